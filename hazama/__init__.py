@@ -23,8 +23,8 @@ __author__ = 'krrr'
 
 
 def main_entry():
-    import time
-    start_time = time.clock()
+    from hazama.timeline import startup
+    startup.begin()
     import logging
     import sys
     from hazama import config
@@ -32,28 +32,26 @@ def main_entry():
     config.changeCWD()
     config.init()
 
-    level = logging.DEBUG if config.settings['Main'].getboolean('debug') else logging.INFO
-    logging.basicConfig(format='%(levelname)s: %(message)s', level=level)
+    debug = config.settings['Main'].getboolean('debug')
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=logging.DEBUG if debug else logging.INFO)
     logging.info('Hazama v%s  (%s, Py%d.%d.%d)', __version__, sys.platform, *sys.version_info[:3])
     logging.info(str(config.nikki))
+    if debug:
+        startup.path = 'startup.json'
 
-    from hazama import ui, db, updater
-    from hazama import updater
+    # updater and windows other than MainWindow are imported on first use
+    from hazama import ui, db
     app = ui.init()
     from hazama.ui.mainwindow import MainWindow
 
     w = MainWindow()
+    startup.mark('main window')
     w.show()
-    logging.debug('startup took %.2f sec', time.clock()-start_time)
-
-    if config.settings['Main'].getboolean('backup'):
-        try:
-            db.backup()
-        except OSError as e:
-            from hazama.ui import showErrors
-            showErrors('cantFile', info=str(e))
+    startup.mark('show')  # finished when the first batch of diaries arrives
 
     if config.settings['Update'].getboolean('needClean'):
+        from hazama import updater
         updater.cleanBackup()
         config.settings['Update']['needClean'] = str(False)
 
@@ -64,8 +62,10 @@ def main_entry():
     config.saveSettings()
 
     # segfault might happen if not wait for them
-    for i in [updater.checkUpdateTask, updater.installUpdateTask]:
-        if i is not None:
-            logging.debug('waiting for %s to exit', i)
-            i.wait()
+    updater = sys.modules.get('hazama.updater')
+    if updater:
+        for i in [updater.checkUpdateTask, updater.installUpdateTask]:
+            if i is not None:
+                logging.debug('waiting for %s to exit', i)
+                i.wait()
     return ret
@@ -4,6 +4,7 @@ import os
 from configparser import ConfigParser
 from os import path
 from hazama import db
+from hazama.timeline import startup
 
 
 # constants
@@ -19,9 +20,13 @@ isWin8OrLater = isWin and _winVer >= (6, 2)
 settings = ConfigParser()
 # set default values. some values have no defaults, such as windowGeo and tagListWidth
 settings.update({
-    'Main': {'debug': False, 'backup': True, 'dbPath': 'nikkichou.db',
+    'Main': {'debug': False, 'backup': True, 'backupCompress': 'none',
+             'backupDedup': False, 'dbPath': 'nikkichou.db',
+             # connection profile, see db.default_profile
+             'dbJournalMode': 'wal', 'dbSynchronous': 'normal', 'dbCacheSize': -8000,
+             'dbMmapSize': 0, 'dbTempStore': 'default',
              'tagListCount': True, 'previewLines': 4, 'listSortBy': 'datetime',
-             'listReverse': True, 'tagListVisible': False,
+             'listReverse': True, 'tagListVisible': False, 'lazyLoad': False,
              'extendTitleBarBg': isWin8OrLater,  # Win8 has no aero glass
              'theme': 'colorful' if isWinVistaOrLater else '1px-rect'},
     'Editor': {'autoIndent': True, 'titleFocus': False, 'autoReadOnly': True},
@@ -63,6 +68,14 @@ def saveSettings():
         ui.showErrors('cantFile', info=str(e))
 
 
+def dbProfile():
+    """Return connection profile of database from settings."""
+    m = settings['Main']
+    return dict(journal_mode=m['dbJournalMode'], synchronous=m['dbSynchronous'],
+                cache_size=m['dbCacheSize'], mmap_size=m['dbMmapSize'],
+                temp_store=m['dbTempStore'])
+
+
 def init():
     """Load config.ini under CWD, initialize settings and nikki."""
     try:
@@ -71,9 +84,10 @@ def init():
             settings.read_file(f)
     except FileNotFoundError:
         pass
+    startup.mark('config')
 
     try:
-        nikki.connect(settings['Main']['dbPath'])
+        nikki.connect(settings['Main']['dbPath'], dbProfile())
     except db.DatabaseError as e:
         from hazama import ui
         ui.showErrors('dbError', hint=str(e))
@@ -82,3 +96,4 @@ def init():
         from hazama import ui
         ui.showErrors('dbLocked')
         sys.exit(-1)
+    startup.mark('db connect')
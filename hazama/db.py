@@ -1,22 +1,61 @@
 ﻿import sqlite3
 import os
+import re
+import sys
+import gzip
+import json
+import lzma
+import zlib
+import hashlib
 import shutil
 import logging
-from datetime import date, timedelta
-
-
-# template used to format txt file
-default_tpl = '''
-********{title}********
-[Date: {datetime}   Tags: {tags}]\n
-{text}\n\n\n\n'''
-
-sql_tag_with_count = '''
-SELECT Tags.name, (SELECT COUNT(*) FROM Nikki_Tags
-                   WHERE Nikki_Tags.tagid=Tags.id) AS count FROM Tags'''
-
-sql_nikki_formats = 'SELECT start,length,type FROM TextFormat WHERE nikkiid=?'
-
+from array import array
+from collections import OrderedDict
+from itertools import islice, chain
+from datetime import date
+from urllib.request import pathname2url
+
+
+sql_tag_with_count = 'SELECT name, refcount FROM Tags'
+
+sql_nikki_tags = ('SELECT name FROM Nikki_Tags JOIN Tags ON Nikki_Tags.tagid=Tags.id '
+                  'WHERE nikkiid=?')
+
+# tag names of a chunk of diaries, ordered by tag id (same as primary key order)
+sql_chunk_tags = '''
+SELECT nikkiid, GROUP_CONCAT(name, ' ') FROM
+    (SELECT nikkiid, name FROM Nikki_Tags JOIN Tags ON Nikki_Tags.tagid=Tags.id
+     WHERE nikkiid IN (%s) ORDER BY nikkiid, tagid)
+GROUP BY nikkiid'''
+
+# diaries hydrated by one set of queries, must be less than SQLITE_MAX_VARIABLE_NUMBER
+HYDRATE_CHUNK_SIZE = 500
+
+backup_dir = 'backup'
+backup_manifest = os.path.join(backup_dir, 'manifest.json')
+BACKUP_STEP_PAGES = 1024
+# name => (function to open compressed file, extension)
+backup_compressors = {'none': (None, ''), 'gzip': (gzip.open, '.gz'),
+                      'lzma': (lzma.open, '.xz')}
+# deduplicated backups store database in chunks named by SHA-256 of content
+backup_chunk_dir = os.path.join(backup_dir, 'chunks')
+BACKUP_CHUNK_SIZE = 64 * 1024
+
+# seconds to wait when database is locked by a reader in another thread
+WRITE_TIMEOUT = 10
+
+# connection profile: pragmas applied to the connection of writer, see Nikki.connect
+default_profile = OrderedDict([('journal_mode', 'wal'), ('synchronous', 'normal'),
+                               ('cache_size', -8000), ('mmap_size', 0),
+                               ('temp_store', 'default')])
+# allowed values of pragmas, others are integers
+profile_choices = {'journal_mode': ('delete', 'truncate', 'persist', 'wal', 'memory'),
+                   'synchronous': ('off', 'normal', 'full', 'extra'),
+                   'temp_store': ('default', 'file', 'memory')}
+
+# schema of version 0 (without trigger autodeltag, which is dropped by
+# migration 2), later changes are made by migrations. It's only executed on
+# databases of version 0
 schema = '''
 CREATE TABLE IF NOT EXISTS Tags
     (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
@@ -29,31 +68,145 @@ CREATE TABLE IF NOT EXISTS Nikki_Tags
 CREATE TABLE IF NOT EXISTS TextFormat
     (nikkiid INTEGER NOT NULL REFERENCES Nikki(id) ON DELETE CASCADE,
      start INTEGER NOT NULL, length INTEGER NOT NULL, type INTEGER NOT NULL);
-CREATE TRIGGER IF NOT EXISTS autodeltag AFTER DELETE ON Nikki_Tags
-    BEGIN DELETE FROM Tags WHERE (SELECT COUNT(*) FROM Nikki_Tags WHERE
-    Nikki_Tags.tagid=Tags.id)==0; END;
 '''
 
+# migrations[i] upgrades database from version i to i+1 (version is stored
+# in PRAGMA user_version). Never modify existing ones, append new one instead.
+migrations = [
+    # 1: indexes used by sorting and lookups; stored length of text
+    '''
+ALTER TABLE Nikki ADD COLUMN length INTEGER NOT NULL DEFAULT 0;
+UPDATE Nikki SET length=LENGTH(text);
+CREATE INDEX Nikki_datetime_idx ON Nikki(datetime);
+CREATE INDEX Nikki_title_idx ON Nikki(title);
+CREATE INDEX Nikki_length_idx ON Nikki(length);
+CREATE INDEX Nikki_Tags_tagid_idx ON Nikki_Tags(tagid);
+CREATE INDEX TextFormat_nikkiid_idx ON TextFormat(nikkiid);
+''',
+    # 2: maintain count of diaries using a tag, only the tag that loses its last
+    # diary is deleted (autodeltag scans all tags after every unlinking)
+    '''
+DROP TRIGGER IF EXISTS autodeltag;
+ALTER TABLE Tags ADD COLUMN refcount INTEGER NOT NULL DEFAULT 0;
+UPDATE Tags SET refcount=(SELECT COUNT(*) FROM Nikki_Tags WHERE tagid=Tags.id);
+DELETE FROM Tags WHERE refcount=0;
+CREATE TRIGGER tag_ref AFTER INSERT ON Nikki_Tags
+    BEGIN UPDATE Tags SET refcount=refcount+1 WHERE id=NEW.tagid; END;
+CREATE TRIGGER tag_unref AFTER DELETE ON Nikki_Tags
+    BEGIN UPDATE Tags SET refcount=refcount-1 WHERE id=OLD.tagid;
+    DELETE FROM Tags WHERE id=OLD.tagid AND refcount<=0; END;
+''',
+    # 3: autosaved drafts of editors, id is -1 for new diary
+    '''
+CREATE TABLE Drafts
+    (id INTEGER PRIMARY KEY, datetime TEXT, title TEXT, tags TEXT, text TEXT,
+     formats TEXT, saved TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP);
+''',
+    # 4: formats of a diary are packed into one blob (see pack_formats) instead of
+    # one row per run in TextFormat
+    '''
+ALTER TABLE Nikki ADD COLUMN formats BLOB;
+UPDATE Nikki SET formats=(SELECT pack_formats(start, length, type) FROM TextFormat
+                          WHERE nikkiid=Nikki.id);
+DROP TABLE TextFormat;
+''',
+    # 5: count of diaries and total length of every day, used by heat map
+    '''
+CREATE TABLE DayStats
+    (day TEXT PRIMARY KEY, count INTEGER NOT NULL, length INTEGER NOT NULL)
+    WITHOUT ROWID;
+INSERT INTO DayStats SELECT substr(datetime, 1, 10), COUNT(*), SUM(length) FROM Nikki
+    GROUP BY substr(datetime, 1, 10);
+CREATE TRIGGER day_stats_ins AFTER INSERT ON Nikki BEGIN
+    INSERT OR IGNORE INTO DayStats VALUES(substr(NEW.datetime, 1, 10), 0, 0);
+    UPDATE DayStats SET count=count+1, length=length+NEW.length
+    WHERE day=substr(NEW.datetime, 1, 10); END;
+CREATE TRIGGER day_stats_del AFTER DELETE ON Nikki BEGIN
+    UPDATE DayStats SET count=count-1, length=length-OLD.length
+    WHERE day=substr(OLD.datetime, 1, 10);
+    DELETE FROM DayStats WHERE day=substr(OLD.datetime, 1, 10) AND count<=0; END;
+CREATE TRIGGER day_stats_upd AFTER UPDATE OF datetime, length ON Nikki BEGIN
+    UPDATE DayStats SET count=count-1, length=length-OLD.length
+    WHERE day=substr(OLD.datetime, 1, 10);
+    DELETE FROM DayStats WHERE day=substr(OLD.datetime, 1, 10) AND count<=0;
+    INSERT OR IGNORE INTO DayStats VALUES(substr(NEW.datetime, 1, 10), 0, 0);
+    UPDATE DayStats SET count=count+1, length=length+NEW.length
+    WHERE day=substr(NEW.datetime, 1, 10); END;
+''',
+]
+
+SCHEMA_VERSION = len(migrations)
+
+# columns of Drafts that can be written by Nikki.savedraft
+draft_fields = {'datetime', 'title', 'tags', 'text', 'formats'}
+
+# full-text index of diaries. It's optional because FTS5 and trigram tokenizer
+# (substring matching) depend on how SQLite is built. The index is rebuilt when
+# its triggers are missing, and triggers are dropped when FTS5 isn't usable
+# (avoid breaking saving, the index becomes stale then)
+fts_schema = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS NikkiFts USING fts5(datetime, title, text,
+    content='Nikki', content_rowid='id', tokenize='trigram');
+INSERT INTO NikkiFts(NikkiFts) VALUES('rebuild');
+CREATE TRIGGER nikki_fts_ins AFTER INSERT ON Nikki BEGIN
+    INSERT INTO NikkiFts(rowid, datetime, title, text)
+    VALUES(NEW.id, NEW.datetime, NEW.title, NEW.text); END;
+CREATE TRIGGER nikki_fts_del AFTER DELETE ON Nikki BEGIN
+    INSERT INTO NikkiFts(NikkiFts, rowid, datetime, title, text)
+    VALUES('delete', OLD.id, OLD.datetime, OLD.title, OLD.text); END;
+CREATE TRIGGER nikki_fts_upd AFTER UPDATE OF datetime, title, text ON Nikki BEGIN
+    INSERT INTO NikkiFts(NikkiFts, rowid, datetime, title, text)
+    VALUES('delete', OLD.id, OLD.datetime, OLD.title, OLD.text);
+    INSERT INTO NikkiFts(rowid, datetime, title, text)
+    VALUES(NEW.id, NEW.datetime, NEW.title, NEW.text); END;
+'''
+fts_triggers = ['nikki_fts_ins', 'nikki_fts_del', 'nikki_fts_upd']
+
+# trigram tokenizer can't match shorter string
+FTS_MIN_QUERY_LEN = 3
+
 DatabaseError = sqlite3.DatabaseError
 
 
 class DatabaseLockedError(Exception): pass
 
 
+def _lock_file(path):
+    """Open and lock given file without blocking, return the file object. Lock will
+    be released when file closed. Raise DatabaseLockedError if locked by others."""
+    f = open(path, 'a')
+    try:
+        if sys.platform == 'win32':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        raise DatabaseLockedError
+    return f
+
+
 class Nikki:
     """This class handles save/read/import/export on SQLite3 database.
 
     Each table's function:
-    Nikki: diary without format/tag fields.
+    Nikki: diary without tag field, formats are packed into a blob
     Nikki_Tags: mapping diary to tags
     Tags: tags
-    TextFormat: rich text formats and their owner
+    Drafts: autosaved drafts of editors
+    DayStats: count of diaries and total length of every day, kept by triggers
     """
     _instance = None
 
     def __init__(self, db_path=None):
         self._path = self._conn = None
         self._commit = self._exe = None  # shortcut, update after connect
+        self._fts = False  # whether full-text index usable, update after connect
+        self._lock = None  # opened lock file, see connect
+        self._profile = {}
         self.setinstance(self)
         if db_path: self.connect(db_path)
 
@@ -64,82 +217,163 @@ class Nikki:
         return self._exe('SELECT COUNT(id) FROM Nikki').fetchone()[0]
 
     def __iter__(self):
-        iter_all = self._exe('SELECT * FROM Nikki')
-        return map(self._makedict, iter_all)
+        return self._makedicts(self._exe('SELECT * FROM Nikki'))
 
     def __getitem__(self, key):
-        r = self._exe('SELECT * FROM Nikki WHERE id=?', (key,)).fetchone()
-        if r is None:
+        try:
+            return next(self._makedicts(
+                self._exe('SELECT * FROM Nikki WHERE id=?', (key,))))
+        except StopIteration:
             raise IndexError
-        return self._makedict(r)
 
-    def connect(self, db_path):
+    def connect(self, db_path, profile=None):
+        """Connect to database, profile is a dict that overrides pragmas in
+        default_profile. Profile of last connection is used if it's None."""
         self._path = db_path
+        if profile is not None: self._profile = profile
         if self._conn: self.disconnect()
-        self._conn = sqlite3.connect(db_path, timeout=0)
+        # prevent other instance from visiting one database, lock a separate file
+        # instead of the database itself so that readers in other threads still work
+        self._lock = _lock_file(db_path + '.lock')
+        self._conn = sqlite3.connect(db_path, timeout=WRITE_TIMEOUT)
         self._commit, self._exe = self._conn.commit, self._conn.execute
 
         self._exe('PRAGMA foreign_keys = ON')
-        # prevent other instance from visiting one database
-        self._exe('PRAGMA locking_mode = EXCLUSIVE')
-        try:
-            self._exe('BEGIN EXCLUSIVE')  # obtain lock by dummy transaction
-        except sqlite3.OperationalError as e:
-            if str(e).startswith('database is locked'):
-                raise DatabaseLockedError
-            else:
-                raise
+        self._apply_profile()
         self._check_schema()
 
+    def _apply_profile(self):
+        for k, default in default_profile.items():
+            v = str(self._profile.get(k, default)).lower()
+            if not (v in profile_choices[k] if k in profile_choices
+                    else v.lstrip('-').isdigit()):
+                logging.warning('invalid %s (%s) in connection profile, use %s',
+                                k, v, default)
+                v = default
+            self._exe('PRAGMA %s = %s' % (k, v))
+
     def disconnect(self):
         self._conn.close()
         self._conn = self._exe = None
+        if self._lock:
+            self._lock.close()
+            self._lock = None
 
-    def _check_schema(self):
-        self._conn.executescript(schema)
+    def reader(self):
+        """Return a new read-only connection to current database, which can be
+        used in another thread."""
+        return NikkiReader(self._path, self._fts)
 
-    def sorted(self, order, reverse=True):
-        assert order in ['datetime', 'title', 'length']
-        order = order.replace('length', 'LENGTH(text)')
-        cmd = ('SELECT * FROM Nikki ORDER BY ' +
-               order + (' DESC' if reverse else ''))
-        for r in self._exe(cmd):
-            yield self._makedict(r)
-
-    def _makedict(self, r):
-        """Make a dictionary that represents one diary"""
-        tags_id = self._exe('SELECT tagid FROM Nikki_Tags WHERE '
-                            'nikkiid=?', (r[0],))
-        tags = ' '.join(self._exe('SELECT name FROM Tags WHERE id = ?',
-                                  (i[0],)).fetchone()[0]
-                        for i in tags_id) if tags_id else ''
-
-        formats = self._exe(sql_nikki_formats, (r[0],))
-        # cursor object only generates once, so we make a list
-        formats = list(formats) if formats else None
-
-        return dict(id=r[0], title=r[3], datetime=r[1], text=r[2],
-                    tags=tags, formats=formats)
-
-    def exporttxt(self, path, selected=None):
-        """Export to TXT file using template (python string formatting).
-        If selected contains diary dictionaries, only export diaries in it."""
-        file = open(path, 'w', encoding='utf-8')
+    def _check_schema(self):
+        """Create or migrate schema according to PRAGMA user_version. Current
+        schema takes a fast path that executes no DDL, which is the usual case."""
+        version = self._exe('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise DatabaseError('database is created by newer version of Hazama')
+        if version < SCHEMA_VERSION:
+            if version == 0:
+                self._conn.executescript(schema)
+            self._conn.create_aggregate('pack_formats', 3, _FormatPacker)  # migration 4
+            for v in range(version, SCHEMA_VERSION):
+                logging.info('migrating database to version %d', v+1)
+                # every migration is done in one transaction
+                self._conn.executescript('BEGIN; %s PRAGMA user_version = %d; COMMIT;' %
+                                         (migrations[v], v+1))
+        self._fts = self._check_fts()
+
+    def _check_fts(self):
+        """Create full-text index if not exists. Return False if FTS5 not usable.
+        If all triggers of the index exist and SQLite is built with FTS5, the index
+        is trusted without probing (creating a table), which needs compiling."""
+        count = self._exe("SELECT COUNT(*) FROM sqlite_master WHERE type='trigger' AND "
+                          "name IN (%s)" % ','.join('?' * len(fts_triggers)),
+                          fts_triggers).fetchone()[0]
+        if (count == len(fts_triggers) and sqlite3.sqlite_version_info >= (3, 34) and
+                self._exe("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0]):
+            return True
         try:
-            with open('template.txt', encoding='utf-8') as f:
-                tpl = f.read()
-            tpl_type = 'custom'
-        except OSError:
-            tpl = default_tpl
-            tpl_type = 'default'
-        for n in (self.sorted('datetime', False) if selected is None
-                  else selected):
-            file.write(tpl.format(**n))
-        file.close()
-        logging.info('exporting succeeded (template: %s)', tpl_type)
+            self._exe("CREATE VIRTUAL TABLE temp.FtsProbe USING fts5(a, tokenize='trigram')")
+            self._exe('DROP TABLE temp.FtsProbe')
+        except sqlite3.OperationalError as e:
+            logging.warning('full-text search disabled: %s', e)
+            self._conn.executescript(''.join('DROP TRIGGER IF EXISTS %s;' % i
+                                             for i in fts_triggers))
+            return False
+        if count != len(fts_triggers):
+            logging.info('building full-text index')
+            self._conn.executescript('BEGIN; %s %s COMMIT;' % (
+                ''.join('DROP TRIGGER IF EXISTS %s;' % i for i in fts_triggers),
+                fts_schema))
+        return True
+
+    def sorted(self, order, reverse=True, light=False, ids=None, packed=False):
+        """Generate diaries in given order. If light is True, diaries have no text
+        and formats but length of text (use getbodies to get them later). If ids
+        is not None, only diaries whose id in it are generated. If packed is True,
+        formats are left as packed by pack_formats."""
+        assert order in ['datetime', 'title', 'length']
+        # light one has the same column positions
+        cols = 'id,datetime,NULL,title,length' if light else '*'
+        where, args = '', ()
+        if ids is not None:
+            # ids are passed as one JSON array, nothing is written (no transaction
+            # left open) and generators running at the same time don't interfere
+            where = ' WHERE id IN (SELECT value FROM json_each(?))'
+            args = (json.dumps(list(ids)),)
+        cmd = ('SELECT %s FROM Nikki%s ORDER BY %s' % (cols, where, order) +
+               (' DESC' if reverse else ''))
+        return self._makedicts(self._exe(cmd, args), light, packed)
+
+    def _makedicts(self, cursor, light=False, packed=False):
+        """Generate dictionaries that represent diaries from rows of Nikki table.
+        Tags are fetched by one set-based query for every chunk of rows, instead
+        of several queries per diary."""
+        while True:
+            rows = cursor.fetchmany(HYDRATE_CHUNK_SIZE)
+            if not rows: break
+            ids = [r[0] for r in rows]
+            marks = ','.join('?' * len(ids))
+
+            tags = dict(self._exe(sql_chunk_tags % marks, ids))
+            if light:
+                for r in rows:
+                    yield dict(id=r[0], title=r[3], datetime=r[1], tags=tags.get(r[0], ''),
+                               length=r[4])
+                continue
+
+            for r in rows:
+                yield dict(id=r[0], title=r[3], datetime=r[1], text=r[2],
+                           tags=tags.get(r[0], ''),
+                           formats=r[5] if packed else unpack_formats(r[5]))
+
+    def getbodies(self, ids, packed=False):
+        """Return a dictionary that maps id to (text, formats) of given diaries.
+        See sorted for packed."""
+        ids, ret = list(ids), {}
+        for i in range(0, len(ids), HYDRATE_CHUNK_SIZE):
+            chunk = ids[i:i+HYDRATE_CHUNK_SIZE]
+            cmd = ('SELECT id, text, formats FROM Nikki WHERE id IN (%s)' %
+                   ','.join('?' * len(chunk)))
+            ret.update((r[0], (r[1], r[2] if packed else unpack_formats(r[2])))
+                       for r in self._exe(cmd, chunk))
+        return ret
+
+    def search(self, query):
+        """Return ids of diaries whose datetime, title or text contains query
+        (case-insensitive). Best matched ones come first if full-text index used."""
+        if self._fts and len(query) >= FTS_MIN_QUERY_LEN:
+            cmd = 'SELECT rowid FROM NikkiFts WHERE NikkiFts MATCH ? ORDER BY rank'
+            # quote as a string, so that FTS query syntax is disabled
+            return [r[0] for r in self._exe(cmd, ('"%s"' % query.replace('"', '""'),))]
+        else:  # fallback to scanning
+            pattern = '%' + re.sub(r'([\\%_])', r'\\\1', query) + '%'
+            cmd = ("SELECT id FROM Nikki WHERE datetime LIKE ?1 ESCAPE '\\' OR "
+                   "title LIKE ?1 ESCAPE '\\' OR text LIKE ?1 ESCAPE '\\'")
+            return [r[0] for r in self._exe(cmd, (pattern,))]
 
     def delete(self, id):
         self._exe('DELETE FROM Nikki WHERE id = ?', (id,))
+        self._exe('DELETE FROM Drafts WHERE id = ?', (id,))
         logging.info('diary deleted (ID: %s)' % id)
         self._commit()
 
@@ -151,6 +385,12 @@ class Nikki:
         else:
             return (n[0] for n in self._exe('SELECT name FROM Tags'))
 
+    def gettagged(self, name):
+        """Return ids of diaries which have given tag"""
+        return [r[0] for r in self._exe(
+            'SELECT nikkiid FROM Nikki_Tags WHERE tagid=(SELECT id FROM Tags WHERE name=?)',
+            (name,))]
+
     def _gettagid(self, name):
         """Get tag-id by name"""
         return self._exe('SELECT id FROM Tags WHERE name=?', (name,)).fetchone()[0]
@@ -167,36 +407,115 @@ class Nikki:
         :return: the id of saved diary if not batch, else None
         """
         new = id == -1
-        id = self.getnewid() if new else id
-        values = ((None, datetime, text, title) if new else
-                  (datetime, text, title, id))
-        cmd = ('INSERT INTO Nikki VALUES(?,?,?,?)' if new else
-               'UPDATE Nikki SET datetime=?, text=?, title=? WHERE id=?')
-        self._exe(cmd, values)
-        # formats processing
-        if not new:  # delete existed format information
-            self._exe('DELETE FROM TextFormat WHERE nikkiid=?', (id,))
-        if formats:
-            for i in formats:
-                cmd = 'INSERT INTO TextFormat VALUES(?,?,?,?)'
-                self._exe(cmd, (id,) + i)
-        # tags processing
-        if tags is not None:
-            if not new:  # if diary isn't new, delete its tags first
-                self._exe('DELETE FROM Nikki_Tags WHERE nikkiid=?', (id,))
-            for t in tags.split():
-                try:
-                    tag_id = self._gettagid(t)
-                except TypeError:  # tag not exists
-                    self._exe('INSERT INTO Tags VALUES(NULL,?)', (t,))
-                    self._commit()
-                    tag_id = self._gettagid(t)
-                self._exe('INSERT INTO Nikki_Tags VALUES(?,?)', (id, tag_id))
+        formats = pack_formats(normalize_formats(formats or []))
+        try:
+            if new:
+                id = self._exe('INSERT INTO Nikki VALUES(?,?,?,?,?,?)',
+                               (None, datetime, text, title, len(text), formats)).lastrowid
+            else:
+                self._exe('UPDATE Nikki SET datetime=?, text=?, title=?, length=?, formats=? '
+                          'WHERE id=?', (datetime, text, title, len(text), formats, id))
+            # tags processing, only links of changed tags are touched
+            if tags is not None:
+                tags = list(OrderedDict.fromkeys(tags.split()))  # remove duplicates
+                old_tags = set() if new else {r[0] for r in self._exe(sql_nikki_tags, (id,))}
+                for t in old_tags.difference(tags):
+                    self._exe('DELETE FROM Nikki_Tags WHERE nikkiid=? AND tagid=?',
+                              (id, self._gettagid(t)))
+                for t in (i for i in tags if i not in old_tags):
+                    try:
+                        tag_id = self._gettagid(t)
+                    except TypeError:  # tag not exists
+                        tag_id = self._exe('INSERT INTO Tags (name) VALUES(?)',
+                                           (t,)).lastrowid
+                    self._exe('INSERT INTO Nikki_Tags VALUES(?,?)', (id, tag_id))
+            if not batch: self._commit()
+        except BaseException:
+            # e.g. database is locked by a reader in rollback journal mode, saving
+            # again should not start from a half-done transaction
+            if not batch: self._conn.rollback()
+            raise
         if not batch:
-            self._commit()
             logging.info('diary saved(ID: %s)' % id)
             return id
 
+    def import_many(self, diaries):
+        """Add diaries in one transaction, much faster than calling save repeatedly.
+        :param diaries: iterable of dicts with keys datetime, title, tags (string
+            contains space-separated tags), text and optional formats; id is ignored
+        :return: the count of imported diaries
+        """
+        # triggers are dropped while inserting, their work is done in bulk afterwards
+        dropped = ['tag_ref', 'day_stats_ins'] + fts_triggers
+        triggers = self._exe("SELECT sql FROM sqlite_master WHERE type='trigger' AND "
+                             "name IN (%s)" % ','.join('?' * len(dropped)),
+                             dropped).fetchall()
+        tag_ids = {r[1]: r[0] for r in self._exe('SELECT id, name FROM Tags')}
+        first_id = next_id = self.getnewid()
+        if not self._conn.in_transaction: self._exe('BEGIN')
+        try:
+            for i in dropped:
+                self._exe('DROP TRIGGER IF EXISTS %s' % i)
+            for chunk in _chunks(diaries, HYDRATE_CHUNK_SIZE):
+                rows, links = [], []
+                for d in chunk:
+                    text = d['text']
+                    rows.append((next_id, d['datetime'], text, d['title'], len(text),
+                                 pack_formats(normalize_formats(d.get('formats') or []))))
+                    for t in OrderedDict.fromkeys((d['tags'] or '').split()):
+                        if t not in tag_ids:
+                            tag_ids[t] = self._exe('INSERT INTO Tags (name) VALUES(?)',
+                                                   (t,)).lastrowid
+                        links.append((next_id, tag_ids[t]))
+                    next_id += 1
+                self._conn.executemany('INSERT INTO Nikki VALUES(?,?,?,?,?,?)', rows)
+                self._conn.executemany('INSERT INTO Nikki_Tags VALUES(?,?)', links)
+            self._exe('UPDATE Tags SET refcount=(SELECT COUNT(*) FROM Nikki_Tags '
+                      'WHERE tagid=Tags.id) WHERE id IN (SELECT DISTINCT tagid '
+                      'FROM Nikki_Tags WHERE nikkiid>=?)', (first_id,))
+            self._exe('INSERT OR REPLACE INTO DayStats SELECT substr(datetime, 1, 10), '
+                      'COUNT(*), SUM(length) FROM Nikki WHERE substr(datetime, 1, 10) IN '
+                      '(SELECT substr(datetime, 1, 10) FROM Nikki WHERE id>=?) '
+                      'GROUP BY substr(datetime, 1, 10)', (first_id,))
+            if self._fts:
+                self._exe('INSERT INTO NikkiFts(rowid, datetime, title, text) '
+                          'SELECT id, datetime, title, text FROM Nikki WHERE id>=?',
+                          (first_id,))
+            for r in triggers:
+                self._exe(r[0])
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._commit()
+        logging.info('%d diaries imported', next_id - first_id)
+        return next_id - first_id
+
+    def savedraft(self, id, **fields):
+        """Write fields of the draft of diary (id is -1 for new diary). Only
+        changed fields should be given, others remain what last written."""
+        assert set(fields) <= draft_fields
+        if 'formats' in fields:
+            fields['formats'] = json.dumps(fields['formats'] or [])
+        self._exe('INSERT OR IGNORE INTO Drafts (id) VALUES(?)', (id,))
+        self._exe('UPDATE Drafts SET %s saved=CURRENT_TIMESTAMP WHERE id=?' %
+                  ''.join('%s=?, ' % k for k in fields), list(fields.values()) + [id])
+        self._commit()
+
+    def getdrafts(self):
+        """Generate drafts as diary dictionaries, saved is the time (UTC) of last
+        writing. Key datetime is absent if not set (draft of new diary), like the
+        dictionary editors of new diaries are created with."""
+        for r in self._exe('SELECT id, datetime, title, tags, text, formats, saved '
+                           'FROM Drafts ORDER BY saved'):
+            d = dict(id=r[0], title=r[2] or '', tags=r[3] or '', text=r[4] or '',
+                     formats=[tuple(i) for i in json.loads(r[5] or '[]')], saved=r[6])
+            if r[1]: d['datetime'] = r[1]
+            yield d
+
+    def deletedraft(self, id):
+        self._exe('DELETE FROM Drafts WHERE id = ?', (id,))
+        self._commit()
+
     def getnewid(self):
         max_id = self._exe('SELECT max(id) FROM Nikki').fetchone()[0]
         return max_id + 1 if max_id else 1
@@ -204,6 +523,13 @@ class Nikki:
     def getpath(self):
         return self._path
 
+    def getdaystats(self, year):
+        """Return a dictionary that maps (month, day) to (count of diaries, total
+        length of text) of days in the year that have diaries."""
+        cmd = 'SELECT substr(day, 6), count, length FROM DayStats WHERE day >= ? AND day < ?'
+        return {(int(r[0][:2]), int(r[0][3:])): (r[1], r[2])
+                for r in self._exe(cmd, ('%04d-' % year, '%04d-' % (year + 1)))}
+
     def get_datetime_range(self):
         return self._exe('SELECT min(datetime), max(datetime) from Nikki').fetchone()
 
@@ -217,38 +543,276 @@ class Nikki:
         return cls._instance
 
 
-def list_backups():
+def normalize_formats(formats):
+    """Merge overlapping or adjacent runs of the same type and drop empty ones,
+    return sorted list of (start, length, type). NTextDocument.getFormats emits a
+    run for every fragment, which may be split by runs of other types."""
+    merged = []  # [type, start, end]
+    for type_, start, end in sorted((f[2], f[0], f[0] + f[1]) for f in formats if f[1] > 0):
+        if merged and merged[-1][0] == type_ and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([type_, start, end])
+    return sorted((start, end - start, type_) for type_, start, end in merged)
+
+
+def pack_formats(formats):
+    """Pack formats into bytes of little-endian 32-bit integers (start, length
+    and type of every run in turn), return None if there is no format. One blob
+    per diary is much smaller and faster to load than rows of tuples."""
+    if not formats: return None
+    packed = array('I', chain.from_iterable(formats))
+    if sys.byteorder == 'big': packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_formats(blob):
+    """Return list of (start, length, type) packed by pack_formats."""
+    if not blob: return []
+    packed = array('I')
+    packed.frombytes(blob)
+    if sys.byteorder == 'big': packed.byteswap()
+    return list(zip(packed[0::3], packed[1::3], packed[2::3]))
+
+
+class _FormatPacker:
+    """SQLite aggregate that packs rows of TextFormat, used by migration 4."""
+    def __init__(self):
+        self.formats = []
+
+    def step(self, start, length, type_):
+        self.formats.append((start, length, type_))
+
+    def finalize(self):
+        return pack_formats(normalize_formats(self.formats))
+
+
+def _chunks(iterable, size):
+    """Split iterable into lists of given size (the last one may be shorter)."""
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk: return
+        yield chunk
+
+
+class NikkiReader(Nikki):
+    """Read-only connection to a diary book, not registered as the instance. It
+    can be created in one thread and used in another, but only by one thread at
+    a time. Schema is never checked or changed through it."""
+    def __init__(self, db_path, fts=False):
+        self._fts, self._lock, self._conn = fts, None, None
+        self.connect(db_path)
+
+    def connect(self, db_path):
+        """Open database read-only, neither lock nor schema check is needed."""
+        self._path = db_path
+        if self._conn: self.disconnect()
+        uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(db_path))
+        self._conn = sqlite3.connect(uri, uri=True, timeout=WRITE_TIMEOUT,
+                                     check_same_thread=False)
+        self._commit, self._exe = self._conn.commit, self._conn.execute
+
+
+def _read_manifest():
+    """Return entries of backups (dicts with keys name, date, count, size and
+    compress) in time order. Manifest is created from file names of backups if
+    not exists (made by old versions)."""
+    try:
+        with open(backup_manifest, encoding='utf-8') as f:
+            return json.load(f)['backups']
+    except FileNotFoundError:
+        pass
     try:
-        files = sorted(os.listdir('backup'))
+        files = sorted(os.listdir(backup_dir))
     except FileNotFoundError:
         return []
-    fil = lambda x: len(x)>10 and x[4]==x[7]=='-' and x[10]=='_'
-    return list(filter(fil, files))
+    fil = lambda x: len(x)>10 and x[4]==x[7]=='-' and x[10]=='_' and x.endswith('.db')
+    entries = [dict(name=i, date=i[:10], count=int(i[11:-3]), compress='none',
+                    size=os.path.getsize(os.path.join(backup_dir, i)))
+               for i in filter(fil, files)]
+    _write_manifest(entries)
+    return entries
+
+
+def _write_manifest(entries):
+    if not os.path.isdir(backup_dir): os.mkdir(backup_dir)
+    tmp = backup_manifest + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'version': 1, 'backups': entries}, f, indent=1)
+    os.replace(tmp, backup_manifest)  # never leave a broken manifest
+
+
+def _copy_db(src_path, dst_path, progress=None, restore=False):
+    """Copy database using backup API of SQLite, some pages at a time so that
+    writers are not blocked too long. progress is called with (copied, total).
+    Backups are switched to rollback journal and opened as immutable when
+    restored, so no -wal and -shm files are left in backup_dir. Journal mode of
+    the database itself is set by Nikki.connect."""
+    uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(src_path))
+    if restore: uri += '&immutable=1'
+    src = sqlite3.connect(uri, uri=True, timeout=WRITE_TIMEOUT)
+    dst = sqlite3.connect(dst_path, timeout=WRITE_TIMEOUT)
+    try:
+        src.backup(dst, pages=BACKUP_STEP_PAGES,
+                   progress=progress and (lambda status, remaining, total:
+                                          progress(total - remaining, total)))
+        if not restore: dst.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        dst.close()
+        src.close()
+
+
+def _chunk_path(digest):
+    return os.path.join(backup_chunk_dir, digest[:2], digest)
+
+
+def _store_chunks(src_path, list_path):
+    """Split file into chunks, store those not stored yet (compressed by zlib),
+    then write the list of chunks to list_path. Return count of bytes written."""
+    digests, written = [], 0
+    with open(src_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BACKUP_CHUNK_SIZE), b''):
+            digest = hashlib.sha256(chunk).hexdigest()
+            digests.append(digest)
+            path = _chunk_path(digest)
+            if os.path.exists(path): continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = zlib.compress(chunk)
+            with open(path + '.tmp', 'wb') as out:
+                out.write(data)
+            os.replace(path + '.tmp', path)
+            written += len(data)
+    with open(list_path, 'w', encoding='utf-8') as f:
+        json.dump({'chunk_size': BACKUP_CHUNK_SIZE, 'chunks': digests}, f)
+    return written + os.path.getsize(list_path)
+
+
+def _load_chunks(list_path, dst_path):
+    """Reassemble file from chunks listed in list_path."""
+    with open(list_path, encoding='utf-8') as f:
+        digests = json.load(f)['chunks']
+    with open(dst_path, 'wb') as out:
+        for digest in digests:
+            with open(_chunk_path(digest), 'rb') as f:
+                chunk = zlib.decompress(f.read())
+            if hashlib.sha256(chunk).hexdigest() != digest:
+                raise DatabaseError('backup is corrupt (chunk %s)' % digest)
+            out.write(chunk)
+
+
+def _gc_chunks(entries):
+    """Delete chunks that not used by any backup in entries."""
+    used = set()
+    for i in entries:
+        if i['compress'] != 'dedup': continue
+        with open(os.path.join(backup_dir, i['name']), encoding='utf-8') as f:
+            used.update(json.load(f)['chunks'])
+    removed = 0
+    for dir_path, __, files in os.walk(backup_chunk_dir):
+        for name in files:
+            if name not in used:
+                os.remove(os.path.join(dir_path, name))
+                removed += 1
+    logging.info('%d unused backup chunks deleted', removed)
+
+
+def _expired_backups(entries, today):
+    """Return entries of backups that should be deleted. Full copies are kept for
+    a week. Deduplicated ones are kept daily for a week, weekly for two months
+    and monthly for a year (the newest one in each period is kept)."""
+    expired, periods = [], set()
+    for i in reversed(entries):  # newest first
+        d = date(*map(int, i['date'].split('-')))
+        age = (today - d).days
+        if age <= 7: continue
+        if i['compress'] != 'dedup' or age > 365:
+            expired.append(i)
+            continue
+        period = d.isocalendar()[:2] if age <= 61 else (d.year, 0, d.month)
+        if period in periods:
+            expired.append(i)
+        else:
+            periods.add(period)
+    return expired
 
 
-def restore_backup(bk_name):
-    logging.info('restore backup: %s', bk_name)
-    nikki = Nikki.getinstance()
-    nikki.disconnect()
-    bk_path = os.path.join('backup', bk_name)
-    shutil.copyfile(bk_path, nikki.getpath())
-    nikki.connect(nikki.getpath())
+def list_backups():
+    return [i['name'] for i in _read_manifest()]
 
 
-def backup():
-    """Do daily backup and delete old backups if not did yet."""
-    db_path = Nikki.getinstance().getpath()
-    if not os.path.isdir('backup'): os.mkdir('backup')
-    backups = list_backups()
-    newest = backups[-1] if backups else ''
-    if newest.split('_')[0] == str(date.today()): return
+def restore_backup(bk_name, progress=None):
+    """Replace current database with the backup. Its content is copied through a
+    new connection, so it can be called in any thread, but the instance of Nikki
+    should connect again afterwards (backup may be made by older version)."""
+    logging.info('restore backup: %s', bk_name)
+    entry = next(i for i in _read_manifest() if i['name'] == bk_name)
+    bk_path = os.path.join(backup_dir, bk_name)
+    tmp = None
+    if entry['compress'] == 'dedup':
+        tmp = bk_path + '.tmp'
+        _load_chunks(bk_path, tmp)
+    elif entry['compress'] != 'none':
+        tmp = bk_path + '.tmp'
+        with backup_compressors[entry['compress']][0](bk_path, 'rb') as fin, \
+                open(tmp, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+    try:
+        _copy_db(tmp or bk_path, Nikki.getinstance().getpath(), progress, restore=True)
+    finally:
+        if tmp: os.remove(tmp)
+
+
+def backup(compress='none', progress=None, dedup=False):
+    """Do daily backup and delete old backups if not did yet. Database is copied
+    through a new connection, so it can be called in any thread.
+    :param compress: key of backup_compressors, ignored if dedup
+    :param progress: function called with (copied pages, total pages)
+    :param dedup: only write chunks that changed since older backups, and keep
+        backups longer (see _expired_backups)
+    :return: True if backup made
+    """
+    entries = _read_manifest()
+    today = str(date.today())
+    if entries and entries[-1]['date'] == today: return False
 
-    shutil.copyfile(db_path, os.path.join(
-        'backup', str(date.today())+'_%d.db' % len(Nikki.getinstance())))
-    logging.info('everyday backup succeeded')
+    db_path = Nikki.getinstance().getpath()
+    reader = NikkiReader(db_path)
+    count = len(reader)
+    reader.disconnect()
+    if not os.path.isdir(backup_dir): os.mkdir(backup_dir)
+    if dedup:
+        compress, name = 'dedup', '%s_%d.chunks' % (today, count)
+        path = os.path.join(backup_dir, name)
+        _copy_db(db_path, path + '.tmp', progress)  # a consistent snapshot
+        try:
+            size = _store_chunks(path + '.tmp', path)
+        finally:
+            os.remove(path + '.tmp')
+    else:
+        opener, ext = backup_compressors[compress]
+        name = '%s_%d.db%s' % (today, count, ext)
+        path = os.path.join(backup_dir, name)
+        _copy_db(db_path, path + '.tmp', progress)
+        if opener:
+            with open(path + '.tmp', 'rb') as fin, opener(path, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            os.remove(path + '.tmp')
+        else:
+            os.replace(path + '.tmp', path)
+        size = os.path.getsize(path)
+    entries.append(dict(name=name, date=today, count=count, compress=compress, size=size))
+    logging.info('everyday backup succeeded (%d bytes written)', size)
 
     # delete old backups
-    week_before = str(date.today() - timedelta(weeks=1))
-    for i in backups:
-        if not i < week_before: break
-        os.remove(os.path.join('backup', i))
+    expired = _expired_backups(entries, date.today())
+    for i in expired:
+        entries.remove(i)
+        try:
+            os.remove(os.path.join(backup_dir, i['name']))
+        except FileNotFoundError:
+            pass
+    _write_manifest(entries)
+    if any(i['compress'] == 'dedup' for i in expired):
+        _gc_chunks(entries)
+    return True
@@ -0,0 +1,202 @@
+"""Export diaries to TXT (using template), JSON lines, Markdown or HTML."""
+import os
+import json
+import logging
+from html import escape
+from string import Formatter
+from operator import itemgetter
+
+
+# template used to format txt file, can be overridden by template.txt under CWD
+default_tpl = '''
+********{title}********
+[Date: {datetime}   Tags: {tags}]\n
+{text}\n\n\n\n'''
+
+_fields = {'id', 'datetime', 'title', 'tags', 'text', 'formats'}
+
+# types of formats are the same as NTextDocument's
+Bold, HighLight, Italic, StrikeOut, UnderLine = range(1, 6)
+
+
+def compile_template(tpl):
+    """Parse template (str.format syntax) once, return a function that formats a
+    diary dict. Raise ValueError if template is invalid."""
+    fields, parts = [], []
+    for literal, field, spec, conversion in Formatter().parse(tpl):
+        parts.append(literal.replace('%', '%%'))
+        if field is None: continue
+        if field.split('.')[0].split('[')[0] not in _fields:
+            raise ValueError('unknown field in template: %s' % field)
+        if spec or conversion or not field.isidentifier():
+            return tpl.format_map  # rarely used features, let str.format handle them
+        fields.append(field)
+        parts.append('%s')
+    if not fields:
+        return lambda d: tpl
+    fmt, getter = ''.join(parts), itemgetter(*fields)
+    if len(fields) == 1:
+        return lambda d: fmt % (getter(d),)
+    return lambda d: fmt % getter(d)
+
+
+_tpl_cache = None  # (mtime, compiled template) of template.txt
+
+
+def load_template():
+    """Return compiled template.txt under CWD (default template if not exists).
+    It is compiled again only if the file modified."""
+    global _tpl_cache
+    try:
+        mtime = os.path.getmtime('template.txt')
+    except OSError:
+        return compile_template(default_tpl)
+    if _tpl_cache is None or _tpl_cache[0] != mtime:
+        with open('template.txt', encoding='utf-8') as f:
+            _tpl_cache = mtime, compile_template(f.read())
+        logging.info('custom template loaded')
+    return _tpl_cache[1]
+
+
+def _segments(text, formats):
+    """Split text at boundaries of formats, yield (segment, set of types)."""
+    bounds = {0, len(text)}
+    for start, length, __ in formats:
+        bounds.update((start, start + length))
+    bounds = sorted(b for b in bounds if 0 <= b <= len(text))
+    for a, b in zip(bounds, bounds[1:]):
+        yield text[a:b], {t for start, length, t in formats if start <= a and b <= start + length}
+
+
+_html_tags = [(Bold, 'b'), (Italic, 'i'), (UnderLine, 'u'), (StrikeOut, 's'),
+              (HighLight, 'mark')]
+# markdown has no underline, use html instead
+_md_marks = [(Bold, '**', '**'), (Italic, '*', '*'), (StrikeOut, '~~', '~~'),
+             (HighLight, '==', '=='), (UnderLine, '<u>', '</u>')]
+_md_special = str.maketrans({c: '\\' + c for c in '\\`*_~[]<>#='})
+
+
+def _html_text(text, formats):
+    if not formats:
+        return escape(text).replace('\n', '<br>\n')
+    out = []
+    for seg, types in _segments(text, formats):
+        tags = [tag for t, tag in _html_tags if t in types]
+        out.append(''.join('<%s>' % i for i in tags) + escape(seg) +
+                   ''.join('</%s>' % i for i in reversed(tags)))
+    return ''.join(out).replace('\n', '<br>\n')
+
+
+def _md_text(text, formats):
+    if not formats:
+        return text.translate(_md_special)
+    out = []
+    for seg, types in _segments(text, formats):
+        marks = [(a, b) for t, a, b in _md_marks if t in types]
+        seg = seg.translate(_md_special)
+        stripped = seg.strip()
+        if not marks or not stripped:
+            out.append(seg)
+            continue
+        # emphasis can't start or end with white space in markdown
+        lead, trail = seg[:len(seg) - len(seg.lstrip())], seg[len(seg.rstrip()):]
+        out.append(lead + ''.join(a for a, b in marks) + stripped +
+                   ''.join(b for a, b in reversed(marks)) + trail)
+    return ''.join(out)
+
+
+def _txt_writer(title):
+    return '', load_template(), ''
+
+
+def _jsonl_writer(title):
+    def render(d):
+        return json.dumps(dict(datetime=d['datetime'], title=d['title'], tags=d['tags'],
+                               text=d['text'], formats=d['formats']),
+                          ensure_ascii=False) + '\n'
+    return '', render, ''
+
+
+def _md_writer(title):
+    def render(d):
+        # two spaces at the end of line is line break in markdown
+        text = _md_text(d['text'], d['formats']).replace('\n', '  \n')
+        head = '## %s\n\n' % d['title'].translate(_md_special) if d['title'] else ''
+        tags = ' | %s' % d['tags'] if d['tags'] else ''
+        return '%s*%s%s*\n\n%s\n\n' % (head, d['datetime'], tags, text)
+    return '# %s\n\n' % title, render, ''
+
+
+def _html_writer(title):
+    head = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<title>%s</title>\n</head>\n<body>\n' % escape(title))
+
+    def render(d):
+        tags = ' | %s' % escape(d['tags']) if d['tags'] else ''
+        return ('<article>\n<h2>%s</h2>\n<p><small>%s%s</small></p>\n<p>%s</p>\n'
+                '</article>\n' % (escape(d['title']), d['datetime'], tags,
+                                  _html_text(d['text'], d['formats'])))
+    return head, render, '</body>\n</html>\n'
+
+
+writers = {'txt': _txt_writer, 'jsonl': _jsonl_writer, 'md': _md_writer,
+           'html': _html_writer}
+
+
+_ext2fmt = {'txt': 'txt', 'jsonl': 'jsonl', 'json': 'jsonl', 'md': 'md', 'markdown': 'md',
+            'html': 'html', 'htm': 'html'}
+
+
+def guess_format(path):
+    """Guess export format by extension of path, default is txt."""
+    return _ext2fmt.get(os.path.splitext(path)[1].lower().lstrip('.'), 'txt')
+
+
+class Exporter:
+    """Export diaries into one file. Diaries are streamed from one query in order
+    of datetime and written through a large buffer, so memory usage doesn't grow
+    with the size of diary book. Set canceled to True (from any thread) to stop.
+    The unfinished file is removed if stopped or failed, but not if canceled
+    after all diaries written."""
+    BUFFER_SIZE = 1 << 20
+    PROGRESS_STEP = 200  # diaries between two progress reports
+
+    def __init__(self, nikki, path, fmt=None, ids=None, progress=None):
+        """
+        :param ids: ids of diaries to export, None means all
+        :param progress: function called with (exported, total) periodically
+        """
+        self.nikki, self.path, self.ids, self.progress = nikki, path, ids, progress
+        self.fmt = fmt or guess_format(path)
+        self.canceled = False
+
+    def run(self):
+        """Return the count of exported diaries, or None if canceled."""
+        head, render, tail = writers[self.fmt](os.path.splitext(os.path.basename(self.path))[0])
+        total = len(self.nikki) if self.ids is None else len(self.ids)
+        count, canceled = 0, False
+        f = open(self.path, 'w', encoding='utf-8', buffering=self.BUFFER_SIZE)
+        try:
+            with f:
+                write = f.write
+                write(head)
+                for d in self.nikki.sorted('datetime', False, ids=self.ids):
+                    write(render(d))
+                    count += 1
+                    if count % self.PROGRESS_STEP == 0:
+                        if self.canceled:
+                            canceled = True
+                            break
+                        if self.progress: self.progress(count, total)
+                else:
+                    write(tail)
+        except BaseException:
+            os.remove(self.path)  # never leave a truncated file (e.g. disk full)
+            raise
+        if canceled:
+            os.remove(self.path)
+            logging.info('exporting canceled')
+            return None
+        if self.progress: self.progress(count, count)
+        logging.info('%d diaries exported (%s)', count, self.fmt)
+        return count
@@ -0,0 +1,118 @@
+"""Import diaries into a diary book from TXT (exported with the default template)
+or JSON lines (one object per line with keys datetime, title, tags, text and
+optional formats).
+
+Usage: hazama-import [-f {txt,jsonl}] [--db PATH] FILE [FILE ...]"""
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+from hazama import db
+
+
+_txt_title = re.compile(r'\*{8}(.*)\*{8}\n')
+_txt_info = re.compile(r'\[Date: (.+?)   Tags: (.*)\]\n')
+
+
+def parse_txt(file):
+    """Parse diaries from a file object of TXT exported with default template,
+    yield diary dicts. Formats are lost in TXT, so they are always empty."""
+    diary, body, pending = None, [], None  # pending: title line before info line
+
+    def finish(followed):
+        text = ''.join(body)
+        if followed: text = text[:-1]  # leading newline of the next diary
+        if text.endswith('\n\n\n\n'): text = text[:-4]
+        diary['text'] = text
+        return diary
+
+    it = iter(file)
+    for line in it:
+        if pending is not None:
+            info = _txt_info.match(line)
+            if info:
+                if diary: yield finish(True)
+                diary = dict(title=_txt_title.match(pending).group(1), datetime=info.group(1),
+                             tags=info.group(2), formats=None)
+                body, pending = [], None
+                next(it, None)  # empty line after the info line
+                continue
+            body.append(pending)
+            pending = None
+        if _txt_title.match(line):
+            pending = line
+        elif diary:
+            body.append(line)
+    if pending is not None: body.append(pending)
+    if diary: yield finish(False)
+
+
+def parse_jsonl(file):
+    """Parse diaries from a file object of JSON lines, yield diary dicts."""
+    for num, line in enumerate(file, 1):
+        if not line.strip(): continue
+        try:
+            d = json.loads(line)
+            yield dict(datetime=d['datetime'], title=d.get('title', ''),
+                       tags=d.get('tags', ''), text=d['text'],
+                       formats=[tuple(f) for f in d.get('formats') or []])
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError('line %d: invalid diary (%s)' % (num, e))
+
+
+parsers = {'txt': parse_txt, 'jsonl': parse_jsonl}
+
+
+def import_file(nikki, path, fmt=None):
+    """Import one file into nikki, format is guessed by file extension if not
+    given. Return the count of imported diaries."""
+    if fmt is None:
+        fmt = 'jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'txt'
+    with open(path, encoding='utf-8-sig') as f:
+        return nikki.import_many(parsers[fmt](f))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('-f', '--format', choices=sorted(parsers),
+                        help='format of files, guessed by extension if omitted')
+    parser.add_argument('--db', help='path of diary book, default is the one '
+                                     'in the settings of Hazama')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+    files = [os.path.abspath(i) for i in args.files]  # CWD may be changed
+    from hazama import config  # the instance of Nikki is created there
+    if args.db:
+        path = args.db
+    else:  # same book as the GUI uses
+        config.changeCWD()
+        config.settings.read('config.ini', encoding='utf-8-sig')
+        path = config.settings['Main']['dbPath']
+    nikki = config.nikki
+    try:
+        nikki.connect(path, config.dbProfile())
+    except db.DatabaseLockedError:
+        print('diary book is opened by Hazama, close it first', file=sys.stderr)
+        return 1
+    except db.DatabaseError as e:
+        print('can not open diary book: %s' % e, file=sys.stderr)
+        return 1
+
+    try:
+        for path in files:
+            count = import_file(nikki, path, args.format)
+            print('%s: %d diaries imported' % (path, count))
+    except (OSError, ValueError) as e:
+        print('import failed: %s' % e, file=sys.stderr)
+        return 1
+    finally:
+        nikki.disconnect()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
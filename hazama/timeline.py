@@ -0,0 +1,51 @@
+"""Timeline of application startup, used to find out where cold start time goes.
+Modules call startup.mark(phase) at the end of each phase; marks are ignored
+unless main_entry began the timeline, so they cost nothing in tools and tests."""
+import json
+import logging
+from time import perf_counter
+
+
+class Timeline:
+    """Durations of named phases in order. Every mark ends the phase started by
+    the previous mark (or by begin)."""
+    def __init__(self):
+        self.phases = []  # [(name, seconds)]
+        self.path = None  # JSON file written by finish, None means not write
+        self._start = self._last = None
+        self._running = False
+
+    def begin(self):
+        self.phases = []
+        self._start = self._last = perf_counter()
+        self._running = True
+
+    def mark(self, name):
+        if not self._running: return
+        now = perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def total(self):
+        return 0 if self._start is None else self._last - self._start
+
+    def finish(self, name):
+        """Mark the last phase, then write the timeline to debug log and to JSON
+        file (if path set). Only the first call takes effect."""
+        if not self._running: return
+        self.mark(name)
+        self._running = False
+        for n, sec in self.phases:
+            logging.debug('startup: %-16s %7.1f ms', n, sec * 1000)
+        logging.debug('startup took %.2f sec', self.total())
+        if self.path is None: return
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump({'total': round(self.total(), 4),
+                           'phases': [{'name': n, 'sec': round(sec, 4)}
+                                      for n, sec in self.phases]}, f, indent=1)
+        except OSError as e:
+            logging.warning('failed to write startup timeline: %s', e)
+
+
+startup = Timeline()
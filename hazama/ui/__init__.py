@@ -8,6 +8,7 @@ from PySide.QtGui import QApplication, QIcon, QFont, QFontMetrics, QMessageBox
 from PySide.QtCore import QLocale, QTranslator, QLibraryInfo, QDateTime, QFile, QByteArray
 from hazama.config import (settings, appPath, isWin, isWin7OrLater,
                            isWinVistaOrLater, isWin8OrLater)
+from hazama.timeline import startup
 
 
 # qApp global var is None before entering event loop, use QApplication.instance() instead
@@ -96,6 +97,12 @@ def showErrors(type_, **extra_args):
          None,
          app.translate('Errors', 'Multiple access error'),
          app.translate('Errors', 'This diary book is already open.')),
+     'dbBusy': lambda hint='': QMessageBox.warning(
+         None,
+         app.translate('Errors', 'Failed to save diary'),
+         app.translate('Errors', 'SQLite3: %s.\n\nThe diary book is busy (exporting may be '
+                       'running). The diary is kept in editor, please save it again later.')
+         % hint),
      'cantFile': lambda info: QMessageBox.warning(
          None,
          app.translate('Errors', 'Failed to access file'),
@@ -269,9 +276,12 @@ def init():
     logging.debug('DPI scale ratio %s' % scaleRatio)
 
     setTranslationLocale()
+    startup.mark('qt init')
     global font
     font = Fonts()
     font.load()
+    startup.mark('fonts')
 
     setStyleSheet()
+    startup.mark('stylesheet')
     return app
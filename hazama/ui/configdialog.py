@@ -1,13 +1,14 @@
+import os
 import sys
 import logging
 from PySide.QtGui import *
 from PySide.QtCore import *
 from hazama import __version__, db
 from hazama.ui import (font, setStyleSheet, scaleRatio, fixWidgetSizeOnHiDpi, isDwmUsable,
-                       dbDatetimeFmtQt)
+                       dbDatetimeFmtQt, showErrors)
 from hazama.ui.configdialog_ui import Ui_configDialog
 from hazama.config import settings, nikki, isWin7OrLater, isWin
-from hazama import updater
+from hazama.ui.tasks import ExportTask, BackupTask
 
 
 languages = {'en': 'English', 'zh_CN': '简体中文', 'ja_JP': '日本語'}
@@ -72,6 +73,8 @@ class ConfigDialog(QDialog, Ui_configDialog):
     def __init__(self, parent):
         super().__init__(parent, Qt.WindowTitleHint)
         self._checkUpdateTask = self._installUpdateTask = None
+        self._exportTask = self._exportProgress = None
+        self._restoreTask = self._restoreProgress = None
         self._dlProgressBlocks = None
         self.setAttribute(Qt.WA_DeleteOnClose)
         self.setupUi(self)
@@ -81,6 +84,7 @@ class ConfigDialog(QDialog, Ui_configDialog):
         self.aboutBrowser.anchorClicked.connect(self._NavigateAboutArea)
         self.aboutBrowser.document().setDocumentMargin(0)
         self.aboutBrowser.document().setDefaultStyleSheet(aboutBrowserCss)
+        from hazama import updater
         if updater.foundUpdate:
             self._NavigateAboutArea(QUrl('hzm://show-update'))
         elif updater.checkUpdateTask:
@@ -147,7 +151,8 @@ class ConfigDialog(QDialog, Ui_configDialog):
         diaryCount = len(nikki)
         if diaryCount < 2:
             diaryDtRange = None
-        elif settings['Main']['listSortBy'] == 'datetime' and parent:
+        elif (settings['Main']['listSortBy'] == 'datetime' and parent and
+              not parent.nList.originModel.isLoading()):
             # only save 10 milliseconds (600 diaries)
             m = parent.findChild(QListView, 'nList').model()
             diaryDtRange = m.data(m.index(0, 1)), m.data(m.index(m.rowCount()-1, 1))
@@ -180,6 +185,15 @@ class ConfigDialog(QDialog, Ui_configDialog):
         if self._installUpdateTask:
             self._installUpdateTask.canceled = True
             self._installUpdateTask.disConn()
+        if self._exportTask and self._exportTask.isRunning():
+            self._exportTask.exporter.canceled = True
+            self._exportTask.disConn()
+            self._exportTask.wait()
+        if self._restoreTask and self._restoreTask.isRunning():
+            self._restoreTask.disConn()
+            self._restoreTask.wait()  # can't be canceled
+            self._reconnectDatabase()
+            self.bkRestored.emit()
 
     def reject(self):
         self.closeEvent(None)  # when Esc key pressed closeEvent will not be called
@@ -303,6 +317,7 @@ class ConfigDialog(QDialog, Ui_configDialog):
         self.aboutBrowser.setMinimumHeight(int(doc.size().height()))
 
     def _NavigateAboutArea(self, url):
+        from hazama import updater
         if url.isLocalFile() or url.scheme().startswith('http'):
             return QDesktopServices.openUrl(url)
 
@@ -383,27 +398,34 @@ class ConfigDialog(QDialog, Ui_configDialog):
 
     @Slot()
     def on_exportBtn_clicked(self):
+        if self._exportTask and self._exportTask.isRunning(): return
         export_all = self.exportOption.currentIndex() == 0
         nList = self.parent().nList
 
+        filters = [(self.tr('Plain Text (*.txt)'), 'txt'),
+                   (self.tr('JSON Lines (*.jsonl)'), 'jsonl'),
+                   (self.tr('Markdown (*.md)'), 'md'),
+                   (self.tr('HTML (*.html)'), 'html')]
         path, _type = QFileDialog.getSaveFileName(
             parent=self,
             caption=self.tr('Export Diary'),
-            filter=self.tr('Plain Text (*.txt)'))
+            filter=';;'.join(i[0] for i in filters))
         if path == '': return    # dialog cancelled
-        try:
-            nList.handleExport(path, export_all)
-        except Exception as e:
-            QMessageBox.warning(self, self.tr('Export Failed'), '%-20s' % e)
-            return
-
-        if not self.openOutBtn.isVisible():
-            self.openOutBtn.show()
-        else:  # two or more export happened
-            self.openOutBtn.clicked.disconnect()
-        self.openOutBtn.setFocus()
-        self.openOutBtn.clicked.connect(
-            lambda: QDesktopServices.openUrl('file:///' + path))
+        fmt = dict(filters).get(_type, 'txt')
+        if not os.path.splitext(path)[1]:
+            path += '.' + fmt
+
+        task = self._exportTask = ExportTask(path, fmt, None if export_all else nList.selectedIds())
+        task.progress.connect(self._onExportProgress)
+        task.succeeded.connect(self._onExportSucceeded)
+        task.failed.connect(self._onExportFailed)
+        task.finished.connect(self._onExportFinished)
+        progress = self._exportProgress = QProgressDialog(
+            self.tr('Exporting...'), qApp.translate('Dialog', 'Cancel'), 0, 0, self)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(500)
+        progress.canceled.connect(self._cancelExport)
+        task.start()
 
     @Slot(str)
     def on_rstCombo_activated(self, filename):
@@ -418,21 +440,103 @@ class ConfigDialog(QDialog, Ui_configDialog):
         msg.deleteLater()
 
         if msg.clickedButton() == okBtn:
-            db.restore_backup(filename)
-            self.close()
-            self.bkRestored.emit()
+            if not self._releaseDatabase():
+                self.rstCombo.setCurrentIndex(0)
+                return
+            task = self._restoreTask = BackupTask(restore=filename)
+            task.progress.connect(self._onRestoreProgress)
+            task.succeeded.connect(self._onRestoreSucceeded)
+            task.failed.connect(self._onRestoreFailed)
+            progress = self._restoreProgress = QProgressDialog(
+                self.tr('Restoring...'), None, 0, 0, self)
+            progress.setWindowModality(Qt.WindowModal)
+            progress.setMinimumDuration(500)
+            task.start()
         else:
             self.rstCombo.setCurrentIndex(0)
 
+    def _releaseDatabase(self):
+        """Stop everything that reads or writes the database file, which is going
+        to be replaced, then disconnect. Return False if editors are open (they
+        save drafts and diaries), user should close them first."""
+        mainWindow = self.parent()
+        if mainWindow.nList.editors:
+            QMessageBox.information(self, self.tr('Restore backup'),
+                                    self.tr('Please close all editors before restoring.'))
+            return False
+        try:
+            mainWindow.heatMap.close()  # it queries statistics of days when painting
+        except (AttributeError, RuntimeError):
+            pass
+        # loading canceled and lazy fetching of text stopped; it's loaded again
+        # whether restoring succeeded (bkRestored) or not
+        mainWindow.nList.originModel.clear()
+        nikki.disconnect()
+        return True
+
+    def _reconnectDatabase(self):
+        try:
+            nikki.connect(nikki.getpath())  # schema may be older
+        except db.DatabaseError as e:
+            showErrors('dbError', hint=str(e))
+            sys.exit(-1)
+
+    def _onRestoreProgress(self, copied, total):
+        self._restoreProgress.setMaximum(total)
+        self._restoreProgress.setValue(copied)
+
+    def _onRestoreSucceeded(self):
+        self._restoreTask.wait()  # about to exit, closeEvent shouldn't see it running
+        self._restoreProgress.deleteLater()
+        self._reconnectDatabase()
+        self.close()
+        self.bkRestored.emit()
+
+    def _onRestoreFailed(self, msg):
+        self._restoreTask.wait()
+        self._restoreProgress.deleteLater()
+        self._reconnectDatabase()
+        self.parent().nList.reload()
+        self.rstCombo.setCurrentIndex(0)
+        QMessageBox.warning(self, self.tr('Restore Failed'), '%-20s' % msg)
+
+    def _onExportProgress(self, exported, total):
+        self._exportProgress.setMaximum(total)
+        self._exportProgress.setValue(exported)
+
+    def _onExportSucceeded(self):
+        path = self._exportTask.exporter.path
+        if not self.openOutBtn.isVisible():
+            self.openOutBtn.show()
+        else:  # two or more export happened
+            self.openOutBtn.clicked.disconnect()
+        self.openOutBtn.setFocus()
+        self.openOutBtn.clicked.connect(
+            lambda: QDesktopServices.openUrl('file:///' + path))
+
+    def _onExportFailed(self, msg):
+        self._exportProgress.reset()
+        QMessageBox.warning(self, self.tr('Export Failed'), '%-20s' % msg)
+
+    def _onExportFinished(self):
+        # task itself is kept until next exporting, it's the sender of this slot
+        self._exportProgress.deleteLater()
+        self._exportProgress = None
+
+    def _cancelExport(self):
+        self._exportTask.exporter.canceled = True
+
     def _onCheckUpdateSucceeded(self):
         self._NavigateAboutArea(QUrl('hzm://show-update'))
 
     def _onInstallUpdateSucceeded(self):
+        from hazama import updater
         self._setAboutArea(self.tr('Succeeded (Restart needed for update to take effect)'))
         updater.foundUpdate = None
         self.parent().setUpdateHint(False)
 
     def _onInstallUpdateProgress(self, received, total):
+        from hazama import updater
         self._setAboutArea(updater.textProgressBar(
             received, total, barLen=self._dlProgressBlocks), False)
 
@@ -1,5 +1,35 @@
+from collections import OrderedDict
 from PySide.QtCore import *
 from PySide.QtGui import *
+from hazama.db import unpack_formats
+
+
+class LRUCache:
+    """Mapping with limited size, least recently used items are dropped first."""
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._d = OrderedDict()
+
+    def __contains__(self, key): return key in self._d
+
+    def __len__(self): return len(self._d)
+
+    def get(self, key, default=None):
+        try:
+            self._d.move_to_end(key)
+        except KeyError:
+            return default
+        return self._d[key]
+
+    def put(self, key, value):
+        self._d[key] = value
+        self._d.move_to_end(key)
+        if len(self._d) > self.maxSize:
+            self._d.popitem(last=False)
+
+    def pop(self, key, default=None): return self._d.pop(key, default)
+
+    def clear(self): self._d.clear()
 
 
 class TagCompleter(QCompleter):
@@ -85,12 +115,14 @@ class TextFormatter:
 
 class NTextDocument(QTextDocument, TextFormatter):
     """QTextDocument with format setting function. Formats are three-tuple
-    (startIndex, length, type), the same form in database."""
+    (startIndex, length, type), or bytes packed by db.pack_formats."""
     _type2method = [None, TextFormatter.setBD, TextFormatter.setHL, TextFormatter.setIta,
                     TextFormatter.setSO, TextFormatter.setUL]  # associated array
 
     def setText(self, text, formats=None):
         self.setPlainText(text)
+        if isinstance(formats, bytes):
+            formats = unpack_formats(formats)
         if formats:
             cur = self._cur = QTextCursor(self)
             for start, length, type_ in formats:
@@ -165,9 +197,10 @@ class NSplitter(QSplitter):
 
 class MultiSortFilterProxyModel(QSortFilterProxyModel):
     """Multi-filter ProxyModel, every filter may associated with multiple columns,
-    if any of columns match then it will pass that filter."""
+    if any of columns match then it will pass that filter. A filter can also
+    accept rows by a set of ids, the first column of source model must be id."""
     class Filter:
-        cols = regExp = None
+        cols = regExp = ids = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -183,7 +216,10 @@ class MultiSortFilterProxyModel(QSortFilterProxyModel):
             return False
 
         for f in self._filters:
-            if not checkOneFilter(f):
+            if f.ids is not None:
+                if model.data(model.index(sourceRow, 0)) not in f.ids:
+                    return False
+            elif not checkOneFilter(f):
                 return False
         return True
 
@@ -197,6 +233,19 @@ class MultiSortFilterProxyModel(QSortFilterProxyModel):
         """Return the filter's pattern specified by filter id"""
         return self._filters[id].regExp.pattern()
 
+    def setFilterIds(self, id, ids, copy=True):
+        """Let the filter specified by filter id accept rows whose id in ids
+        instead of matching pattern. Pass None to use pattern again. If copy is
+        False, ids (anything supports `in`) is kept as it is, so that its owner
+        can update it later (changed rows are filtered again on dataChanged)."""
+        self._filters[id].ids = None if ids is None else set(ids) if copy else ids
+        self.invalidateFilter()
+
+    def isFilterEnabled(self, id):
+        """Return True if the filter specified by filter id may reject rows"""
+        f = self._filters[id]
+        return f.ids is not None or bool(f.regExp.pattern())
+
     def addFilter(self, cols, patternSyntax=QRegExp.FixedString, cs=None):
         """Add new filter into proxy model.
         :param cols: a list contains columns to be filtered
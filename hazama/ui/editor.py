@@ -10,8 +10,12 @@ from hazama.config import settings, nikki
 
 class Editor(QWidget, Ui_editor):
     """The widget that used to edit diary's body, title, tag and datetime.
+    Unsaved changes are written to draft after user stops typing for a while, or
+    periodically if user keeps typing; only changed fields are written.
     Signal closed: (id of nikki, needSave)
     """
+    DRAFT_DELAY = 1500  # ms, since the last edit
+    DRAFT_MAX_DELAY = 5000  # ms, since the first edit not written
     closed = Signal(int, bool)
 
     def __init__(self, nikkiDict, parent=None):
@@ -49,7 +53,16 @@ class Editor(QWidget, Ui_editor):
         self.nextSc = QShortcut(QKeySequence('Ctrl+Tab'), self)
         self.quickNextSc = QShortcut(QKeySequence('Right'), self)
 
+        # setup draft autosave
+        self._draft = {}  # fields last written to draft
+        self._draftTimer = QTimer(self)
+        self._draftTimer.setSingleShot(True)
+        self._draftTimer.timeout.connect(self.saveDraft)
+        self._dirtyTimer = QElapsedTimer()  # started by the first edit not written
+
         self.fromNikkiDict(nikkiDict)
+        self.textEditor.textChanged.connect(self._onEdited)
+        self.titleEditor.textEdited.connect(self._onEdited)
 
     def showEvent(self, event):
         if settings['Editor'].getboolean('titleFocus'):
@@ -62,6 +75,7 @@ class Editor(QWidget, Ui_editor):
     def closeEvent(self, event):
         """Normal close will save diary. For cancel operation, call closeNoSave."""
         settings['Editor']['windowGeo'] = saveWidgetGeo(self)
+        self._draftTimer.stop()
         self.closed.emit(self.id, self.needSave() if self._saveOnClose else False)
         event.accept()
 
@@ -85,6 +99,25 @@ class Editor(QWidget, Ui_editor):
                 self.titleEditor.isModified() or self.timeModified or
                 self.tagModified)
 
+    def setModified(self):
+        """Make needSave return True, used when editor opened from draft."""
+        self.textEditor.document().setModified(True)
+        self.timeModified = self.tagModified = True
+
+    def saveDraft(self):
+        """Write fields changed since last writing to draft."""
+        self._draftTimer.stop()
+        self._dirtyTimer.invalidate()
+        if not self.needSave(): return
+        text, formats = self.textEditor.getRichText()
+        current = dict(datetime=self.datetime, title=self.titleEditor.text(),
+                       tags=self.tagEditor.text(), text=text, formats=formats)
+        changed = {k: v for k, v in current.items()
+                   if k not in self._draft or self._draft[k] != v}
+        if changed:
+            nikki.savedraft(self.id, **changed)
+            self._draft.update(changed)
+
     def setReadOnly(self, readOnly):
         for i in [self.titleEditor, self.textEditor, self.tagEditor]:
             i.setReadOnly(readOnly)
@@ -110,7 +143,7 @@ class Editor(QWidget, Ui_editor):
         self.textEditor.setRichText(dic.get('text', ''), dic.get('formats'))
         # if title is empty, use datetime instead. if no datetime (new), use "New Diary"
         t = (dic.get('title') or
-             (datetimeTrans(self.datetime, stripTime=True) if 'datetime' in dic else None) or
+             (datetimeTrans(self.datetime, stripTime=True) if self.datetime else None) or
              self.tr('New Diary'))
         self.setWindowTitle("%s - Hazama" % t)
 
@@ -118,6 +151,10 @@ class Editor(QWidget, Ui_editor):
                     self.datetime is not None and
                     datetimeToQt(self.datetime).daysTo(QDateTime.currentDateTime()) > 3)
         self.setReadOnly(readOnly)
+        # editor may be reused for another diary, whose draft is not written yet
+        self._draft = {}
+        self._draftTimer.stop()
+        self._dirtyTimer.invalidate()
 
     def toNikkiDict(self):
         text, formats = self.textEditor.getRichText()
@@ -125,10 +162,19 @@ class Editor(QWidget, Ui_editor):
                     text=text, formats=formats, title=self.titleEditor.text(),
                     tags=self.tagEditor.text())
 
+    def _onEdited(self):
+        # coalesce rapid edits, but don't delay writing forever
+        if not self._dirtyTimer.isValid():
+            self._dirtyTimer.start()
+        elif self._dirtyTimer.elapsed() >= self.DRAFT_MAX_DELAY:
+            return self.saveDraft()
+        self._draftTimer.start(self.DRAFT_DELAY)
+
     @Slot()
     def on_tagEditor_textEdited(self):
         # tagEditor.isModified() will be reset by completer. So this instead.
         self.tagModified = True
+        self._onEdited()
 
     @Slot()
     def on_dtBtn_clicked(self):
@@ -142,3 +188,4 @@ class Editor(QWidget, Ui_editor):
                 self.datetime = newDtStr
                 self.dtBtn.setText(datetimeTrans(newDtStr))
                 self.timeModified = True
+                self._onEdited()
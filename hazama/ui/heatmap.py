@@ -1,7 +1,9 @@
 from PySide.QtGui import *
 from PySide.QtCore import *
+from array import array
 from itertools import chain
 from hazama.ui import scaleRatio, makeQIcon
+from hazama.ui.customobjects import LRUCache
 
 # the default colors that represent heat of data, from cold to hot
 defCellColors = (QColor(255, 255, 255), QColor(255, 243, 208),
@@ -9,6 +11,8 @@ defCellColors = (QColor(255, 255, 255), QColor(255, 243, 208),
 
 
 class HeatMap(QWidget):
+    """Heat map with a bar to switch periods. Click a cell to zoom in (decade to
+    year to month), press Backspace or right click to zoom out."""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         layout = QVBoxLayout(self)
@@ -20,7 +24,8 @@ class HeatMap(QWidget):
         barLayout.setSpacing(3)
         # setup buttons and menu
         self.view = HeatMapView(self, font=self.font(), objectName='heatMapView')
-        self.yearBtn = QPushButton(str(self.view.year), self,
+        self.view.cellClicked.connect(self.zoomIn)
+        self.yearBtn = QPushButton(self._periodText(), self,
                                    objectName='heatMapBtn')
         self.yearBtn.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Maximum)
         self.yearBtn.setFocusPolicy(Qt.TabFocus)
@@ -54,6 +59,7 @@ class HeatMap(QWidget):
         self.nextSc = QShortcut(QKeySequence(Qt.Key_Right), self, self.yearNext)
         self.pre5Sc = QShortcut(QKeySequence(Qt.Key_Up), self, self.yearPre5)
         self.next5Sc = QShortcut(QKeySequence(Qt.Key_Down), self, self.yearNext5)
+        self.zoomOutSc = QShortcut(QKeySequence(Qt.Key_Backspace), self, self.zoomOut)
 
     def setupYearMenu(self):
         group, menu, curtYear = self._yearActGroup, self.yearMenu, self.view.year
@@ -68,30 +74,69 @@ class HeatMap(QWidget):
         for y in chain(range(curtYear+1, curtYear+5), [curtYear+7, curtYear+10]):
             menu.addAction(QAction(str(y), group, triggered=self.yearMenuAct))
 
-    def setColorFunc(self, f):
-        """Set function that determine each cell's background color.
-        This function will be called with args: year, month, day, cellColors.
-        cellColors is something like defCellColors."""
-        self.view.cellColorFunc = f
+    def setLevelFunc(self, f):
+        """Set function that determine each cell's background color. It will be
+        called with args: year, month, day, and returns index of cell colors
+        (0 to 3, from cold to hot)."""
+        self.view.setLevelFunc(f)
+
+    def setToolTipFunc(self, f):
+        """Set function that returns tooltip of a cell, called with args: year,
+        month, day."""
+        self.view.toolTipFunc = f
+
+    def _periodText(self):
+        v = self.view
+        if v.zoom == v.Decade:
+            return '%d - %d' % (v.year // 10 * 10, v.year // 10 * 10 + 9)
+        elif v.zoom == v.Year:
+            return str(v.year)
+        return QLocale().toString(QDate(v.year, v.month, 1), 'MMM yyyy')
+
+    def _periodChanged(self):
+        self.yearBtn.setText(self._periodText())
+        self.setupYearMenu()
 
     def _moveYear(self, offset):
         self.view.year += offset
-        self.yearBtn.setText(str(self.view.year))
-        self.setupYearMenu()
+        self._periodChanged()
+
+    def _step(self, step):
+        """Move to previous or next period of current zoom level."""
+        v = self.view
+        if v.zoom == v.Month:
+            y, m = divmod(v.year * 12 + v.month - 1 + step, 12)
+            v.year, v.month = y, m + 1
+            self._periodChanged()
+        else:
+            self._moveYear(step * (10 if v.zoom == v.Decade else 1))
 
-    def yearPre(self): self._moveYear(-1)
+    def yearPre(self): self._step(-1)
 
-    def yearNext(self): self._moveYear(1)
+    def yearNext(self): self._step(1)
 
     def yearPre5(self): self._moveYear(-5)
 
     def yearNext5(self): self._moveYear(5)
 
     def yearMenuAct(self):
-        yearStr = self.sender().text()
-        self.view.year = int(yearStr)
-        self.yearBtn.setText(yearStr)
-        self.setupYearMenu()
+        self.view.year = int(self.sender().text())
+        self._periodChanged()
+
+    def zoomIn(self, year, month):
+        v = self.view
+        if v.zoom == v.Month: return
+        v.year, v.month = year, month
+        v.zoom += 1
+        self._periodChanged()
+
+    def zoomOut(self):
+        if self.view.zoom == self.view.Decade: return
+        self.view.zoom -= 1
+        self._periodChanged()
+
+    def contextMenuEvent(self, event):
+        self.zoomOut()
 
     def yearBtnAct(self):
         """Popup menu manually to avoid indicator in YearButton"""
@@ -100,72 +145,213 @@ class HeatMap(QWidget):
 
     def showEvent(self, event):
         # must call setupMap after style polished
-        self.view.setupMap()
         cs = tuple(getattr(self.view, 'cellColor%d' % i) for i in range(4))
         self.sample.setColors(cs)
         self.sample.setupMap()
         event.accept()
 
 
-class HeatMapView(QGraphicsView):
-    cellColorFunc = lambda *args: Qt.white  # dummy
+class HeatMapView(QWidget):
+    """Heat map painted directly, in one of three zoom levels: a decade (a row
+    of months per year), a year (days in 12 months) or a month. Levels (index of
+    cell colors) of all cells in a period are computed once into an array, and
+    the painted map is cached as a pixmap per (zoom, period, size, colors), so
+    switching periods or zoom levels is cheap. Call invalidate after data
+    changed."""
     cellLen = 9
     cellSpacing = 2
     monthSpacingX = 14
     monthSpacingY = 20
-    nameFontPx = 9  # month name
+    nameFontPx = 9  # month name and year
+    numberFontPx = 5  # day number in month zoom
+    # zoom levels
+    Decade, Year, Month = range(3)
+    # special levels in array of levels
+    NoDay, Future = -1, -2
+    cellClicked = Signal(int, int)  # year, month
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.yearVal = QDate.currentDate().year()
-        self.cellBorderColorVal = Qt.lightGray
+        today = QDate.currentDate()
+        self.yearVal, self.monthVal, self.zoomVal = today.year(), today.month(), self.Year
+        self.cellBorderColorVal = QColor(Qt.lightGray)
         for idx, c in enumerate(defCellColors):
             setattr(self, '_cellColor%d' % idx, c)
+        self.levelFunc = lambda y, m, d: 0  # dummy
+        self.toolTipFunc = None
+        self._levels = {}  # (zoom, period) => array of levels, see _cellKey
+        self._pixmaps = LRUCache(8)  # (zoom, period, width, height, colors) => QPixmap
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
-        self.scene = QGraphicsScene(self)
         f = self.font()
         f.setPixelSize(self.nameFontPx)
         self.nameH = QFontMetrics(f).height()
+        self.labelW = QFontMetrics(f).width('0000') + self.monthSpacingX // 2
         self.setFont(f)
         # short names, for convenience
         self._cd = cellDis = self.cellLen + self.cellSpacing
         self._mdx = monthDisX = cellDis * 6 + self.cellLen + self.monthSpacingX
         self._mdy = monthDisY = cellDis * 4 + self.cellLen + self.monthSpacingY
-        self.scene.setSceneRect(0, 0, monthDisX*3-self.monthSpacingX,
-                                monthDisY*4-self.monthSpacingY+self.nameH)
-        self.setScene(self.scene)
-
-    def setupMap(self):
-        locale, date, font, nameH = QLocale(), QDate(), self.font(), self.nameH
-        cellDis, monthDisX, monthDisY = self._cd, self._mdx, self._mdy
-        cellColors = tuple(getattr(self, 'cellColor%d' % i) for i in range(4))
-        for m in range(12):
-            date.setDate(self.year, m+1, 1)
-            # cells. 7 days per row, index of row: (d//7)
-            monthItems = [QGraphicsRectItem(cellDis*d-(d//7)*cellDis*7, cellDis*(d//7),
-                                            self.cellLen, self.cellLen)
-                          for d in range(date.daysInMonth())]
-            for (d, item) in enumerate(monthItems, 1):
-                date.setDate(self.year, m+1, d)
-                if date <= QDate.currentDate():
-                    item.setPen(QPen(self.cellBorderColor))
-                    item.setBrush(self.cellColorFunc(self.year, m+1, d, cellColors))
-                else:
-                    p = QPen(Qt.gray)
-                    p.setStyle(Qt.DotLine)
-                    item.setPen(p)
-            monthGroup = self.scene.createItemGroup(monthItems)
-            # 3 months per line
-            x, y = monthDisX*m-(m//3)*monthDisX*3, monthDisY*(m//3)
-            monthGroup.setPos(x, y+nameH)
-            # month name
-            monthText = self.scene.addSimpleText(locale.toString(date, 'MMM'), font)
-            monthText.setPen(self.palette().color(QPalette.WindowText))
-            nameW = monthText.boundingRect().width()
-            monthText.setPos(x+(monthDisX-self.monthSpacingX-nameW)/2, y)
-
-    def resizeEvent(self, event):
-        self.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
+        self._mapSizes = {
+            self.Decade: QSizeF(self.labelW + cellDis*12 - self.cellSpacing,
+                                cellDis*10 - self.cellSpacing),
+            self.Year: QSizeF(monthDisX*3 - self.monthSpacingX,
+                              monthDisY*4 - self.monthSpacingY + self.nameH),
+            self.Month: QSizeF(cellDis*7 - self.cellSpacing, cellDis*5 - self.cellSpacing)}
+        # rects of cells in map coordinates, the same for every period
+        self._rects = {zoom: [self._cellRect(zoom, i) for i in range(n)]
+                       for zoom, n in [(self.Decade, 120), (self.Year, 372), (self.Month, 31)]}
+
+    def setLevelFunc(self, f):
+        """f is called with (year, month, day), returns index of cell colors.
+        day is None for a cell of month in decade zoom."""
+        self.levelFunc = f
+        self.invalidate()
+
+    def invalidate(self, *__):
+        """Drop cached levels and pixmaps, used after data changed."""
+        self._levels.clear()
+        self._pixmaps.clear()
+        self.update()
+
+    def _period(self):
+        if self.zoom == self.Decade: return self.year // 10 * 10
+        return self.year if self.zoom == self.Year else (self.year, self.month)
+
+    def _cellKey(self, zoom, i):
+        """Return (year, month, day) of the i-th cell in current period, day is
+        None for months. Decade: 10 years x 12 months; year: 12 months x 31
+        days; month: 31 days."""
+        if zoom == self.Decade:
+            return self.year // 10 * 10 + i // 12, i % 12 + 1, None
+        elif zoom == self.Year:
+            return self.year, i // 31 + 1, i % 31 + 1
+        return self.year, self.month, i + 1
+
+    def _cellRect(self, zoom, i):
+        """Return rect of the i-th cell in map coordinates."""
+        cellDis = self._cd
+        if zoom == self.Decade:  # labels of year on the left
+            x, y = self.labelW + cellDis * (i % 12), cellDis * (i // 12)
+        elif zoom == self.Year:  # 7 days per row in a month, 3 months per line
+            m, d = divmod(i, 31)
+            x = self._mdx * (m % 3) + cellDis * (d % 7)
+            y = self._mdy * (m // 3) + self.nameH + cellDis * (d // 7)
+        else:
+            x, y = cellDis * (i % 7), cellDis * (i // 7)
+        return QRectF(x, y, self.cellLen, self.cellLen)
+
+    def _getLevels(self):
+        key = (self.zoom, self._period())
+        levels = self._levels.get(key)
+        if levels is None:
+            rects = self._rects[self.zoom]
+            levels = self._levels[key] = array('b', [self.NoDay]) * len(rects)
+            today, date = QDate.currentDate(), QDate()
+            for i in range(len(rects)):
+                y, m, d = self._cellKey(self.zoom, i)
+                date.setDate(y, m, 1)
+                if d is not None and d > date.daysInMonth(): continue
+                if d is not None: date.setDate(y, m, d)
+                levels[i] = self.Future if date > today else self.levelFunc(y, m, d)
+        return levels
+
+    def _transform(self):
+        """Return (scale, offset) that fit the map in the widget keeping aspect."""
+        mapSize, rect = self._mapSizes[self.zoom], self.contentsRect()
+        scale = min(rect.width() / mapSize.width(), rect.height() / mapSize.height())
+        offset = QPointF(rect.x() + (rect.width() - mapSize.width() * scale) / 2,
+                         rect.y() + (rect.height() - mapSize.height() * scale) / 2)
+        return scale, offset
+
+    def cellAt(self, pos):
+        """Return (year, month, day) of the cell under pos (widget coordinates),
+        None if no cell there."""
+        scale, offset = self._transform()
+        if scale <= 0: return None
+        p = (QPointF(pos) - offset) / scale
+        levels = self._getLevels()
+        for i, rect in enumerate(self._rects[self.zoom]):
+            if rect.contains(p) and levels[i] != self.NoDay:
+                return self._cellKey(self.zoom, i)
+        return None
+
+    def _paintMap(self, painter):
+        levels = self._getLevels()
+        colors = [getattr(self, 'cellColor%d' % i) for i in range(4)]
+        byLevel = {}  # level => list of rects, drawn in one call
+        for rect, level in zip(self._rects[self.zoom], levels):
+            if level != self.NoDay:
+                byLevel.setdefault(level, []).append(rect)
+        for level, rects in byLevel.items():
+            if level == self.Future:
+                pen = QPen(Qt.gray)
+                pen.setStyle(Qt.DotLine)
+                painter.setPen(pen)
+                painter.setBrush(Qt.NoBrush)
+            else:
+                painter.setPen(self.cellBorderColor)
+                painter.setBrush(colors[level])
+            painter.drawRects(rects)
+        # labels
+        painter.setPen(self.palette().color(QPalette.WindowText))
+        fm = painter.fontMetrics()
+        if self.zoom == self.Decade:
+            for row in range(10):
+                rect = QRectF(0, self._cd * row, self.labelW, self.cellLen)
+                painter.drawText(rect, Qt.AlignLeft | Qt.AlignVCenter,
+                                 str(self.year // 10 * 10 + row))
+        elif self.zoom == self.Year:
+            locale, date = QLocale(), QDate()
+            for m in range(12):
+                date.setDate(self.year, m+1, 1)
+                name = locale.toString(date, 'MMM')
+                x = self._mdx * (m % 3) + (self._mdx - self.monthSpacingX - fm.width(name)) / 2
+                painter.drawText(QPointF(x, self._mdy * (m // 3) + fm.ascent()), name)
+        else:
+            f = painter.font()
+            f.setPixelSize(self.numberFontPx)
+            painter.setFont(f)
+            for i, (rect, level) in enumerate(zip(self._rects[self.zoom], levels)):
+                if level != self.NoDay:
+                    painter.drawText(rect, Qt.AlignCenter, str(i + 1))
+
+    def paintEvent(self, event):
+        colors = tuple(getattr(self, 'cellColor%d' % i).rgba() for i in range(4)) + (
+            self.cellBorderColor.rgba(), self.palette().color(QPalette.WindowText).rgba())
+        key = (self.zoom, self._period(), self.width(), self.height(), colors)
+        pixmap = self._pixmaps.get(key)
+        if pixmap is None:
+            pixmap = QPixmap(self.size())
+            pixmap.fill(Qt.transparent)
+            painter = QPainter(pixmap)
+            painter.setFont(self.font())
+            scale, offset = self._transform()
+            painter.translate(offset)
+            painter.scale(scale, scale)
+            self._paintMap(painter)
+            painter.end()
+            self._pixmaps.put(key, pixmap)
+        painter = QPainter(self)
+        painter.drawPixmap(0, 0, pixmap)
+        painter.end()
+
+    def event(self, event):
+        if event.type() == QEvent.ToolTip:
+            cell = self.cellAt(event.pos())
+            if cell and self.toolTipFunc:
+                QToolTip.showText(event.globalPos(), self.toolTipFunc(*cell), self)
+            else:
+                QToolTip.hideText()
+                event.ignore()
+            return True
+        return super().event(event)
+
+    def mouseReleaseEvent(self, event):
+        cell = self.cellAt(event.pos()) if event.button() == Qt.LeftButton else None
+        if cell:
+            self.cellClicked.emit(cell[0], cell[1])
+        super().mouseReleaseEvent(event)
 
     def setCellBorderColor(self, color):
         self.cellBorderColorVal = color
@@ -178,8 +364,21 @@ class HeatMapView(QGraphicsView):
 
     def setYear(self, year):
         self.yearVal = year
-        self.scene.clear()
-        self.setupMap()
+        self.update()
+
+    def getMonth(self):
+        return self.monthVal
+
+    def setMonth(self, month):
+        self.monthVal = month
+        self.update()
+
+    def getZoom(self):
+        return self.zoomVal
+
+    def setZoom(self, zoom):
+        self.zoomVal = zoom
+        self.update()
 
     def getCellColor0(self): return self._cellColor0
 
@@ -198,6 +397,8 @@ class HeatMapView(QGraphicsView):
     def setCellColor3(self, c): self._cellColor3 = c
 
     year = property(getYear, setYear)
+    month = property(getMonth, setMonth)
+    zoom = property(getZoom, setZoom)
     cellBorderColor = Property(QColor, getCellBorderColor, setCellBorderColor)
     cellColor0 = Property(QColor, getCellColor0, setCellColor0)
     cellColor1 = Property(QColor, getCellColor1, setCellColor1)
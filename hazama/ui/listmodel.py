@@ -1,78 +1,447 @@
+import logging
+from array import array
 from PySide.QtCore import *
 from PySide.QtGui import *
+from hazama.ui.customobjects import LRUCache
+from hazama.db import pack_formats, unpack_formats
 from hazama.config import nikki, settings
+from hazama.timeline import startup
+
+
+def makePreview(text, formats, lines, lineChars):
+    """Cut text to the part that can be displayed in given lines, and clip formats
+    accordingly. Each paragraph takes at least one line, and one line holds at most
+    lineChars characters. formats can be packed. Return (text, formats)."""
+    segments = []  # (start, end) of kept part of paragraphs
+    start = 0
+    for para in text.split('\n'):
+        if lines <= 0: break
+        segments.append((start, start + min(len(para), lines * lineChars)))
+        lines -= max(1, -(-len(para) // lineChars))  # ceil
+        start += len(para) + 1
+    preview = '\n'.join(text[a:b] for a, b in segments)
+    if len(preview) == len(text):
+        return text, formats  # nothing cut
+
+    if isinstance(formats, bytes):
+        formats = unpack_formats(formats)
+    outFormats = []
+    for fStart, fLength, fType in formats or []:
+        fEnd, offset = fStart + fLength, 0
+        for segStart, segEnd in segments:
+            a, b = max(fStart, segStart), min(fEnd, segEnd)
+            if a < b:
+                outFormats.append((a - segStart + offset, b - a, fType))
+            offset += segEnd - segStart + 1
+    return preview, outFormats
+
+
+class DayStatsCache:
+    """Count of diaries and total length of text of every day, loaded from
+    database (table DayStats) a year at a time and cached. Sums of months are
+    cached along with days. Cached years are kept up to date by add and remove,
+    which are called by NikkiModel."""
+    def __init__(self):
+        self._years = {}  # year => {(month, day): [count, length]}
+        self._months = {}  # year => {month: [count, length]}
+
+    def year(self, year):
+        """Return dict that maps (month, day) to [count, length] of the year."""
+        stats = self._years.get(year)
+        if stats is None:
+            stats = self._years[year] = {k: list(v)
+                                         for k, v in nikki.getdaystats(year).items()}
+            months = self._months[year] = {}
+            for (m, __), (count, length) in stats.items():
+                month = months.setdefault(m, [0, 0])
+                month[0] += count
+                month[1] += length
+        return stats
+
+    def get(self, year, month=None, day=None):
+        """Return (count, length) of the day, or the month if day is None, or
+        the year if month is None."""
+        stats = self.year(year)
+        if day is not None:
+            return tuple(stats.get((month, day), (0, 0)))
+        months = self._months[year]
+        if month is not None:
+            return tuple(months.get(month, (0, 0)))
+        return (sum(i[0] for i in months.values()), sum(i[1] for i in months.values()))
+
+    def add(self, datetime, length, sign=1):
+        """Count a diary in (or out if sign is -1) its day, only if its year
+        is cached."""
+        if not datetime: return
+        y, m = int(datetime[:4]), int(datetime[5:7])
+        stats = self._years.get(y)
+        if stats is None: return  # will be loaded with the change
+        for i in (stats.setdefault((m, int(datetime[8:10])), [0, 0]),
+                  self._months[y].setdefault(m, [0, 0])):
+            i[0] += sign
+            i[1] += sign * length
+
+    def remove(self, datetime, length):
+        self.add(datetime, length, -1)
+
+    def clear(self):
+        self._years.clear()
+        self._months.clear()
+
+
+class TaggedIds:
+    """Container of ids of diaries that have all (or any) of several tags, made
+    from sets in the tag index of NikkiModel. It only supports `in`."""
+    def __init__(self, sets, matchAll=True):
+        self._sets, self._matchAll = sets, matchAll
+
+    def __contains__(self, id_):
+        if self._matchAll:
+            return all(id_ in s for s in self._sets)
+        return any(id_ in s for s in self._sets)
+
+
+NULL = -1 << 63  # None in integer columns of NikkiRows
+
+
+def _encodeInt(v):
+    return NULL if v is None else v
+
+
+def _decodeInt(v):
+    return None if v == NULL else v
+
+
+class NikkiRows:
+    """Rows of NikkiModel stored by columns, to avoid per-row Python objects:
+    id and length are in integer arrays; datetime in format yyyy-MM-dd HH:mm is
+    encoded as integer yyyyMMddHHmm (others are kept in a list and referenced by
+    negative numbers); tags are ids of a table of distinct tag strings, which is
+    shared by rows. Only title, text and formats are objects of their own.
+
+    Values are the same as NikkiModel's columns, None is allowed everywhere."""
+    def __init__(self):
+        self.ids = array('q')
+        self._datetimes = array('q')
+        self._texts = []
+        self._titles = []
+        self._tags = array('I')
+        self._formats = []
+        self._lengths = array('q')
+        self._cols = [self.ids, self._datetimes, self._texts, self._titles, self._tags,
+                      self._formats, self._lengths]
+        self._encoders = [_encodeInt, self._encodeDatetime, None, None, self._encodeTags,
+                          None, _encodeInt]
+        self._decoders = [_decodeInt, self._decodeDatetime, None, None, self._decodeTags,
+                          None, _decodeInt]
+        self._resetTables()
+
+    def __len__(self): return len(self.ids)
+
+    def _resetTables(self):
+        self._tagStrs = [None]  # tag strings indexed by id
+        self._tagIds = {None: 0}  # tag string => id
+        self._oddDatetimes = []  # datetime not in the usual format
+
+    def _encodeTags(self, tags):
+        i = self._tagIds.get(tags)
+        if i is None:
+            i = self._tagIds[tags] = len(self._tagStrs)
+            self._tagStrs.append(tags)
+        return i
+
+    def _decodeTags(self, i):
+        return self._tagStrs[i]
+
+    def _encodeDatetime(self, dt):
+        if dt is None: return NULL
+        try:
+            v = int(dt[:4] + dt[5:7] + dt[8:10] + dt[11:13] + dt[14:])
+            if v >= 0 and self._decodeDatetime(v) == dt: return v
+        except ValueError:
+            pass
+        self._oddDatetimes.append(dt)
+        return -len(self._oddDatetimes)
+
+    def _decodeDatetime(self, v):
+        if v >= 0:
+            return '%04d-%02d-%02d %02d:%02d' % (v // 100000000, v // 1000000 % 100,
+                                                 v // 10000 % 100, v // 100 % 100, v % 100)
+        return None if v == NULL else self._oddDatetimes[-v - 1]
+
+    def get(self, row, col):
+        v = self._cols[col][row]
+        decode = self._decoders[col]
+        return decode(v) if decode else v
+
+    def row(self, row):
+        """Return values of the row as a list."""
+        return [self.get(row, c) for c in range(7)]
+
+    def set(self, row, col, value):
+        encode = self._encoders[col]
+        self._cols[col][row] = encode(value) if encode else value
+
+    def setRow(self, row, values):
+        for c, v in enumerate(values):
+            self.set(row, c, v)
+
+    def extend(self, rows):
+        """Append rows, which is a list of sequences of values."""
+        for c, (col, encode) in enumerate(zip(self._cols, self._encoders)):
+            if encode:
+                col.extend(encode(r[c]) for r in rows)
+            else:
+                col.extend(r[c] for r in rows)
+
+    def insertEmpty(self, row, count):
+        """Insert count rows whose values are all None before row."""
+        for col, encode in zip(self._cols, self._encoders):
+            empty = [encode(None) if encode else None] * count
+            col[row:row] = array(col.typecode, empty) if isinstance(col, array) else empty
+
+    def delete(self, row, count):
+        for col in self._cols:
+            del col[row:row+count]
+        if not self.ids:
+            self._resetTables()  # drop strings no longer used
+
+
+# all members and methods except run() of QThread reside in the old thread
+class NikkiLoader(QThread):
+    """Read diaries from database and send them back in batches of model rows.
+    The first batch is small to show something as soon as possible."""
+    FIRST_BATCH_SIZE = 35
+    BATCH_SIZE = 500
+    batchLoaded = Signal(object)  # list of rows
+
+    def __init__(self, sortBy, reverse, light):
+        super().__init__()
+        self.canceled = False
+        self.sortBy, self.reverse, self.light = sortBy, reverse, light
+
+    def run(self):
+        reader = nikki.reader()
+        try:
+            batch, size = [], self.FIRST_BATCH_SIZE
+            for i in reader.sorted(self.sortBy, self.reverse, light=self.light,
+                                   packed=True):
+                if self.canceled:
+                    return
+                if self.light:
+                    batch.append([i['id'], i['datetime'], None, i['title'],
+                                  i['tags'], None, i['length']])
+                else:
+                    batch.append([i['id'], i['datetime'], i['text'], i['title'],
+                                  i['tags'], i['formats'], len(i['text'])])
+                if len(batch) == size:
+                    self.batchLoaded.emit(batch)
+                    batch, size = [], self.BATCH_SIZE
+            if batch:
+                self.batchLoaded.emit(batch)
+        except Exception as e:
+            logging.error('loading diaries failed: %s' % e)
+        finally:
+            reader.disconnect()
+
+    def disConn(self):
+        self.batchLoaded.disconnect()
 
 
 class NikkiModel(QAbstractTableModel):
     """The Model holds diaries. Specially optimized for loading from database.
     Table structure: id | datetime | text | title | tags | formats | len(text)
+    Rows are stored by columns (see NikkiRows) and formats are kept packed (see
+    db.pack_formats) to save memory.
+
+    In lazy mode only light columns are loaded, text and formats are fetched from
+    database on demand and kept in a LRU cache (call prefetch to fetch in bulk).
+
+    Data of column text with PreviewRole is (text, formats) that cut to the part
+    can be displayed in list (see setPreviewLimit).
+
+    Ids of diaries are indexed by their tags, see taggedIds. Statistics of days
+    used by heat map are in dayStats (DayStatsCache).
     """
-    def __init__(self, parent=None):
+    BODY_CACHE_SIZE = 512
+    PREVIEW_CACHE_SIZE = 4096
+    PreviewRole = Qt.UserRole + 1
+    loaded = Signal()
+
+    def __init__(self, parent=None, lazy=False):
         super().__init__(parent)
-        self._lst = []
+        self._rows = NikkiRows()
+        self._loader = None
+        self._loading = False
+        self._idToRow = {}
+        # tag name => set of ids. Sets are never removed (only emptied), because
+        # they may be referenced by filters of proxy model
+        self._tagIndex = {}
+        self.dayStats = DayStatsCache()
+        self.lazy = lazy
+        self._bodies = LRUCache(self.BODY_CACHE_SIZE)  # id => (text, formats)
+        self._previews = LRUCache(self.PREVIEW_CACHE_SIZE)  # id => (text, formats)
+        self._previewLimit = None
 
     def loadFromDb(self):
-        """Load diaries from database. It will repeatedly call qApp.processEvents
-        while loading data, making UI remaining responsive if the amount of data
-        is big. It also delay informing views to update, this avoid unnecessary
-        layout operation."""
-        def makeTimesSeq():
-            # e.g. len(nikki)==10: [10]; len(nikki)==450: [70, 300, 80]
-            # let first chunk be smallest to decreasing the time of blank-list
-            chunkSz, firstChunkSz = 300, 35
-            l = len(nikki)
-            if l <= firstChunkSz:
-                return [l]
-            else:
-                rest = l - firstChunkSz
-                seq = ([firstChunkSz] + [chunkSz] * (rest // chunkSz) +
-                       [rest % chunkSz])
-                return filter(lambda x: x != 0, seq)
-
-        sortBy = settings['Main']['listSortBy']
-        reverse = settings['Main'].getboolean('listReverse')
-
-        iterator = nikki.sorted(sortBy, reverse)
-        for times in makeTimesSeq():
-            # informing view every TIMES iterations
-            nextRow = len(self._lst)
-            self.beginInsertRows(QModelIndex(), nextRow, nextRow+times-1)
-            for count in range(times):
-                i = next(iterator)
-                self._lst.append([i['id'], i['datetime'], i['text'], i['title'],
-                                  i['tags'], i['formats'], len(i['text'])])
-                if count & 15 == 0: qApp.processEvents()  # equals "row % 16 == 0"
-            self.endInsertRows()
+        """Start loading diaries from database in a background thread (with its
+        own read-only connection), rows are appended when batches arrive. Signal
+        loaded will be emitted after all diaries loaded."""
+        self.cancelLoading()
+        self._loading = True
+        self._loader = NikkiLoader(settings['Main']['listSortBy'],
+                                   settings['Main'].getboolean('listReverse'), self.lazy)
+        self._loader.batchLoaded.connect(self._appendBatch)
+        self._loader.finished.connect(self._onLoaderFinished)
+        self._loader.start()
+
+    def cancelLoading(self):
+        """Stop loading if it is in progress, rows already appended are kept."""
+        if not self._loading: return
+        self._loader.canceled = True
+        self._loader.disConn()
+        self._loader.wait()
+        self._loading = False
+
+    def isLoading(self):
+        return self._loading
+
+    def _appendBatch(self, rows):
+        # batches of canceled loader may still in event queue
+        if self.sender() is not self._loader: return
+        if self._idToRow:  # skip diaries already saved into model while loading
+            rows = [r for r in rows if r[0] not in self._idToRow]
+            if not rows: return
+        start = len(self._rows)
+        self.beginInsertRows(QModelIndex(), start, start+len(rows)-1)
+        self._rows.extend(rows)
+        self._reindex(start)
+        for r in rows:
+            self._indexTags(r[0], r[4])
+        self.endInsertRows()
+        startup.finish('first batch')
+
+    def _onLoaderFinished(self):
+        if self.sender() is not self._loader or not self._loading: return
+        self._loading = False
+        startup.finish('first batch')  # empty diary book
+        self.loaded.emit()
 
     def getRowById(self, id):
-        for row, i in enumerate(self._lst):
-            if i[0] == id: return row
-        return -1
+        return self._idToRow.get(id, -1)
+
+    def _indexTags(self, id_, tags, add=True):
+        """Add id to (or remove from) sets of its tags in tag index."""
+        if id_ is None or not tags: return
+        for t in tags.split():
+            s = self._tagIndex.setdefault(t, set())
+            if add:
+                s.add(id_)
+            else:
+                s.discard(id_)
+
+    def taggedIds(self, tags, matchAll=True):
+        """Return a container (only supports `in`) of ids of diaries that have
+        all of tags, or any of them if matchAll is False. It's a live view of the
+        tag index, which is updated as rows inserted, removed or changed."""
+        sets = [self._tagIndex.setdefault(t, set()) for t in tags]
+        return sets[0] if len(sets) == 1 else TaggedIds(sets, matchAll)
+
+    def _reindex(self, start):
+        """Update id=>row index for rows after start (included)"""
+        index, ids = self._idToRow, self._rows.ids
+        for row in range(start, len(ids)):
+            id_ = ids[row]
+            if id_ != NULL: index[id_] = row
 
     def getNikkiDictByRow(self, row):
-        r = self._lst[row]
-        return dict(id=r[0], title=r[3], datetime=r[1], text=r[2],
-                    tags=r[4], formats=r[5])
+        r = self._rows.row(row)
+        text, formats = self._getBody(row)
+        return dict(id=r[0], title=r[3], datetime=r[1], text=text,
+                    tags=r[4], formats=formats)
+
+    def prefetch(self, rows):
+        """Fetch text and formats of given rows in bulk, only used in lazy mode."""
+        if not self.lazy: return
+        ids = [self._rows.get(r, 0) for r in rows]
+        missing = [i for i in ids if i not in self._bodies]
+        if missing:
+            for id_, body in nikki.getbodies(missing, packed=True).items():
+                self._bodies.put(id_, body)
 
-    def clear(self): self.removeRows(0, self.rowCount())
+    def _getBody(self, row):
+        """Return (text, formats) of the row"""
+        if not self.lazy:
+            return self._rows.get(row, 2), self._rows.get(row, 5)
+        id_ = self._rows.get(row, 0)
+        body = self._bodies.get(id_)
+        if body is None:
+            self.prefetch([row])
+            body = self._bodies.get(id_, ('', None))
+        return body
 
-    def rowCount(self, *__): return len(self._lst)
+    def setPreviewLimit(self, lines, lineChars):
+        """Set how many lines of preview and the max count of characters in one line.
+        Pass None to disable cutting."""
+        self._previewLimit = None if lines is None else (lines, lineChars)
+        self._previews.clear()
+
+    def _getPreview(self, row):
+        id_ = self._rows.get(row, 0)
+        preview = self._previews.get(id_)
+        if preview is None:
+            text, formats = self._getBody(row)
+            preview = (makePreview(text, formats, *self._previewLimit) if self._previewLimit
+                       else (text, formats))
+            self._previews.put(id_, preview)
+        return preview
+
+    def clear(self):
+        self.cancelLoading()
+        self.dayStats.clear()  # rows are not deleted, don't count them out
+        self.removeRows(0, self.rowCount())
+        self._idToRow.clear()
+        self._bodies.clear()
+        self._previews.clear()
+
+    def rowCount(self, *__): return len(self._rows)
 
     def columnCount(self, *__): return 7
 
     def data(self, index, role=Qt.DisplayRole):
         if role == Qt.DisplayRole:
-            return self._lst[index.row()][index.column()]
+            c = index.column()
+            if self.lazy and (c == 2 or c == 5):
+                return self._getBody(index.row())[c == 5]
+            return self._rows.get(index.row(), c)
+        elif role == self.PreviewRole and index.column() == 2:
+            return self._getPreview(index.row())
 
     def setData(self, index, value, *__):
         r, c = index.row(), index.column()
-        self._lst[r][c] = value
+        rows = self._rows
+        id_, tags = rows.get(r, 0), rows.get(r, 4)
+        if c == 0:
+            self._idToRow.pop(id_, None)
+            if value is not None: self._idToRow[value] = r
+        if c == 0 or c == 4:
+            self._indexTags(id_, tags, add=False)
+        self._previews.pop(id_)
+        rows.set(r, c, value)
+        if c == 0 or c == 4:
+            self._indexTags(rows.get(r, 0), rows.get(r, 4))
         self.dataChanged.emit(*[self.index(r, c)] * 2)
         return True
 
     def removeRows(self, row, count, *__):
         self.beginRemoveRows(QModelIndex(), row, row+count-1)
-        del self._lst[row:row+count]
+        for i in map(self._rows.row, range(row, row+count)):
+            self._idToRow.pop(i[0], None)
+            self._previews.pop(i[0])
+            self._indexTags(i[0], i[4], add=False)
+            self.dayStats.remove(i[1], i[6])
+        self._rows.delete(row, count)
+        self._reindex(row)
         self.endRemoveRows()
         return True
 
@@ -80,27 +449,129 @@ class NikkiModel(QAbstractTableModel):
 
     def insertRows(self, row, count, *__):
         self.beginInsertRows(QModelIndex(), row, row+count-1)
-        for i in range(row, row+count):
-            self._lst.insert(i, [None] * 7)
+        self._rows.insertEmpty(row, count)
+        self._reindex(row + count)
         self.endInsertRows()
         return True
 
     def insertRow(self, row, *__): return self.insertRows(row, 1)
 
     def updateNikki(self, nikkiDict):
+        """Save the diary to database and write it to model, return its row. The
+        diary is appended if it's new, or its row is missing (loading canceled or
+        not finished when editor opened)."""
+        id_ = nikkiDict['id']
+        row = -1 if id_ == -1 else self.getRowById(id_)
+        missing = nikki[id_] if row == -1 and id_ != -1 else None  # as before saving
         realId = nikki.save(**nikkiDict)
         # write to model
         oneRow = ([realId] +
-                  [nikkiDict[k] for k in ('datetime', 'text', 'title', 'tags', 'formats')] +
-                  [len(nikkiDict['text'])])
-        if nikkiDict['id'] == -1:  # new diary
+                  [nikkiDict[k] for k in ('datetime', 'text', 'title', 'tags')] +
+                  [pack_formats(nikkiDict['formats']), len(nikkiDict['text'])])
+        if row == -1:
             row = self.rowCount()
             self.insertRow(row)
             # tags may be None while tags is empty or not changed
-            if oneRow[4] is None: oneRow[4] = ''
+            if oneRow[4] is None:
+                oneRow[4] = missing['tags'] if missing else ''
+            if missing:  # its day may be counted already in a cached year
+                self.dayStats.remove(missing['datetime'], len(missing['text']))
         else:
-            row = self.getRowById(nikkiDict['id'])
-            if oneRow[4] is None: oneRow[4] = self._lst[row][4]
-        self._lst[row] = oneRow
+            old = self._rows.row(row)
+            if oneRow[4] is None: oneRow[4] = old[4]
+            self._indexTags(realId, old[4], add=False)
+            self.dayStats.remove(old[1], old[6])
+        self._indexTags(realId, oneRow[4])
+        self.dayStats.add(oneRow[1], oneRow[6])
+        self._previews.pop(realId)
+        if self.lazy:
+            self._bodies.put(realId, (oneRow[2], oneRow[5]))
+            oneRow[2] = oneRow[5] = None
+        self._rows.setRow(row, oneRow)
+        self._idToRow[realId] = row
         self.dataChanged.emit(self.index(row, 0), self.index(row, 6))
         return row
+
+
+class TagModel(QAbstractListModel):
+    """Tags and count of diaries using them, in the order of database. Row 0 is
+    always "All" (clear tag filter). After loaded it's kept up to date by
+    applyDelta instead of loading again.
+
+    Data of Qt.UserRole is the count (None if counts disabled by settings)."""
+    def __init__(self, allText, parent=None):
+        super().__init__(parent)
+        self.allText = allText
+        self.countEnabled = True
+        self._names = []  # name of row 1, 2, ...
+        self._counts = {}  # name => count
+
+    def load(self):
+        self.beginResetModel()
+        self.countEnabled = settings['Main'].getboolean('tagListCount')
+        self._counts = dict(nikki.gettags(getcount=True))
+        self._names = list(self._counts)
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self._names, self._counts = [], {}
+        self.endResetModel()
+
+    def applyDelta(self, delta):
+        """Apply changes of counts (dict: name => change). Tags whose count drops
+        to zero are removed, new tags are appended."""
+        for name, change in delta.items():
+            if not change: continue
+            count = self._counts.get(name, 0) + change
+            row = self.rowOf(name)
+            if row == -1:
+                if count <= 0: continue
+                row = self.rowCount()
+                self.beginInsertRows(QModelIndex(), row, row)
+                self._names.append(name)
+                self._counts[name] = count
+                self.endInsertRows()
+            elif count <= 0:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._names[row-1]
+                del self._counts[name]
+                self.endRemoveRows()
+            else:
+                self._counts[name] = count
+                idx = self.index(row)
+                self.dataChanged.emit(idx, idx)
+
+    def rowOf(self, name):
+        """Return the row of tag, -1 if not exists."""
+        try:
+            return self._names.index(name) + 1
+        except ValueError:
+            return -1
+
+    def count(self, name):
+        return self._counts.get(name, 0)
+
+    def rowCount(self, *__): return len(self._names) + 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        row = index.row()
+        if role in (Qt.DisplayRole, Qt.EditRole, Qt.ToolTipRole):
+            return self.allText if row == 0 else self._names[row-1]
+        if role == Qt.UserRole and row > 0 and self.countEnabled:
+            return self._counts[self._names[row-1]]
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        """Rename the tag (database is not touched)."""
+        row = index.row()
+        if role != Qt.EditRole or row == 0: return False
+        old = self._names[row-1]
+        self._names[row-1] = value
+        self._counts[value] = self._counts.pop(old)
+        self.dataChanged.emit(index, index)
+        return True
+
+    def flags(self, index):
+        f = Qt.ItemIsSelectable | Qt.ItemIsEnabled
+        return f if index.row() == 0 else f | Qt.ItemIsEditable
@@ -2,22 +2,60 @@
 """
 import logging
 import random
-from collections import OrderedDict
+import sqlite3
+from collections import OrderedDict, Counter
 from PySide.QtGui import *
 from PySide.QtCore import *
-from hazama.ui import font, datetimeTrans, scaleRatio, makeQIcon
+from hazama.ui import font, datetimeTrans, scaleRatio, makeQIcon, showErrors
 from hazama.ui.editor import Editor
-from hazama.ui.customobjects import NTextDocument, MultiSortFilterProxyModel
+from hazama.ui.customobjects import NTextDocument, MultiSortFilterProxyModel, LRUCache
 from hazama.ui.customwidgets import NElideLabel, NDocumentLabel
-from hazama.ui.listmodel import NikkiModel
+from hazama.ui.listmodel import NikkiModel, TagModel
 from hazama.config import settings, nikki
 
 
+class ItemPixmapCache:
+    """Cache items rendered by ItemDelegate of NList as pixmaps, one per (id, size,
+    state), so that painting an unchanged item is just a blit. Cached pixmaps of
+    a diary must be dropped by invalidate after it changed.
+    :param paintFunc: called with (painter, rect, index, selected, active) to
+    render an item into the pixmap"""
+    def __init__(self, paintFunc, maxSize=64):
+        self._paintFunc = paintFunc
+        self._pixmaps = LRUCache(maxSize)  # id => {(width, height, state): QPixmap}
+
+    def paint(self, painter, option, index):
+        selected = bool(option.state & QStyle.State_Selected)
+        active = bool(option.state & QStyle.State_Active)
+        size = option.rect.size()
+        id_ = index.sibling(index.row(), 0).data()
+        pixmaps = self._pixmaps.get(id_)
+        if pixmaps is None:
+            pixmaps = {}
+            self._pixmaps.put(id_, pixmaps)
+        key = (size.width(), size.height(), selected, active)
+        pixmap = pixmaps.get(key)
+        if pixmap is None:
+            pixmap = pixmaps[key] = QPixmap(size)
+            pixmap.fill(Qt.transparent)
+            pixPainter = QPainter(pixmap)
+            self._paintFunc(pixPainter, QRect(QPoint(0, 0), size), index, selected, active)
+            pixPainter.end()
+        painter.drawPixmap(option.rect.topLeft(), pixmap)
+
+    def invalidate(self, id):
+        self._pixmaps.pop(id)
+
+    def clear(self):
+        self._pixmaps.clear()
+
+
 class NListDelegate(QStyledItemDelegate):
     """ItemDelegate of old theme 'one-pixel-rect' for NList, Using 'traditional'
     painting method compared to colorful theme."""
     def __init__(self):
         super().__init__()  # don't pass parent because of mem problem
+        self.cache = ItemPixmapCache(self.paintItem)
         # To avoid some font has much more space at top and bottom, we use ascent instead
         # of height, and add it with a small number.
         magic = int(4 * scaleRatio)
@@ -27,7 +65,7 @@ class NListDelegate(QStyledItemDelegate):
         self.tagPath_h = font.default_m.ascent() + magic
         self.tag_h = self.tagPath_h + 4
         self.dt_w = font.datetime_m.width(datetimeTrans('2000-01-01 00:00')) + 40
-        self.all_h = None  # updated in sizeHint before each item being painting
+        self.all_h = None  # updated in sizeHint
         # doc is used to draw text(diary's body)
         self.doc = NTextDocument()
         self.doc.setDefaultFont(font.text)
@@ -42,23 +80,25 @@ class NListDelegate(QStyledItemDelegate):
         self.c_gray = QColor(93, 73, 57)
 
     def paint(self, painter, option, index):
-        x, y, w = option.rect.x(), option.rect.y(), option.rect.width()-1
+        self.cache.paint(painter, option, index)
+
+    def paintItem(self, painter, rect, index, selected, active):
+        x, y, w = rect.x(), rect.y(), rect.width()-1
+        all_h = rect.height() - 3
         row = index.row()
-        dt, text, title, tags, formats = (index.sibling(row, i).data()
-                                          for i in range(1, 6))
-        selected = bool(option.state & QStyle.State_Selected)
-        active = bool(option.state & QStyle.State_Active)
+        dt, title, tags = (index.sibling(row, i).data() for i in (1, 3, 4))
+        text, formats = index.sibling(row, 2).data(NikkiModel.PreviewRole)
         # draw border and background
         painter.setPen(self.c_border)
         painter.setBrush(self.c_bg if selected and active else
                          self.c_inActBg)
-        painter.drawRect(x+1, y, w-2, self.all_h)  # outer border
+        painter.drawRect(x+1, y, w-2, all_h)  # outer border
         if selected:  # draw inner border
             pen = QPen()
             pen.setStyle(Qt.DashLine)
             pen.setColor(self.c_gray)
             painter.setPen(pen)
-            painter.drawRect(x+2, y+1, w-4, self.all_h-2)
+            painter.drawRect(x+2, y+1, w-4, all_h-2)
         # draw datetime and title
         painter.setPen(self.c_gray)
         painter.drawLine(x+10, y+self.titleArea_h, x+w-10, y+self.titleArea_h)
@@ -192,20 +232,26 @@ class NListDelegateColorful(QItemDelegate):
 
     def __init__(self):
         super().__init__()
+        self.cache = ItemPixmapCache(self.paintItem)
         self._itemW = self.ItemWidget()
         self._itemW.refreshHeightInfo()
 
     def paint(self, painter, option, index):
+        self.cache.paint(painter, option, index)
+
+    def paintItem(self, painter, rect, index, selected, active):
         row = index.row()
 
-        self._itemW.resize(option.rect.size())
-        self._itemW.setTexts(*(index.sibling(row, i).data() for i in range(1, 6)))
-        self._itemW.setProperty('selected', bool(option.state & QStyle.State_Selected))
-        self._itemW.setProperty('active', bool(option.state & QStyle.State_Active))
+        self._itemW.resize(rect.size())
+        dt, title, tags = (index.sibling(row, i).data() for i in (1, 3, 4))
+        text, formats = index.sibling(row, 2).data(NikkiModel.PreviewRole)
+        self._itemW.setTexts(dt, text, title, tags, formats)
+        self._itemW.setProperty('selected', selected)
+        self._itemW.setProperty('active', active)
         self._itemW.refreshStyle()
 
         # don't use offset argument of QWidget.render
-        painter.translate(option.rect.topLeft())
+        painter.translate(rect.topLeft())
         self._itemW.render(painter, QPoint(), renderFlags=QWidget.DrawChildren)
         painter.resetTransform()
 
@@ -332,9 +378,9 @@ class TListDelegateColorful(QItemDelegate):
         editor.setGeometry(option.rect)
 
 
-class TagList(QListWidget):
+class TagList(QListView):
     currentTagChanged = Signal(str)  # str is tag-name or ''
-    tagNameModified = Signal(str)  # arg: newTagName
+    tagNameModified = Signal(str, str)  # arg: oldTagName, newTagName
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -343,10 +389,12 @@ class TagList(QListWidget):
         self.setDelegateOfTheme()
 
         self.setUniformItemSizes(True)
-        self.currentItemChanged.connect(self.emitCurrentTagChanged)
+        self._model = TagModel(self.tr('All'), self)
+        self.setModel(self._model)
+        self.selectionModel().currentChanged.connect(self.emitCurrentTagChanged)
         nextFunc = lambda: self.setCurrentRow(
-            0 if self.currentRow() == self.count() - 1 else self.currentRow() + 1)
-        preFunc = lambda: self.setCurrentRow((self.currentRow() or self.count()) - 1)
+            0 if self.currentRow() == self._model.rowCount() - 1 else self.currentRow() + 1)
+        preFunc = lambda: self.setCurrentRow((self.currentRow() or self._model.rowCount()) - 1)
         self.nextSc = QShortcut(QKeySequence('Ctrl+Tab'), self, activated=nextFunc)
         self.preSc = QShortcut(QKeySequence('Ctrl+Shift+Tab'), self, activated=preFunc)
 
@@ -374,46 +422,48 @@ class TagList(QListWidget):
             nikki.changetagname(editor.oldText, newName)
             logging.info('tag [%s] changed to [%s]', editor.oldText, newName)
             super().commitData(editor)
-            self.tagNameModified.emit(newName)
+            self.tagNameModified.emit(editor.oldText, newName)
+
+    def currentRow(self):
+        return self.currentIndex().row()
+
+    def setCurrentRow(self, row):
+        self.setCurrentIndex(self._model.index(row))
+
+    def currentTag(self):
+        """Return name of current tag, '' if "All" or nothing selected."""
+        row = self.currentRow()
+        return self._model.index(row).data() if row > 0 else ''
 
     def load(self):
         logging.debug('load Tag List')
-        QListWidgetItem(self.tr('All'), self)
+        self._model.load()
         self.setCurrentRow(0)
-        itemFlag = Qt.ItemIsEditable | Qt.ItemIsSelectable | Qt.ItemIsEnabled
-        if settings['Main'].getboolean('tagListCount'):
-            for name, count in nikki.gettags(getcount=True):
-                item = QListWidgetItem(name, self)
-                item.setFlags(itemFlag)
-                item.setData(Qt.ToolTipRole, name)
-                item.setData(Qt.UserRole, count)
-        else:
-            for name in nikki.gettags(getcount=False):
-                item = QListWidgetItem(name, self)
-                item.setData(Qt.ToolTipRole, name)
-                item.setFlags(itemFlag)
+
+    def clear(self):
+        self._model.clear()
 
     def reload(self):
+        """Load all tags from database again, current tag is kept if it still
+        exists."""
         if self.isVisible():
-            try:
-                currentTag = self.currentItem().data(Qt.DisplayRole)
-            except AttributeError:  # no selection
-                currentTag = None
-            self.clear()
+            currentTag = self.currentTag()
             self.load()
             if currentTag:
-                try:
-                    item = self.findItems(currentTag, Qt.MatchFixedString)[0]
-                except IndexError:
-                    item = self.item(0)
-                self.setCurrentItem(item)
-
-    def emitCurrentTagChanged(self, currentItem):
-        try:
-            text = currentItem.data(Qt.DisplayRole)
-        except AttributeError:  # no selection
-            return
-        self.currentTagChanged.emit('' if currentItem is self.item(0) else text)
+                self.setCurrentRow(max(self._model.rowOf(currentTag), 0))
+
+    def applyDelta(self, delta):
+        """Update counts of tags after diaries saved or deleted.
+        :param delta: dict that maps tag name to the change of its count"""
+        if not self.isVisible(): return  # loaded again when shown
+        currentTag = self.currentTag()
+        if currentTag and self._model.count(currentTag) + delta.get(currentTag, 0) <= 0:
+            self.setCurrentRow(0)  # current tag will be removed
+        self._model.applyDelta(delta)
+
+    def emitCurrentTagChanged(self, current, previous):
+        if not current.isValid(): return  # no selection
+        self.currentTagChanged.emit('' if current.row() == 0 else current.data())
 
     # all three events below for drag scroll
     def mousePressEvent(self, event):
@@ -432,19 +482,23 @@ class TagList(QListWidget):
             pEvent = QMouseEvent(QEvent.MouseButtonPress, event.pos(),
                                  event.globalPos(), Qt.LeftButton,
                                  Qt.LeftButton, Qt.NoModifier)
-            QListWidget.mousePressEvent(self, pEvent)
+            QListView.mousePressEvent(self, pEvent)
         self.trackList = None
 
 
 class NikkiList(QListView):
     """Main List that display preview of diaries"""
+    # rows around viewport (in pages) whose text will be prefetched in lazy mode
+    PREFETCH_PAGES = 1
     startLoading = Signal()
     countChanged = Signal()
-    tagsChanged = Signal()
+    tagsChanged = Signal(object)  # dict: tag name => change of count
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self._delegate = None
+        self._searchString = ''
+        self._filterTags, self._filterTagsAll = [], True
         # ScrollPerPixel means user can draw scroll bar and move list items pixel by pixel,
         # but mouse wheel still scroll item by item (the number of items scrolled depends on
         # qApp.wheelScrollLines)
@@ -453,13 +507,21 @@ class NikkiList(QListView):
         # disable default editor. Editor is implemented in the View
         self.setEditTriggers(QAbstractItemView.NoEditTriggers)
         # setup models
-        self.originModel = NikkiModel(self)
+        self.originModel = NikkiModel(self, lazy=settings['Main'].getboolean('lazyLoad'))
         self.modelProxy = MultiSortFilterProxyModel(self)
         self.modelProxy.setSourceModel(self.originModel)
+        # drop cached rendering of changed diaries
+        self.originModel.dataChanged.connect(self._invalidateCachedItems)
+        self.originModel.rowsAboutToBeRemoved.connect(self._invalidateCachedRows)
+        self.originModel.modelReset.connect(self._clearCachedItems)
+        self.originModel.loaded.connect(self.countChanged)
         self.modelProxy.setDynamicSortFilter(True)
+        # tag filter, uses ids from the tag index of model
         self.modelProxy.addFilter(cols=[4], cs=Qt.CaseSensitive)
+        # search filter, uses ids from full-text search of database
         self.modelProxy.addFilter(cols=[1, 2, 3], cs=Qt.CaseInsensitive)
         self.setModel(self.modelProxy)
+        self._setPreviewLimit()
         self.sort()
         # setup actions
         self.editAct = QAction(self.tr('Edit'), self,
@@ -488,6 +550,24 @@ class NikkiList(QListView):
         self.randAct.setDisabled(self.modelProxy.rowCount() == 0)
         menu.exec_(event.globalPos())
 
+    def paintEvent(self, event):
+        if self.originModel.lazy:
+            self._prefetchVisible()
+        super().paintEvent(event)
+
+    def _prefetchVisible(self):
+        """Fetch text of visible rows and rows around them in one go."""
+        rowCount = self.modelProxy.rowCount()
+        if rowCount == 0: return
+        first = self.indexAt(QPoint(0, 0)).row()
+        if first == -1: first = 0
+        last = self.indexAt(QPoint(0, self.viewport().height() - 1)).row()
+        if last == -1: last = rowCount - 1
+        margin = (last - first + 1) * self.PREFETCH_PAGES
+        modelP = self.modelProxy
+        rows = range(max(first - margin, 0), min(last + margin + 1, rowCount))
+        self.originModel.prefetch([modelP.mapToSource(modelP.index(i, 0)).row() for i in rows])
+
     def selectRandomly(self):
         randRow = random.randrange(0, self.modelProxy.rowCount())
         self.setCurrentIndex(self.modelProxy.index(randRow, 0))
@@ -498,27 +578,28 @@ class NikkiList(QListView):
         if id_ in self.editors:
             self.editors[id_].activateWindow()
         else:
-            e = Editor(dic)
-            self._setEditorStaggerPos(e)
-            self.editors[id_] = e
-            e.closed.connect(self.closeEditor)
-            pre, next = lambda: self._editorMove(-1), lambda: self._editorMove(1)
-            e.preSc.activated.connect(pre)
-            e.quickPreSc.activated.connect(pre)
-            e.nextSc.activated.connect(next)
-            e.quickNextSc.activated.connect(next)
-            e.show()
+            self._openEditor(dic).show()
             return id_
 
     def startEditorNew(self):
         if -1 in self.editors:
             self.editors[-1].activateWindow()
         else:
-            e = Editor({'id': -1})
-            self._setEditorStaggerPos(e)
-            self.editors[-1] = e
-            e.closed.connect(self.closeEditor)
-            e.show()
+            self._openEditor({'id': -1}).show()
+
+    def _openEditor(self, dic):
+        """Create an editor of the diary dict and register it, return the editor
+        (not shown yet)."""
+        e = Editor(dic)
+        self._setEditorStaggerPos(e)
+        self.editors[dic['id']] = e
+        e.closed.connect(self.closeEditor)
+        pre, next = lambda: self._editorMove(-1), lambda: self._editorMove(1)
+        e.preSc.activated.connect(pre)
+        e.quickPreSc.activated.connect(pre)
+        e.nextSc.activated.connect(next)
+        e.quickNextSc.activated.connect(next)
+        return e
 
     def closeEditor(self, id_, needSave):
         """Write editor's data to model and database, and destroy editor"""
@@ -529,19 +610,51 @@ class NikkiList(QListView):
             if not editor.tagModified:  # let database skip heavy tag update operation
                 dic['tags'] = None
             else:  # remove duplicate tags
-                dic['tags'] = ' '.join(set(dic['tags'].split()))
-            row = self.originModel.updateNikki(dic)
+                newTags = set(dic['tags'].split())
+                dic['tags'] = ' '.join(newTags)
+                oldRow = self.originModel.getRowById(id_)
+                if oldRow != -1:
+                    oldTags = set(self.originModel.index(oldRow, 4).data().split())
+                else:  # new diary, or not loaded into model
+                    oldTags = set() if id_ == -1 else set(nikki[id_]['tags'].split())
+                delta = dict.fromkeys(newTags - oldTags, 1)
+                delta.update(dict.fromkeys(oldTags - newTags, -1))
+            try:
+                row = self.originModel.updateNikki(dic)
+            except sqlite3.OperationalError as e:  # locked by a reader (not WAL)
+                logging.error('failed to save diary (ID: %s): %s', id_, e)
+                qApp.restoreOverrideCursor()
+                showErrors('dbBusy', hint=str(e))
+                editor.show()  # keep editor and its draft, user can save again
+                return
 
             self.clearSelection()
             self.setCurrentIndex(self.modelProxy.mapFromSource(
                 self.originModel.index(row, 0)))
 
             if id_ == -1: self.countChanged.emit()  # new diary
-            if editor.tagModified: self.tagsChanged.emit()
+            if editor.tagModified and delta: self.tagsChanged.emit(delta)
+            if self._searchString:  # saved diary may (not) match now
+                self.setFilterBySearchString(self._searchString)
             qApp.restoreOverrideCursor()
+        nikki.deletedraft(id_)
         editor.deleteLater()
         del self.editors[id_]
 
+    def recoverDrafts(self):
+        """Open editors of drafts left by last run (which didn't exit normally).
+        Diaries should be loaded already."""
+        for dic in nikki.getdrafts():
+            id_ = dic['id']
+            if id_ in self.editors: continue
+            if id_ != -1 and self.originModel.getRowById(id_) == -1:
+                nikki.deletedraft(id_)  # diary not exists anymore
+                continue
+            logging.info('recover draft (ID: %s, saved at %s UTC)', id_, dic['saved'])
+            e = self._openEditor(dic)
+            e.setModified()
+            e.show()
+
     def _setEditorStaggerPos(self, editor):
         if self.editors:
             lastOpenEditor = list(self.editors.values())[-1]
@@ -550,20 +663,46 @@ class NikkiList(QListView):
             editor.move(pos)
 
     def load(self):
+        """Start loading diaries in background, countChanged will be emitted
+        after finished."""
         self.startLoading.emit()
         self.originModel.loadFromDb()
-        self.countChanged.emit()
 
     def setDelegateOfTheme(self):
         theme = settings['Main']['theme']
         self._delegate = {'colorful': NListDelegateColorful}.get(theme, NListDelegate)()
         self.setItemDelegate(self._delegate)
+        if hasattr(self, 'originModel'):  # fonts or preview lines may changed
+            self._setPreviewLimit()
         # force items to be laid again
         self.setSpacing(self.spacing())
 
+    def _setPreviewLimit(self):
+        """Let model cut text of diaries before they are laid out by delegates."""
+        # upper bound of characters in one line: the narrowest char fills the widest
+        # screen, window may be moved to any screen after this
+        narrowest = min(font.text_m.width(c) for c in ' .,:;!|\'ijl')
+        desktop = qApp.desktop()
+        width = max(desktop.screenGeometry(i).width() for i in range(desktop.screenCount()))
+        lineChars = width // max(narrowest, 1) + 1
+        self.originModel.setPreviewLimit(settings['Main'].getint('previewLines'), lineChars)
+
+    def _invalidateCachedItems(self, topLeft, bottomRight):
+        self._invalidateCachedRows(None, topLeft.row(), bottomRight.row())
+
+    def _invalidateCachedRows(self, __, first, last):
+        model = self.originModel
+        for row in range(first, last+1):
+            self._delegate.cache.invalidate(model.index(row, 0).data())
+
+    def _clearCachedItems(self):
+        self._delegate.cache.clear()
+
     def reload(self):
-        self.originModel.clear()
+        self.originModel.clear()  # loading in progress is canceled
         self.load()
+        if self._searchString:  # ids may changed (backup restored)
+            self.setFilterBySearchString(self._searchString)
 
     def delNikki(self):
         if len(self.selectedIndexes()) == 0:
@@ -580,18 +719,18 @@ class NikkiList(QListView):
         if msg.clickedButton() == okBtn:
             indexes = [self.modelProxy.mapToSource(i)
                        for i in self.selectedIndexes()]
-            for i in indexes: nikki.delete(i.data())
+            removedTags = Counter()
+            for i in indexes:
+                nikki.delete(i.data())
+                removedTags.update(i.sibling(i.row(), 4).data().split())
             for i in sorted([i.row() for i in indexes], reverse=True):
                 self.originModel.removeRow(i)
             self.countChanged.emit()
-            self.tagsChanged.emit()  # tags might changed
+            if removedTags:
+                self.tagsChanged.emit({k: -v for k, v in removedTags.items()})
 
-    def handleExport(self, path, export_all):
-        if export_all:
-            selected = None
-        else:
-            selected = [self._getNikkiDict(i) for i in self.selectedIndexes()]
-        nikki.exporttxt(path, selected)
+    def selectedIds(self):
+        return [i.data() for i in self.selectedIndexes()]  # column 0 is id
 
     def _getNikkiDict(self, idx):
         """Get a nikki dict with its index in proxy model."""
@@ -609,10 +748,11 @@ class NikkiList(QListView):
         _id = list(self.editors.keys())[0]
         editor = self.editors[_id]
         if editor.needSave(): return
-        idx = self.modelProxy.match(
-            self.modelProxy.index(0, 0), 0, _id, flags=Qt.MatchExactly)
-        if len(idx) != 1: return
-        row = idx[0].row()  # the row of the caller (Editor) 's diary in proxy model
+        srcRow = self.originModel.getRowById(_id)
+        if srcRow == -1: return
+        # the row of the caller (Editor) 's diary in proxy model
+        row = self.modelProxy.mapFromSource(self.originModel.index(srcRow, 0)).row()
+        if row == -1: return  # filtered out
 
         if ((step == -1 and row == 0) or
            (step == 1 and row == self.modelProxy.rowCount() - 1)):
@@ -621,25 +761,37 @@ class NikkiList(QListView):
         self.clearSelection()
         self.setCurrentIndex(newIdx)
         dic = self._getNikkiDict(newIdx)
+        nikki.deletedraft(_id)  # unchanged, but a draft may be written before
         editor.fromNikkiDict(dic)
         self.editors[dic['id']] = self.editors.pop(_id)
 
     def setFilterBySearchString(self, s):
-        self.modelProxy.setFilterPattern(1, s)
+        self._searchString = s
+        self.modelProxy.setFilterIds(1, nikki.search(s) if s else None)
         self.countChanged.emit()
 
     def setFilterByTag(self, s):
-        self.modelProxy.setFilterPattern(0, s)
+        self.setFilterByTags([s] if s else [])
+
+    def setFilterByTags(self, tags, matchAll=True):
+        """Show only diaries that have all of tags (any of them if matchAll is
+        False). Empty tags clear the filter."""
+        self._filterTags, self._filterTagsAll = list(tags), matchAll
+        self.modelProxy.setFilterIds(
+            0, self.originModel.taggedIds(tags, matchAll) if tags else None, copy=False)
         self.countChanged.emit()
 
-    @Slot(str)
-    def refreshFilteredTags(self, newTagName):
-        """Refresh items with old tag in current modelProxy after a tag's name
-        changed, and replace old tag name in filter"""
-        model, modelP = self.originModel, self.modelProxy
-        needRefresh = [modelP.mapToSource(modelP.index(i, 0))
-                       for i in range(modelP.rowCount())]
-        for i in needRefresh:
-            diary = nikki[i.data()]
-            model.setData(i.sibling(i.row(), 4), diary['tags'])
-        self.setFilterByTag(newTagName)
+    @Slot(str, str)
+    def refreshFilteredTags(self, oldTagName, newTagName):
+        """Refresh items with old tag after a tag's name changed, and replace
+        old tag name in filter"""
+        model = self.originModel
+        for id_ in nikki.gettagged(newTagName):
+            row = model.getRowById(id_)
+            if row == -1: continue
+            tags = model.index(row, 4).data().split()
+            tags[tags.index(oldTagName)] = newTagName
+            model.setData(model.index(row, 4), ' '.join(tags))
+        if oldTagName in self._filterTags:
+            self.setFilterByTags([newTagName if t == oldTagName else t
+                                  for t in self._filterTags], self._filterTagsAll)
@@ -2,12 +2,9 @@ import logging
 from PySide.QtGui import *
 from PySide.QtCore import *
 from hazama.ui import (font, setTranslationLocale, winDwmExtendWindowFrame, scaleRatio,
-                       makeQIcon, saveWidgetGeo, restoreWidgetGeo)
+                       makeQIcon, saveWidgetGeo, restoreWidgetGeo, showErrors)
 from hazama.ui.customwidgets import QLineEditWithMenuIcon
-from hazama.ui.configdialog import ConfigDialog
 from hazama.ui.mainwindow_ui import Ui_mainWindow
-from hazama.ui.heatmap import HeatMap
-from hazama import updater
 from hazama.config import settings, isWin
 
 
@@ -16,6 +13,7 @@ class MainWindow(QMainWindow, Ui_mainWindow):
         super().__init__()
         self.setupUi(self)
         self.cfgDialog = self.heatMap = None  # create on on_cfgAct_triggered
+        self._backupTask = None
         restoreWidgetGeo(self, settings['Main'].get('windowGeo'))
         # setup toolbar bg properties; the second stage is in showEvent
         self.onExtendTitleBarBgChanged(init=True)
@@ -52,6 +50,8 @@ class MainWindow(QMainWindow, Ui_mainWindow):
         spacerWidget = QWidget(self.toolBar)
         spacerWidget.setFixedSize(2.5 * scaleRatio, 1)
         self.toolBar.addWidget(spacerWidget)
+        # carries a dict, so it's not connected in Designer
+        self.nList.tagsChanged.connect(self.tList.applyDelta)
         if settings['Main'].getboolean('tagListVisible'):
             self.tListAct.trigger()
         else:
@@ -69,14 +69,16 @@ class MainWindow(QMainWindow, Ui_mainWindow):
                 ico.addPixmap(ico.pixmap(originSz).scaled(originSz * scaleRatio))
                 i.setIcon(ico)
 
-        # setup auto update check
-        if updater.isCheckNeeded():
-            task = updater.CheckUpdate()
-            QTimer.singleShot(1200, task.start)
-            task.succeeded.connect(self.setUpdateHint)  # use lambda here will cause segfault!
+        # setup auto update check (updater is imported when the check starts)
+        if settings['Update'].getboolean('autoCheck'):
+            QTimer.singleShot(1200, self._startUpdateCheck)
+        # backup after diaries loaded, so it won't compete with loading for disk
+        if settings['Main'].getboolean('backup'):
+            self.nList.originModel.loaded.connect(self.startBackup)
 
         # delay list loading until main event loop start
         QTimer.singleShot(0, self.nList.load)
+        self.nList.originModel.loaded.connect(self._recoverDrafts)
 
     def showEvent(self, event):
         # style polished, we can get correct height of toolbar now
@@ -84,6 +86,10 @@ class MainWindow(QMainWindow, Ui_mainWindow):
         self.nList.setFocus()
 
     def closeEvent(self, event):
+        self.nList.originModel.cancelLoading()
+        if self._backupTask:
+            self._backupTask.disConn()
+            self._backupTask.wait()
         settings['Main']['windowGeo'] = saveWidgetGeo(self)
         tListVisible = self.tList.isVisible()
         settings['Main']['tagListVisible'] = str(tListVisible)
@@ -91,6 +97,14 @@ class MainWindow(QMainWindow, Ui_mainWindow):
             settings['Main']['tagListWidth'] = str(int(self.splitter.sizes()[0] / scaleRatio))
         event.accept()
 
+    def startBackup(self):
+        """Make daily backup in background if not did yet."""
+        self.nList.originModel.loaded.disconnect(self.startBackup)  # only once
+        from hazama.ui.tasks import BackupTask
+        self._backupTask = BackupTask()
+        self._backupTask.failed.connect(self._onBackupFailed)
+        self._backupTask.start()
+
     def createSortMenu(self):
         """Add sort order menu to sorAct."""
         menu = QMenu(self)
@@ -167,16 +181,31 @@ class MainWindow(QMainWindow, Ui_mainWindow):
     def updateCountLabel(self):
         """Update label that display count of diaries in Main List.
         'XX diaries' format is just fine, don't use 'XX diaries,XX results'."""
-        filtered = (self.nList.modelProxy.filterPattern(0) or
-                    self.nList.modelProxy.filterPattern(1))
+        filtered = (self.nList.modelProxy.isFilterEnabled(0) or
+                    self.nList.modelProxy.isFilterEnabled(1))
         c = self.nList.modelProxy.rowCount() if filtered else self.nList.originModel.rowCount()
         self.countLabel.setText(self.tr('%i diaries') % c)
 
+    def _recoverDrafts(self):
+        self.nList.originModel.loaded.disconnect(self._recoverDrafts)  # only once
+        self.nList.recoverDrafts()
+
+    def _startUpdateCheck(self):
+        from hazama import updater
+        if not updater.isCheckNeeded(): return
+        task = updater.CheckUpdate()
+        task.succeeded.connect(self.setUpdateHint)  # use lambda here will cause segfault!
+        task.start()
+
+    def _onBackupFailed(self, msg):
+        showErrors('cantFile', info=msg)
+
     def updateCountLabelOnLoad(self):
         self.countLabel.setText(self.tr('loading...'))
 
     def setUpdateHint(self, enabled=None):
         if enabled is None:
+            from hazama import updater
             enabled = bool(updater.foundUpdate)
 
         if enabled:
@@ -200,6 +229,7 @@ class MainWindow(QMainWindow, Ui_mainWindow):
         try:
             self.cfgDialog.activateWindow()
         except (AttributeError, RuntimeError):
+            from hazama.ui.configdialog import ConfigDialog
             self.cfgDialog = ConfigDialog(self)
             self.cfgDialog.langChanged.connect(self.retranslate)
             self.cfgDialog.bkRestored.connect(self.nList.reload)
@@ -218,32 +248,41 @@ class MainWindow(QMainWindow, Ui_mainWindow):
               '>= %d' % (550 * ratio)]
         descriptions = [i + ' ' + qApp.translate('HeatMap', '(characters)') for i in ds]
 
-        def colorFunc(y, m, d, cellColors):
-            data = colorFunc.cached.get((y, m, d), 0)
+        model = self.nList.originModel
+        dayStats = model.dayStats
+
+        def levelFunc(y, m, d):
+            data = dayStats.get(y, m, d)[1]  # total length of the day (or month)
+            if d is None:  # average of days in the month
+                data /= QDate(y, m, 1).daysInMonth()
             if data == 0:
-                return cellColors[0]
+                return 0
             elif data < 200 * ratio:
-                return cellColors[1]
+                return 1
             elif data < 550 * ratio:
-                return cellColors[2]
+                return 2
             else:
-                return cellColors[3]
+                return 3
 
-        # iter through model once and cache result.
-        colorFunc.cached = {}
-        model = self.nList.originModel
-        for i in range(model.rowCount()):
-            dt, length = model.index(i, 1).data(), model.index(i, 6).data()
-            year, month, last = dt.split('-')
-            colorFunc.cached[(int(year), int(month), int(last[:2]))] = length
+        def toolTipFunc(y, m, d):
+            count, length = dayStats.get(y, m, d)
+            title = (QLocale().toString(QDate(y, m, 1), 'MMMM yyyy') if d is None else
+                     QLocale().toString(QDate(y, m, d), QLocale.LongFormat))
+            return '%s\n%s' % (title, qApp.translate('HeatMap', '%d diaries, %d characters') %
+                               (count, length))
 
         try:
             self.heatMap.activateWindow()
         except (AttributeError, RuntimeError):
+            from hazama.ui.heatmap import HeatMap
             self.heatMap = HeatMap(self, objectName='heatMap', font=font.datetime)
             self.heatMap.closeSc = QShortcut(QKeySequence(Qt.Key_Escape), self.heatMap,
                                              activated=self.heatMap.close)
-            self.heatMap.setColorFunc(colorFunc)
+            self.heatMap.setLevelFunc(levelFunc)
+            self.heatMap.setToolTipFunc(toolTipFunc)
+            # levels of days are cached by the view
+            model.dataChanged.connect(self.heatMap.view.invalidate)
+            model.rowsRemoved.connect(self.heatMap.view.invalidate)
             self.heatMap.sample.setDescriptions(descriptions)
             self.heatMap.setAttribute(Qt.WA_DeleteOnClose)
             self.heatMap.resize(self.size())
@@ -0,0 +1,65 @@
+"""Background tasks that work on the diary book (export, backup and restore).
+They are kept out of configdialog, so that the daily backup started with the
+main window doesn't import the dialog and updater."""
+import logging
+from PySide.QtCore import QThread, Signal
+from hazama import db
+from hazama.config import settings, nikki
+
+
+class ExportTask(QThread):
+    """Export diaries in a new thread with a read-only connection."""
+    progress = Signal(int, int)  # exported, total
+    succeeded = Signal()
+    failed = Signal(str)
+
+    def __init__(self, path, fmt, ids):
+        super().__init__()
+        from hazama.exporter import Exporter
+        self.exporter = Exporter(None, path, fmt, ids, progress=self.progress.emit)
+
+    def run(self):
+        reader = nikki.reader()
+        try:
+            self.exporter.nikki = reader
+            if self.exporter.run() is not None:
+                self.succeeded.emit()
+        except Exception as e:
+            logging.error('exporting failed: %s' % e)
+            self.failed.emit(str(e))
+        finally:
+            reader.disconnect()
+
+    def disConn(self):
+        self.progress.disconnect()
+        self.succeeded.disconnect()
+        self.failed.disconnect()
+
+
+class BackupTask(QThread):
+    """Make daily backup, or restore given backup, in a new thread."""
+    progress = Signal(int, int)  # copied pages, total pages
+    succeeded = Signal()
+    failed = Signal(str)
+
+    def __init__(self, restore=None):
+        super().__init__()
+        self.restore = restore
+        self.compress = settings['Main']['backupCompress']
+        self.dedup = settings['Main'].getboolean('backupDedup')
+
+    def run(self):
+        try:
+            if self.restore:
+                db.restore_backup(self.restore, self.progress.emit)
+            else:
+                db.backup(self.compress, self.progress.emit, self.dedup)
+            self.succeeded.emit()
+        except Exception as e:
+            logging.error('%s failed: %s' % ('restoring' if self.restore else 'backup', e))
+            self.failed.emit(str(e))
+
+    def disConn(self):
+        self.progress.disconnect()
+        self.succeeded.disconnect()
+        self.failed.disconnect()
@@ -199,4 +199,5 @@ setup(name='Hazama',
                 'update_ts': UpdateTranslations, 'build_exe': BuildExe, 'pkgbuild': MakePKGBUILD,
                 'desktop_entry': InstallDesktopEntry},
       zip_safe=False,
-      entry_points={'gui_scripts': ['hazama = hazama:main_entry']})
+      entry_points={'gui_scripts': ['hazama = hazama:main_entry'],
+                    'console_scripts': ['hazama-import = hazama.importer:main']})
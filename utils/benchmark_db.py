@@ -0,0 +1,307 @@
+"""Benchmarks of database layer, run with a synthetic diary book.
+
+Usage: python3 utils/benchmark_db.py <benchmark> [-n DIARIES]"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path[0] = os.path.join(os.path.dirname(__file__), os.pardir)
+from hazama import db
+
+
+def make_diaries(count, seed=0, words=(20, 400)):
+    """Generate count synthetic diary dicts, about half of them have tags and formats.
+    :param words: range of word count of each diary"""
+    rand = random.Random(seed)
+    tags = ['tag%d' % i for i in range(60)]
+    start = datetime(2006, 1, 1)
+    for i in range(count):
+        dt = (start + timedelta(minutes=i * 97)).strftime('%Y-%m-%d %H:%M')
+        text = ' '.join('word%d' % rand.randrange(5000)
+                        for __ in range(rand.randrange(*words)))
+        formats = [(rand.randrange(len(text) - 10), rand.randrange(1, 10),
+                    rand.randrange(1, 6)) for __ in range(rand.choice([0, 0, 1, 3, 8]))]
+        t = ' '.join(rand.sample(tags, rand.choice([0, 0, 1, 2, 3])))
+        yield dict(datetime=dt, title='title %d' % i, tags=t, text=text, formats=formats)
+
+
+def make_book(path, count, nikki=None, seed=0, words=(20, 400)):
+    """Create a synthetic diary book that contains count diaries (see make_diaries).
+    Return a connected Nikki object (the given one if any)."""
+    if nikki is None:
+        db.Nikki._instance = None
+        nikki = db.Nikki()
+    nikki.connect(path)
+    nikki.import_many(make_diaries(count, seed, words))
+    return nikki
+
+
+def timeit(func, repeat=3):
+    """Return the best wall time of several runs."""
+    best = None
+    for __ in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def make_format_table(nikki):
+    """Create table TextFormat (one row per format run, used before formats are
+    packed) from packed formats, for legacy functions to compare with."""
+    if nikki._exe("SELECT name FROM sqlite_master WHERE name='TextFormat'").fetchone():
+        return
+    nikki._conn.executescript('''
+CREATE TABLE TextFormat
+    (nikkiid INTEGER NOT NULL REFERENCES Nikki(id) ON DELETE CASCADE,
+     start INTEGER NOT NULL, length INTEGER NOT NULL, type INTEGER NOT NULL);
+CREATE INDEX TextFormat_nikkiid_idx ON TextFormat(nikkiid);''')
+    nikki._conn.executemany('INSERT INTO TextFormat VALUES(?,?,?,?)', (
+        (r[0],) + f for r in nikki._exe('SELECT id, formats FROM Nikki')
+        for f in db.unpack_formats(r[1])))
+    nikki._commit()
+
+
+def legacy_sorted(nikki, order, reverse=True):
+    """The per-diary hydration used before bulk hydration, kept for comparison.
+    Call make_format_table first."""
+    exe = nikki._exe
+    order = order.replace('length', 'LENGTH(text)')
+    for r in exe('SELECT * FROM Nikki ORDER BY ' + order + (' DESC' if reverse else '')):
+        tags_id = exe('SELECT tagid FROM Nikki_Tags WHERE nikkiid=?', (r[0],))
+        tags = ' '.join(exe('SELECT name FROM Tags WHERE id = ?', (i[0],)).fetchone()[0]
+                        for i in tags_id)
+        formats = list(exe('SELECT start,length,type FROM TextFormat WHERE nikkiid=?',
+                           (r[0],)))
+        yield dict(id=r[0], title=r[3], datetime=r[1], text=r[2],
+                   tags=tags, formats=formats)
+
+
+def drop_page_cache(path):
+    """Evict the database file (and its WAL files) from page cache of OS, so that
+    the next open reads from disk. Only works on Linux, do nothing elsewhere."""
+    if not hasattr(os, 'posix_fadvise'): return
+    for p in [path, path + '-wal', path + '-shm']:
+        if not os.path.exists(p): continue
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.fsync(fd)  # dirty pages can't be dropped
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_connect(nikki, args):
+    """Open the book as the GUI does at startup (connect, then count diaries for
+    the log) with warm and cold page cache. 'probe fts' adds what every connect
+    did before the fast path: creating a FTS5 table to check availability."""
+    path = nikki.getpath()
+    nikki.disconnect()
+
+    def probe():
+        nikki.connect(path)
+        nikki._exe("CREATE VIRTUAL TABLE temp.FtsProbe USING fts5(a, tokenize='trigram')")
+        nikki._exe('DROP TABLE temp.FtsProbe')
+
+    tests = [('fast path', lambda: nikki.connect(path)), ('probe fts', probe),
+             ('fast path+count', lambda: (nikki.connect(path), len(nikki)))]
+    print('%-16s %10s %10s' % ('open', 'warm(ms)', 'cold(ms)'))
+    for name, func in tests:
+        warm = cold = None
+        for __ in range(5):
+            t = timeit(func, repeat=1)
+            nikki.disconnect()
+            warm = t if warm is None else min(warm, t)
+            drop_page_cache(path)
+            t = timeit(func, repeat=1)
+            nikki.disconnect()
+            cold = t if cold is None else min(cold, t)
+        print('%-16s %10.2f %10.2f' % (name, warm * 1000, cold * 1000))
+    nikki.connect(path)
+
+
+def bench_hydration(nikki, args):
+    make_format_table(nikki)
+    for name, func in [('legacy per-row', lambda: legacy_sorted(nikki, 'datetime')),
+                       ('bulk', lambda: nikki.sorted('datetime'))]:
+        t = timeit(lambda: sum(1 for __ in func()), repeat=1)
+        print('%-16s %8.3f sec  %10.0f diaries/sec' % (name, t, args.n / t))
+
+
+def bench_import(nikki, args):
+    """Import into empty books, diaries are generated before timing."""
+    diaries = list(make_diaries(args.n, seed=1))
+    nikki.disconnect()
+
+    def save_each():
+        for d in diaries:
+            nikki.save(-1, batch=True, **d)
+        nikki._commit()
+
+    for name, func in [('save per diary', save_each),
+                       ('import_many', lambda: nikki.import_many(diaries))]:
+        path = os.path.join(args.tmp_dir, 'import.db')
+        nikki.connect(path)
+        t = timeit(func, repeat=1)
+        nikki.disconnect()
+        os.remove(path)
+        print('%-16s %8.3f sec  %10.0f diaries/sec' % (name, t, args.n / t))
+    nikki.connect(os.path.join(args.tmp_dir, 'bench.db'))
+
+
+def bench_export(nikki, args):
+    from hazama.exporter import Exporter, default_tpl
+    path = os.path.join(args.tmp_dir, 'export')
+    make_format_table(nikki)
+
+    def legacy():
+        with open(path, 'w', encoding='utf-8') as f:
+            for d in legacy_sorted(nikki, 'datetime', reverse=False):
+                f.write(default_tpl.format(**d))
+
+    tests = [('legacy txt', legacy)] + [
+        (fmt, lambda fmt=fmt: Exporter(nikki, path, fmt).run())
+        for fmt in ['txt', 'jsonl', 'md', 'html']]
+    for name, func in tests:
+        t = timeit(func, repeat=1)
+        print('%-16s %8.3f sec  %10.0f diaries/sec' % (name, t, args.n / t))
+
+
+def bench_save(nikki, args):
+    """Latency of saving (with commit) one diary, half new and half updated."""
+    profiles = [
+        ('delete/full', dict(journal_mode='delete', synchronous='full')),
+        ('delete/normal', dict(journal_mode='delete', synchronous='normal')),
+        ('wal/full', dict(journal_mode='wal', synchronous='full')),
+        ('wal/normal', dict(journal_mode='wal', synchronous='normal')),
+        ('wal/normal+mmap', dict(journal_mode='wal', synchronous='normal',
+                                 mmap_size=256 * 1024 * 1024, temp_store='memory')),
+        ('wal/off', dict(journal_mode='wal', synchronous='off')),
+    ]
+    diaries = list(make_diaries(200, seed=2))
+    print('%-16s %10s %10s %10s' % ('profile', 'mean(ms)', 'p95(ms)', 'max(ms)'))
+    for name, profile in profiles:
+        nikki.connect(nikki.getpath(), profile)
+        times = []
+        for i, d in enumerate(diaries):
+            t = time.perf_counter()
+            nikki.save(-1 if i % 2 else i + 1, **d)
+            times.append((time.perf_counter() - t) * 1000)
+        times.sort()
+        print('%-16s %10.2f %10.2f %10.2f' % (name, sum(times) / len(times),
+                                             times[int(len(times) * 0.95)], times[-1]))
+
+
+def bench_formats(nikki, args):
+    """Save a long diary with many formats again after changing a few of them."""
+    make_format_table(nikki)
+
+    def legacy_save(id_, formats):
+        nikki._exe('UPDATE Nikki SET datetime=?, text=?, title=?, length=? WHERE id=?',
+                   ('2016-01-01 12:00', text, '', len(text), id_))
+        nikki._exe('DELETE FROM TextFormat WHERE nikkiid=?', (id_,))
+        for i in formats:
+            nikki._exe('INSERT INTO TextFormat VALUES(?,?,?,?)', (id_,) + i)
+        nikki._commit()
+
+    rand = random.Random(3)
+    text = 'x' * (args.n * 20)
+    # fragments as NTextDocument.getFormats emits, runs split by other types
+    formats = [(i * 20 + j * 5, 5, rand.randrange(1, 6)) for i in range(args.n) for j in range(4)]
+    id_ = nikki.save(-1, '2016-01-01 12:00', '', '', text, formats)
+    for name, func in [('legacy', lambda: legacy_save(id_, formats)),
+                       ('packed', lambda: nikki.save(id_, '2016-01-01 12:00', '', None, text,
+                                                     formats[:-8] + [(0, 1, 1)]))]:
+        t = timeit(func)
+        print('%-16s %8.2f ms' % (name, t * 1000))
+
+
+def bench_packing(nikki, args):
+    """Load formats of all diaries from TextFormat table and from packed blobs,
+    a quarter of diaries are heavily formatted."""
+    rand = random.Random(4)
+    heavy = []
+    for id_, length in nikki._exe('SELECT id, length FROM Nikki WHERE id % 4 = 0').fetchall():
+        formats = db.normalize_formats(
+            (rand.randrange(length), rand.randrange(1, 20), rand.randrange(1, 6))
+            for __ in range(rand.randrange(50, 300)))
+        heavy.append((db.pack_formats(formats), id_))
+    nikki._conn.executemany('UPDATE Nikki SET formats=? WHERE id=?', heavy)
+    nikki._commit()
+    make_format_table(nikki)
+    ids = [r[0] for r in nikki._exe('SELECT id FROM Nikki')]
+    print('rows: %d in TextFormat, %d blobs (%.1f MB)' % (
+        nikki._exe('SELECT COUNT(*) FROM TextFormat').fetchone()[0],
+        nikki._exe('SELECT COUNT(formats) FROM Nikki').fetchone()[0],
+        nikki._exe('SELECT SUM(LENGTH(formats)) FROM Nikki').fetchone()[0] / 1e6))
+
+    def load_table():
+        ret = {}
+        for chunk in db._chunks(ids, db.HYDRATE_CHUNK_SIZE):
+            cmd = ('SELECT nikkiid,start,length,type FROM TextFormat WHERE nikkiid IN (%s)'
+                   % ','.join('?' * len(chunk)))
+            for nikki_id, *fmt in nikki._exe(cmd, chunk):
+                ret.setdefault(nikki_id, []).append(tuple(fmt))
+        return ret
+
+    def load_blobs(unpack):
+        ret = {}
+        for chunk in db._chunks(ids, db.HYDRATE_CHUNK_SIZE):
+            cmd = 'SELECT id, formats FROM Nikki WHERE id IN (%s)' % ','.join('?' * len(chunk))
+            ret.update((r[0], unpack(r[1])) for r in nikki._exe(cmd, chunk))
+        return ret
+
+    print('%-16s %10s %10s' % ('storage', 'load(sec)', 'memory(MB)'))
+    for name, func in [('table', load_table),
+                       ('blob unpacked', lambda: load_blobs(db.unpack_formats)),
+                       ('blob kept', lambda: load_blobs(lambda x: x))]:
+        t = timeit(func)
+        tracemalloc.start()
+        result = func()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+        print('%-16s %10.3f %10.1f' % (name, t, size / 1e6))
+
+
+benchmarks = {
+    'packing': (bench_packing, 50000),
+    'formats': (bench_formats, 2000),
+    'save': (bench_save, 10000),
+    'export': (bench_export, 100000),
+    'import': (bench_import, 100000),
+    'hydration': (bench_hydration, 50000),
+    'connect': (bench_connect, 100000),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmark', choices=sorted(benchmarks))
+    parser.add_argument('-n', type=int, help='number of diaries in synthetic book')
+    args = parser.parse_args()
+    func, default_n = benchmarks[args.benchmark]
+    args.n = args.n or default_n
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        t = time.perf_counter()
+        nikki = make_book(os.path.join(tmp_dir, 'bench.db'), args.n)
+        print('synthetic book with %d diaries built in %.1f sec' %
+              (args.n, time.perf_counter() - t))
+        args.tmp_dir = tmp_dir
+        func(nikki, args)
+        nikki.disconnect()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
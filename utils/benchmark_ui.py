@@ -0,0 +1,146 @@
+"""Benchmarks of UI layer, run with a synthetic diary book. Requires PySide and
+compiled Qt files (./setup.py build_qt).
+
+Usage: python3 utils/benchmark_ui.py <benchmark> [-n DIARIES [DIARIES ...]]"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path[0] = os.path.join(os.path.dirname(__file__), os.pardir)
+from hazama import config
+from utils.benchmark_db import make_book
+
+
+class PaintSpy:
+    """Record the time when widget painted with rows for the first time."""
+    def __init__(self, view, start):
+        from PySide.QtCore import QObject, QEvent
+
+        class Filter(QObject):
+            def eventFilter(self_, obj, event):
+                if (self.firstPaint is None and event.type() == QEvent.Paint and
+                        view.model().rowCount()):
+                    self.firstPaint = time.perf_counter() - start
+                return False
+
+        self.firstPaint = None
+        self._filter = Filter()
+        view.viewport().installEventFilter(self._filter)
+
+
+def load_list(app, lazy):
+    """Create a NikkiList and load all diaries into it, return (list, spy)."""
+    from PySide.QtCore import QEventLoop
+    from hazama.ui.listview import NikkiList
+    config.settings['Main']['lazyLoad'] = str(lazy)
+    start = time.perf_counter()
+    nList = NikkiList()
+    nList.resize(500, 700)
+    nList.show()
+    spy = PaintSpy(nList, start)
+    nList.load()
+    while nList.originModel.isLoading():  # rows arrive through queued signals
+        app.processEvents(QEventLoop.WaitForMoreEvents)
+    app.processEvents()
+    spy.total = time.perf_counter() - start
+    return nList, spy
+
+
+def bench_load(app, args):
+    print('%8s %6s %16s %12s %14s' % ('diaries', 'lazy', 'first paint(s)',
+                                      'load(s)', 'memory(MB)'))
+    for n in args.n:
+        path = os.path.join(args.tmp_dir, 'bench%d.db' % n)
+        make_book(path, n, config.nikki)
+        for lazy in (False, True):
+            nList, spy = load_list(app, lazy)
+            nList.close()
+            nList.deleteLater()
+            app.processEvents()
+            # measure memory in a separated run, tracing slows down loading
+            tracemalloc.start()
+            nList, __ = load_list(app, lazy)
+            mem = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+            tracemalloc.stop()
+            nList.close()
+            nList.deleteLater()
+            app.processEvents()
+            print('%8d %6s %16.3f %12.3f %14.1f' % (n, lazy, spy.firstPaint or -1,
+                                                    spy.total, mem))
+
+
+def bench_paint(app, args):
+    """Repaint a list of long diaries (about 50KB each) with pixmap cache dropped,
+    so that every paint lays out text."""
+    make_book(os.path.join(args.tmp_dir, 'bench.db'), args.n[0], config.nikki,
+              words=(6000, 7000))
+    nList, __ = load_list(app, lazy=False)
+    for cut in (False, True):
+        if cut:
+            nList._setPreviewLimit()
+        else:
+            nList.originModel.setPreviewLimit(None, None)
+        start = time.perf_counter()
+        for __ in range(20):
+            nList._delegate.cache.clear()
+            nList.viewport().repaint()
+        print('preview cut %-5s %8.1f ms per repaint' %
+              (cut, (time.perf_counter() - start) / 20 * 1000))
+
+
+def bench_rows(app, args):
+    """Memory of rows of NikkiModel with light columns (as in lazy mode), kept as
+    lists (used before) and by columns in NikkiRows."""
+    from hazama.ui.listmodel import NikkiRows
+
+    def columns(rows):
+        store = NikkiRows()
+        store.extend(rows)
+        return store
+
+    print('%8s %14s %14s' % ('diaries', 'lists(MB)', 'NikkiRows(MB)'))
+    for n in args.n:
+        make_book(os.path.join(args.tmp_dir, 'bench%d.db' % n), n, config.nikki,
+                  words=(20, 40))
+        mem = []
+        for store in (list, columns):
+            tracemalloc.start()
+            rows = store([[d['id'], d['datetime'], None, d['title'], d['tags'], None,
+                           d['length']] for d in config.nikki.sorted('datetime', light=True)])
+            mem.append(tracemalloc.get_traced_memory()[0] / 1024 / 1024)
+            tracemalloc.stop()
+            del rows
+        print('%8d %14.1f %14.1f' % (n, *mem))
+
+
+benchmarks = {
+    'load': (bench_load, [10000, 50000, 100000]),
+    'paint': (bench_paint, [50]),
+    'rows': (bench_rows, [10000, 100000]),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmark', choices=sorted(benchmarks))
+    parser.add_argument('-n', type=int, nargs='+', help='number of diaries in synthetic book')
+    args = parser.parse_args()
+    func, default_n = benchmarks[args.benchmark]
+    args.n = args.n or default_n
+
+    from hazama import ui
+    app = ui.init()
+    args.tmp_dir = tempfile.mkdtemp()
+    try:
+        func(app, args)
+        config.nikki.disconnect()
+    finally:
+        shutil.rmtree(args.tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,542 @@
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from datetime import date, timedelta
+from hazama import db
+
+
+class NikkiTestCase(unittest.TestCase):
+    """Base class that provides an empty diary book in a temporary directory."""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'test.db')
+        db.Nikki._instance = None
+        self.nikki = db.Nikki(self.db_path)
+
+    def tearDown(self):
+        self.nikki.disconnect()
+        db.Nikki._instance = None
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, datetime='2016-01-01 12:00', title='', tags='', text='text',
+            formats=None):
+        return self.nikki.save(-1, datetime, title, tags, text, formats)
+
+
+class HydrationTest(NikkiTestCase):
+    def test_same_shape(self):
+        id1 = self.add(title='one', tags='b a', text='hello world',
+                       formats=[(0, 5, 1), (6, 5, 2)])
+        id2 = self.add(datetime='2016-01-02 12:00', text='no tags')
+        result = list(self.nikki.sorted('datetime', reverse=False))
+        self.assertEqual(result, [
+            dict(id=id1, datetime='2016-01-01 12:00', title='one', tags='b a',
+                 text='hello world', formats=[(0, 5, 1), (6, 5, 2)]),
+            dict(id=id2, datetime='2016-01-02 12:00', title='', tags='',
+                 text='no tags', formats=[])])
+        self.assertEqual(self.nikki[id1], result[0])
+        self.assertRaises(IndexError, self.nikki.__getitem__, 999)
+
+    def test_light(self):
+        id1 = self.add(title='one', tags='a', text='hello', formats=[(0, 5, 1)])
+        id2 = self.add(datetime='2016-01-02 12:00', text='no tags')
+        result = list(self.nikki.sorted('datetime', reverse=True, light=True))
+        self.assertEqual(result, [
+            dict(id=id2, datetime='2016-01-02 12:00', title='', tags='', length=7),
+            dict(id=id1, datetime='2016-01-01 12:00', title='one', tags='a', length=5)])
+        self.assertEqual(self.nikki.getbodies([id1, id2, 999]),
+                         {id1: ('hello', [(0, 5, 1)]), id2: ('no tags', [])})
+
+    def test_selected_ids(self):
+        ids = [self.add(title=str(i)) for i in range(4)]
+        reader = self.nikki.reader()
+        a = reader.sorted('title', False, ids=[ids[0], ids[2], 999])
+        b = reader.sorted('title', False, ids=ids[1:2])
+        self.assertEqual([d['title'] for d in a], ['0', '2'])  # run at the same time
+        self.assertEqual([d['title'] for d in b], ['1'])
+        self.assertFalse(reader._conn.in_transaction)
+        reader.disconnect()
+
+    def test_many_chunks(self):
+        count = db.HYDRATE_CHUNK_SIZE * 2 + 7
+        for i in range(count):
+            self.nikki.save(-1, '2016-01-01 12:00', str(i), 't%d' % (i % 3), 'x' * i,
+                            [(0, 1, i % 5 + 1)], batch=True)
+        self.nikki._commit()
+        diaries = list(self.nikki)
+        self.assertEqual(len(diaries), count)
+        for i, d in enumerate(diaries):
+            self.assertEqual(d['title'], str(i))
+            self.assertEqual(d['tags'], 't%d' % (i % 3))
+            self.assertEqual(d['formats'], [(0, 1, i % 5 + 1)])
+
+
+class MigrationTest(NikkiTestCase):
+    def query_plan(self, sql, *args):
+        return ' | '.join(r[3] for r in self.nikki._exe('EXPLAIN QUERY PLAN ' + sql, args))
+
+    def test_upgrade_from_version_0(self):
+        self.nikki.disconnect()
+        os.remove(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(db.schema)
+        conn.execute("INSERT INTO Nikki VALUES(1, '2016-01-01 12:00', 'abc', '')")
+        conn.execute("INSERT INTO Nikki VALUES(2, '2016-01-02 12:00', 'abcdef', '')")
+        conn.executemany('INSERT INTO TextFormat VALUES(2,?,?,?)',
+                         [(3, 2, 2), (0, 2, 1), (2, 1, 1)])
+        conn.commit()
+        conn.close()
+
+        self.nikki.connect(self.db_path)
+        self.assertEqual(self.nikki._exe('PRAGMA user_version').fetchone()[0],
+                         db.SCHEMA_VERSION)
+        self.assertEqual(self.nikki._exe('SELECT length FROM Nikki').fetchone()[0], 3)
+        self.assertEqual([d['formats'] for d in self.nikki],
+                         [[], [(0, 3, 1), (3, 2, 2)]])
+        self.assertEqual(self.nikki.getdaystats(2016), {(1, 1): (1, 3), (1, 2): (1, 6)})
+        self.assertIsNone(self.nikki._exe("SELECT name FROM sqlite_master "
+                                          "WHERE name='TextFormat'").fetchone())
+        # connecting again will not run migrations twice
+        self.nikki.connect(self.db_path)
+        self.assertEqual(len(self.nikki), 2)
+
+    def test_current_no_ddl(self):
+        self.nikki.disconnect()
+        statements, connect = [], sqlite3.connect
+
+        def traced_connect(*args, **kwargs):
+            conn = connect(*args, **kwargs)
+            conn.set_trace_callback(statements.append)
+            return conn
+        with mock.patch.object(db.sqlite3, 'connect', traced_connect):
+            self.nikki.connect(self.db_path)
+        self.assertTrue(self.nikki._fts)
+        self.assertTrue(statements)
+        for i in statements:
+            self.assertNotRegex(i.upper(), r'CREATE|DROP|ALTER|BEGIN')
+
+    def test_newer_version(self):
+        self.nikki._exe('PRAGMA user_version = %d' % (db.SCHEMA_VERSION + 1))
+        self.nikki._commit()
+        self.assertRaises(db.DatabaseError, self.nikki.connect, self.db_path)
+
+    def test_sort_use_index(self):
+        for order in ['datetime', 'title', 'length']:
+            plan = self.query_plan('SELECT * FROM Nikki ORDER BY %s DESC' % order)
+            self.assertIn('USING INDEX Nikki_%s_idx' % order, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_lookup_use_index(self):
+        plan = self.query_plan('SELECT nikkiid FROM Nikki_Tags WHERE tagid=?', 1)
+        self.assertIn('Nikki_Tags_tagid_idx', plan)
+
+    def test_tag_filter_use_index(self):
+        plan = self.query_plan('SELECT nikkiid FROM Nikki_Tags WHERE '
+                               'tagid=(SELECT id FROM Tags WHERE name=?)', 'a')
+        self.assertIn('SEARCH Nikki_Tags USING INDEX Nikki_Tags_tagid_idx', plan)
+        self.assertIn('SEARCH Tags USING COVERING INDEX', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_chunk_tags_use_index(self):
+        plan = self.query_plan(db.sql_chunk_tags % '?,?', 1, 2)
+        self.assertIn('SEARCH Nikki_Tags USING COVERING INDEX', plan)
+        self.assertIn('SEARCH Tags USING INTEGER PRIMARY KEY', plan)
+        self.assertNotIn('SCAN Nikki_Tags', plan)
+
+    def test_selected_ids_use_primary_key(self):
+        plan = self.query_plan('SELECT id FROM Nikki WHERE id IN '
+                               '(SELECT value FROM json_each(?)) ORDER BY datetime', '[1]')
+        self.assertIn('SEARCH Nikki USING INTEGER PRIMARY KEY', plan)
+        self.assertNotIn('SCAN Nikki', plan)
+
+    def test_datetime_range_use_index(self):
+        plan = self.query_plan('SELECT min(datetime), max(datetime) FROM Nikki')
+        self.assertIn('COVERING INDEX Nikki_datetime_idx', plan)
+
+    def test_daystats_use_primary_key(self):
+        plan = self.query_plan('SELECT count, length FROM DayStats '
+                               'WHERE day >= ? AND day < ?', '2016-', '2017-')
+        self.assertIn('SEARCH DayStats USING PRIMARY KEY', plan)
+
+    def test_stored_length(self):
+        id_ = self.add(text='abc')
+        self.nikki.save(id_, '2016-01-01 12:00', '', None, 'abcdef', None)
+        self.assertEqual(self.nikki._exe('SELECT length FROM Nikki').fetchone()[0], 6)
+
+
+class TagCountTest(NikkiTestCase):
+    def counts(self):
+        return dict(self.nikki.gettags(getcount=True))
+
+    def test_counts(self):
+        id1 = self.add(tags='a b')
+        id2 = self.add(tags='b c c')
+        self.assertEqual(self.counts(), {'a': 1, 'b': 2, 'c': 1})
+        self.nikki.save(id1, '2016-01-01 12:00', '', 'b d', 'text', None)
+        self.assertEqual(self.counts(), {'b': 2, 'c': 1, 'd': 1})
+        self.assertEqual(self.nikki[id1]['tags'], 'b d')
+        self.nikki.delete(id2)
+        self.assertEqual(self.counts(), {'b': 1, 'd': 1})
+        self.nikki.save(id1, '2016-01-01 12:00', '', '', 'text', None)
+        self.assertEqual(self.counts(), {})
+
+    def test_tagged(self):
+        id1 = self.add(tags='a b')
+        id2 = self.add(tags='b')
+        self.assertEqual(sorted(self.nikki.gettagged('b')), [id1, id2])
+        self.assertEqual(self.nikki.gettagged('a'), [id1])
+        self.assertEqual(self.nikki.gettagged('none'), [])
+
+    def test_unchanged_tags_keep_id(self):
+        id1 = self.add(tags='a b')
+        tag_id = self.nikki._gettagid('a')
+        self.nikki.save(id1, '2016-01-01 12:00', '', 'a c', 'text', None)
+        self.assertEqual(self.nikki._gettagid('a'), tag_id)
+
+    def test_upgrade_counts(self):
+        self.nikki.disconnect()
+        os.remove(self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(db.schema + db.migrations[0] + 'PRAGMA user_version = 1;')
+        conn.executescript('''
+            INSERT INTO Nikki VALUES(1, '2016-01-01 12:00', 'abc', '', 3);
+            INSERT INTO Nikki VALUES(2, '2016-01-01 12:00', 'abc', '', 3);
+            INSERT INTO Tags VALUES(1, 'a'), (2, 'b'), (3, 'orphan');
+            INSERT INTO Nikki_Tags VALUES(1, 1), (2, 1), (2, 2);''')
+        conn.close()
+        self.nikki.connect(self.db_path)
+        self.assertEqual(self.counts(), {'a': 2, 'b': 1})
+
+
+class ReaderTest(NikkiTestCase):
+    def test_second_instance_locked(self):
+        db.Nikki._instance = None
+        with self.assertRaises(db.DatabaseLockedError):
+            db.Nikki(self.db_path)
+        db.Nikki._instance = self.nikki
+        self.nikki.disconnect()
+        db._lock_file(self.db_path + '.lock').close()  # lock released
+        self.nikki.connect(self.db_path)
+
+    def test_read_in_other_thread(self):
+        ids = [self.add(datetime='2016-01-%02d 12:00' % i, tags='a') for i in range(1, 6)]
+        reader = self.nikki.reader()
+        result = []
+        t = threading.Thread(target=lambda: result.extend(
+            i['id'] for i in reader.sorted('datetime', reverse=False, light=True)))
+        t.start()
+        t.join()
+        self.assertEqual(result, ids)
+        # writer works while reader opened
+        self.add(text='new')
+        self.assertEqual(len(reader), 6)
+        with self.assertRaises(sqlite3.OperationalError):
+            reader._exe('DELETE FROM Nikki')
+        reader.disconnect()
+        reader.connect(self.db_path)  # reopened read-only, no lock taken
+        self.assertEqual(len(reader), 6)
+        with self.assertRaises(sqlite3.OperationalError):
+            reader._exe('DELETE FROM Nikki')
+        reader.disconnect()
+        self.assertIs(db.Nikki.getinstance(), self.nikki)
+
+
+class ProfileTest(NikkiTestCase):
+    def pragma(self, name):
+        return self.nikki._exe('PRAGMA ' + name).fetchone()[0]
+
+    def test_default(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)  # normal
+        self.assertEqual(self.pragma('cache_size'), -8000)
+
+    def test_custom(self):
+        profile = dict(journal_mode='DELETE', synchronous='full', cache_size='100',
+                       temp_store='memory')
+        self.nikki.connect(self.db_path, profile)
+        self.assertEqual(self.pragma('journal_mode'), 'delete')
+        self.assertEqual(self.pragma('synchronous'), 2)
+        self.assertEqual(self.pragma('cache_size'), 100)
+        self.assertEqual(self.pragma('temp_store'), 2)
+        self.nikki.connect(self.db_path)  # profile kept
+        self.assertEqual(self.pragma('journal_mode'), 'delete')
+
+    def test_invalid(self):
+        with self.assertLogs(level='WARNING'):
+            self.nikki.connect(self.db_path, dict(synchronous='fast; DROP TABLE Nikki',
+                                                  mmap_size='1e9'))
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('mmap_size'), 0)
+        self.assertEqual(len(self.nikki), 0)
+
+    def test_locked_by_reader(self):
+        with mock.patch.object(db, 'WRITE_TIMEOUT', 0.1):
+            self.nikki.connect(self.db_path, dict(journal_mode='delete'))
+            reader = self.nikki.reader()
+        for i in range(3):
+            self.add(text=str(i))
+        rows = reader._exe('SELECT id FROM Nikki')
+        rows.fetchone()  # read transaction kept by the unfinished query
+        with self.assertRaises(sqlite3.OperationalError):
+            self.nikki.save(-1, '2016-01-02 12:00', '', 'a', 'new', None)
+        self.assertFalse(self.nikki._conn.in_transaction)
+        rows.close()
+        reader.disconnect()
+        self.add(text='new')  # saved again after reader finished
+        self.assertEqual([i['text'] for i in self.nikki], ['0', '1', '2', 'new'])
+
+
+class DraftTest(NikkiTestCase):
+    def test_partial_writes(self):
+        self.nikki.savedraft(-1, datetime=None, title='t', tags='a', text='hello',
+                             formats=[(0, 2, 1)])
+        self.nikki.savedraft(-1, text='hello world')
+        self.nikki.savedraft(-1, formats=None)
+        drafts = list(self.nikki.getdrafts())
+        self.assertEqual(len(drafts), 1)
+        saved = drafts[0].pop('saved')
+        self.assertTrue(saved)
+        self.assertEqual(drafts[0], dict(id=-1, title='t', tags='a',
+                                         text='hello world', formats=[]))
+        self.nikki.savedraft(-1, datetime='2016-01-01 12:00')
+        self.assertEqual(next(self.nikki.getdrafts())['datetime'], '2016-01-01 12:00')
+        self.nikki.deletedraft(-1)
+        self.assertEqual(list(self.nikki.getdrafts()), [])
+
+    def test_deleted_with_diary(self):
+        id_ = self.add()
+        self.nikki.savedraft(id_, text='draft')
+        self.assertEqual([i['text'] for i in self.nikki.getdrafts()], ['draft'])
+        self.nikki.delete(id_)
+        self.assertEqual(list(self.nikki.getdrafts()), [])
+
+
+class FormatTest(NikkiTestCase):
+    def test_normalize(self):
+        # output of NTextDocument.getFormats in richtagparser_test
+        formats = [(0, 2, 1), (0, 2, 2), (0, 2, 3), (2, 3, 3), (5, 5, 3),
+                   (5, 5, 4), (10, 10, 4), (35, 2, 5)]
+        self.assertEqual(db.normalize_formats(formats),
+                         [(0, 2, 1), (0, 2, 2), (0, 10, 3), (5, 15, 4), (35, 2, 5)])
+        self.assertEqual(db.normalize_formats([(3, 4, 1), (0, 5, 1), (9, 0, 2), (7, 1, 1)]),
+                         [(0, 8, 1)])
+
+    def test_pack(self):
+        formats = [(0, 2, 1), (5, 70000, 5), (2 ** 32 - 1, 1, 3)]
+        blob = db.pack_formats(formats)
+        self.assertEqual(len(blob), 12 * len(formats))
+        self.assertEqual(db.unpack_formats(blob), formats)
+        self.assertIsNone(db.pack_formats([]))
+        self.assertEqual(db.unpack_formats(None), [])
+
+    def test_save(self):
+        id_ = self.add(text='x' * 100, formats=[(0, 2, 1), (2, 3, 1), (10, 5, 2)])
+        self.assertEqual(self.nikki[id_]['formats'], [(0, 5, 1), (10, 5, 2)])
+        self.assertEqual(next(self.nikki.sorted('datetime', packed=True))['formats'],
+                         db.pack_formats([(0, 5, 1), (10, 5, 2)]))
+        self.assertEqual(self.nikki.getbodies([id_], packed=True)[id_][1],
+                         db.pack_formats([(0, 5, 1), (10, 5, 2)]))
+        self.nikki.save(id_, '2016-01-01 12:00', '', None, 'x', None)
+        self.assertIsNone(self.nikki._exe('SELECT formats FROM Nikki').fetchone()[0])
+
+
+class DayStatsTest(NikkiTestCase):
+    def test_group_by_day(self):
+        self.add(datetime='2016-03-01 08:00', text='abc')
+        self.add(datetime='2016-03-01 23:00', text='de')
+        self.add(datetime='2016-12-31 12:00', text='f')
+        self.add(datetime='2017-01-01 00:00', text='g')
+        self.assertEqual(self.nikki.getdaystats(2016), {(3, 1): (2, 5), (12, 31): (1, 1)})
+        self.assertEqual(self.nikki.getdaystats(2015), {})
+
+    def test_kept_by_triggers(self):
+        id1 = self.add(datetime='2016-03-01 08:00', text='abc')
+        id2 = self.add(datetime='2016-03-01 09:00', text='de')
+        self.nikki.save(id1, '2016-03-02 08:00', '', None, 'abcd', None)
+        self.nikki.delete(id2)
+        self.nikki.import_many([dict(datetime='2016-03-02 10:00', title='', tags='',
+                                     text='x'),
+                                dict(datetime='2016-03-05 10:00', title='', tags='',
+                                     text='xy')])
+        expected = self.nikki._exe('SELECT substr(datetime, 1, 10), COUNT(*), SUM(length) '
+                                   'FROM Nikki GROUP BY 1').fetchall()
+        self.assertEqual(self.nikki._exe('SELECT * FROM DayStats').fetchall(), expected)
+        self.assertEqual(self.nikki.getdaystats(2016), {(3, 2): (2, 5), (3, 5): (1, 2)})
+        self.assertEqual(len(self.nikki), 3)
+        for id_ in [r[0] for r in self.nikki._exe('SELECT id FROM Nikki')]:
+            self.nikki.delete(id_)
+        self.assertEqual(len(self.nikki), 0)
+
+
+class SearchTest(NikkiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.id1 = self.add(title='Trip', text='Went to the Mountain 50%')
+        self.id2 = self.add(datetime='2017-05-01 08:00', text='mountain mountain')
+        self.id3 = self.add(text='nothing here')
+
+    def test_fts(self):
+        self.assertTrue(self.nikki._fts)
+        self.assertEqual(set(self.nikki.search('MOUNTAIN')), {self.id1, self.id2})
+        self.assertEqual(self.nikki.search('trip'), [self.id1])
+        self.assertEqual(self.nikki.search('2017-05'), [self.id2])
+        self.assertEqual(self.nikki.search('"OR'), [])
+        plan = ' '.join(r[3] for r in self.nikki._exe(
+            'EXPLAIN QUERY PLAN SELECT rowid FROM NikkiFts WHERE NikkiFts MATCH ?', ('a',)))
+        self.assertIn('VIRTUAL TABLE INDEX', plan)
+
+    def test_index_synced(self):
+        self.nikki.save(self.id3, '2016-01-01 12:00', '', None, 'a mountain', None)
+        self.nikki.delete(self.id1)
+        self.assertEqual(set(self.nikki.search('mountain')), {self.id2, self.id3})
+        self.assertEqual(self.nikki.search('nothing'), [])
+
+    def test_short_query(self):
+        self.assertEqual(self.nikki.search('0%'), [self.id1])
+        self.assertEqual(set(self.nikki.search('mo')), {self.id1, self.id2})
+
+    def test_fallback(self):
+        self.nikki._fts = False
+        self.assertEqual(set(self.nikki.search('Mountain')), {self.id1, self.id2})
+
+    def test_rebuild(self):
+        self.nikki._exe('DROP TRIGGER nikki_fts_ins')
+        self.nikki._exe("INSERT INTO Nikki VALUES(NULL, '2016-01-01 12:00', "
+                        "'unindexed', '', 9, NULL)")
+        self.nikki._commit()
+        self.nikki.connect(self.db_path)
+        self.assertEqual(len(self.nikki.search('unindexed')), 1)
+
+
+class ImportTest(NikkiTestCase):
+    def test_same_as_save(self):
+        old = self.add(tags='a', text='old')
+        diaries = [dict(datetime='2016-01-02 12:00', title='t1', tags='a b b',
+                        text='mountain', formats=[(0, 2, 1)]),
+                   dict(datetime='2016-01-03 12:00', title='t2', tags='',
+                        text='nothing')]
+        self.assertEqual(self.nikki.import_many(iter(diaries)), 2)
+        result = list(self.nikki.sorted('datetime', reverse=False))
+        self.assertEqual([i['id'] for i in result], [old, old+1, old+2])
+        self.assertEqual(result[1], dict(id=old+1, title='t1', datetime='2016-01-02 12:00',
+                                         text='mountain', tags='a b', formats=[(0, 2, 1)]))
+        self.assertEqual(dict(self.nikki.gettags(getcount=True)), {'a': 2, 'b': 1})
+        self.assertEqual(self.nikki.search('mountain'), [old+1])
+        # triggers restored
+        self.nikki.delete(old+1)
+        self.assertEqual(dict(self.nikki.gettags(getcount=True)), {'a': 1})
+        self.assertEqual(self.nikki.search('mountain'), [])
+
+    def test_rollback(self):
+        self.add()
+        diaries = [dict(datetime='2016-01-02 12:00', title='', tags='x', text='a'),
+                   dict(datetime='2016-01-02 12:00', title='', tags='')]  # no text
+        with self.assertRaises(KeyError):
+            self.nikki.import_many(diaries)
+        self.assertEqual(len(self.nikki), 1)
+        self.assertEqual(list(self.nikki.gettags()), [])
+        count = self.nikki._exe("SELECT COUNT(*) FROM sqlite_master WHERE type='trigger'")
+        self.assertEqual(count.fetchone()[0], 8)
+
+
+class BackupTest(NikkiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)  # backups are under CWD
+        self.id1 = self.add(tags='a', text='first')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        super().tearDown()
+
+    def test_backup_and_restore(self):
+        for compress in db.backup_compressors:
+            with self.subTest(compress=compress):
+                shutil.rmtree(db.backup_dir, ignore_errors=True)
+                reports = []
+                self.assertTrue(db.backup(compress, lambda *args: reports.append(args)))
+                self.assertFalse(db.backup(compress))  # once a day
+                self.assertEqual(reports[-1][0], reports[-1][1])
+                name = '%s_1.db%s' % (date.today(), db.backup_compressors[compress][1])
+                self.assertEqual(db.list_backups(), [name])
+
+                self.nikki.delete(self.id1)
+                self.add(text='second')
+                db.restore_backup(name)
+                self.nikki.connect(self.db_path)
+                self.assertEqual([i['text'] for i in self.nikki], ['first'])
+                self.assertEqual(self.nikki.search('first'), [self.id1])
+
+    def test_no_wal_files(self):
+        for kwargs in [dict(compress=i) for i in db.backup_compressors] + [dict(dedup=True)]:
+            with self.subTest(**kwargs):
+                shutil.rmtree(db.backup_dir, ignore_errors=True)
+                db.backup(**kwargs)
+                db.restore_backup(db.list_backups()[-1])
+                self.nikki.connect(self.db_path)
+                files = [f for __, __, files in os.walk(db.backup_dir) for f in files]
+                self.assertFalse([f for f in files if f.endswith(('-wal', '-shm'))])
+
+    def test_legacy_and_old(self):
+        os.mkdir(db.backup_dir)
+        old, legacy = str(date.today() - timedelta(days=8)), str(date.today() - timedelta(days=1))
+        for name in [old + '_3.db', legacy + '_5.db', 'other.txt']:
+            open(os.path.join(db.backup_dir, name), 'w').close()
+        self.assertEqual(db.list_backups(), [old + '_3.db', legacy + '_5.db'])
+        db.backup()
+        self.assertEqual(db.list_backups(), [legacy + '_5.db', '%s_1.db' % date.today()])
+        self.assertFalse(os.path.exists(os.path.join(db.backup_dir, old + '_3.db')))
+
+    def test_dedup(self):
+        class FakeDate(date):
+            @classmethod
+            def today(cls): return day
+        rand = random.Random(0)
+        for i in range(300):
+            self.add(text=' '.join(str(rand.random()) for __ in range(100)))
+        day, db.date = date(2016, 1, 1), FakeDate
+        try:
+            db.backup(dedup=True)
+            first = db._read_manifest()[-1]
+            self.nikki.save(self.id1, '2016-01-01 12:00', '', None, 'changed', None)
+            day = date(2016, 1, 2)
+            db.backup(dedup=True)
+            second = db._read_manifest()[-1]
+            self.assertLess(second['size'] * 5, first['size'])
+
+            db.restore_backup(first['name'])
+            self.nikki.connect(self.db_path)
+            self.assertEqual(self.nikki[self.id1]['text'], 'first')
+            chunks = sum(len(i[2]) for i in os.walk(db.backup_chunk_dir))
+            # both are expired after a year, chunks only used by them are deleted
+            day = date(2017, 1, 5)
+            db.backup(dedup=True)
+            self.assertEqual(db.list_backups(), ['2017-01-05_301.chunks'])
+            self.assertLess(sum(len(i[2]) for i in os.walk(db.backup_chunk_dir)), chunks)
+            db.restore_backup('2017-01-05_301.chunks')
+        finally:
+            db.date = date
+
+    def test_retention(self):
+        today = date(2016, 12, 31)
+        entries = [dict(date=str(today - timedelta(days=i)), compress=c)
+                   for i in range(400, -1, -1) for c in ['dedup', 'none']]
+        expired = db._expired_backups(entries, today)
+        kept = [i for i in entries if i not in expired]
+        self.assertEqual(len([i for i in kept if i['compress'] == 'none']), 8)
+        dates = [i['date'] for i in kept if i['compress'] == 'dedup']
+        self.assertEqual(dates[-8:], [str(today - timedelta(days=i)) for i in range(7, -1, -1)])
+        self.assertIn('2016-01-31', dates)  # newest of a month
+        self.assertNotIn('2016-01-30', dates)
+        self.assertNotIn('2015-12-31', dates)  # more than a year
+        self.assertTrue(9 + 8 < len(dates) < 9 + 8 + 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
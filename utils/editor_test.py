@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hazama import ui
+from hazama.config import nikki
+
+app = ui.init()
+from hazama.ui.editor import Editor  # fonts must be loaded before importing
+
+
+class EditorDraftTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        nikki.connect(os.path.join(self.tmp_dir, 'test.db'))
+        self.id1 = nikki.save(-1, '2016-01-01 12:00', 'one', 'a', 'same', None)
+        self.id2 = nikki.save(-1, '2016-01-02 12:00', 'two', 'a', 'same', None)
+
+    def tearDown(self):
+        nikki.disconnect()
+        shutil.rmtree(self.tmp_dir)
+
+    def edit(self, editor, title):
+        editor.titleEditor.setText(title)
+        editor.titleEditor.setModified(True)
+        editor.titleEditor.textEdited.emit(title)
+
+    def test_reused_for_other_diary(self):
+        e = Editor(nikki[self.id1])
+        self.edit(e, 'one changed')
+        e.saveDraft()
+        e.titleEditor.setModified(False)
+        self.edit(e, 'one changed again')  # pending draft of old diary
+        e.titleEditor.setModified(False)
+
+        e.fromNikkiDict(nikki[self.id2])
+        self.assertFalse(e._draftTimer.isActive())
+        self.edit(e, 'two changed')
+        e.saveDraft()
+        drafts = {d['id']: d for d in nikki.getdrafts()}
+        # all fields of the new diary written, though they equal the old one's
+        self.assertEqual(drafts[self.id2]['text'], 'same')
+        self.assertEqual(drafts[self.id2]['tags'], 'a')
+        self.assertEqual(drafts[self.id2]['datetime'], '2016-01-02 12:00')
+        self.assertEqual(drafts[self.id2]['title'], 'two changed')
+        e.closeNoSave()
+        e.deleteLater()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hazama import db, exporter, importer
+
+
+class TemplateTest(unittest.TestCase):
+    diary = dict(id=1, title='50%', datetime='2016-01-01 12:00', tags='a b',
+                 text='{text}', formats=[])
+
+    def test_same_as_format(self):
+        for tpl in [exporter.default_tpl, '{title}', 'no field %s', '{text:>8}|{id!r}',
+                    '{{escaped}} {title}']:
+            self.assertEqual(exporter.compile_template(tpl)(self.diary),
+                             tpl.format(**self.diary))
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            exporter.compile_template('{title} {mood}')
+
+
+class MarkupTest(unittest.TestCase):
+    def test_html(self):
+        self.assertEqual(exporter._html_text('a<b>\nbold', [(5, 4, exporter.Bold),
+                                                            (5, 2, exporter.Italic)]),
+                         'a&lt;b&gt;<br>\n<b><i>bo</i></b><b>ld</b>')
+
+    def test_markdown(self):
+        self.assertEqual(exporter._md_text('*a* bold ', [(4, 5, exporter.Bold)]),
+                         '\\*a\\* **bold** ')
+
+
+class ExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        db.Nikki._instance = None
+        self.nikki = db.Nikki(os.path.join(self.tmp_dir, 'test.db'))
+        self.diaries = [
+            dict(datetime='2016-01-0%d 12:00' % i, title='title %d' % i, tags='a',
+                 text='text %d' % i, formats=[(0, 4, exporter.Bold)]) for i in range(1, 6)]
+        self.nikki.import_many(self.diaries)
+
+    def tearDown(self):
+        self.nikki.disconnect()
+        db.Nikki._instance = None
+        shutil.rmtree(self.tmp_dir)
+
+    def export(self, fmt, ids=None, **kwargs):
+        path = os.path.join(self.tmp_dir, 'out.' + fmt)
+        e = exporter.Exporter(self.nikki, path, ids=ids, **kwargs)
+        return e, path, e.run()
+
+    def test_formats(self):
+        for fmt in exporter.writers:
+            __, path, count = self.export(fmt)
+            self.assertEqual(count, 5)
+            with open(path, encoding='utf-8') as f:
+                content = f.read()
+            self.assertEqual(content.count('title '), 5, fmt)
+
+    def test_round_trip(self):
+        for fmt, parse in [('txt', importer.parse_txt), ('jsonl', importer.parse_jsonl)]:
+            __, path, __ = self.export(fmt, ids=[2, 4, 100])
+            with open(path, encoding='utf-8') as f:
+                result = list(parse(f))
+            expected = [self.diaries[1], self.diaries[3]]
+            if fmt == 'txt':
+                expected = [dict(i, formats=None) for i in expected]
+            self.assertEqual(result, expected)
+
+    def test_progress_and_cancel(self):
+        path = os.path.join(self.tmp_dir, 'out.txt')
+        reports = []
+        e = exporter.Exporter(self.nikki, path, progress=lambda *args: reports.append(args))
+        e.PROGRESS_STEP = 2
+        self.assertEqual(e.run(), 5)
+        self.assertEqual(reports, [(2, 5), (4, 5), (5, 5)])
+
+        def cancel(exported, total):
+            e.canceled = True
+        e = exporter.Exporter(self.nikki, path, progress=cancel)
+        e.PROGRESS_STEP = 2
+        self.assertIsNone(e.run())
+        self.assertFalse(os.path.exists(path))
+        # canceled after the last check, the file is complete
+        e = exporter.Exporter(self.nikki, path, progress=cancel)
+        e.PROGRESS_STEP = 5
+        self.assertEqual(e.run(), 5)
+        self.assertTrue(os.path.exists(path))
+
+    def test_failed(self):
+        path = os.path.join(self.tmp_dir, 'out.txt')
+        diary = self.diaries[0]
+
+        class Failing:
+            def __len__(self): return 2
+
+            def sorted(self, *args, **kwargs):
+                yield diary
+                raise OSError('No space left on device')
+        with self.assertRaises(OSError):
+            exporter.Exporter(Failing(), path).run()
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import io
+import unittest
+from hazama import exporter, importer
+
+
+class ParseTest(unittest.TestCase):
+    diaries = [
+        dict(title='first', datetime='2016-01-01 12:00', tags='a b', text='line\n\nline'),
+        dict(title='**stars', datetime='2016-01-02 12:00', tags='',
+             text='********fake********\nnot a header\n\n\n'),
+        dict(title='', datetime='2016-01-03 12:00', tags='c', text=''),
+    ]
+
+    def test_txt_round_trip(self):
+        # same as the output of default template
+        f = io.StringIO(''.join(exporter.default_tpl.format(**i) for i in self.diaries))
+        self.assertEqual(list(importer.parse_txt(f)),
+                         [dict(i, formats=None) for i in self.diaries])
+
+    def test_jsonl(self):
+        f = io.StringIO('{"datetime": "2016-01-01 12:00", "text": "a", "formats": [[0, 1, 2]]}\n'
+                        '\n'
+                        '{"datetime": "2016-01-02 12:00", "title": "t", "tags": "x", "text": ""}\n')
+        self.assertEqual(list(importer.parse_jsonl(f)), [
+            dict(datetime='2016-01-01 12:00', title='', tags='', text='a', formats=[(0, 1, 2)]),
+            dict(datetime='2016-01-02 12:00', title='t', tags='x', text='', formats=[])])
+        with self.assertRaises(ValueError):
+            list(importer.parse_jsonl(io.StringIO('{"title": "no text"}\n')))
+
+
+if __name__ == '__main__':
+    unittest.main()
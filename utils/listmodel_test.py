@@ -0,0 +1,227 @@
+import os
+import shutil
+import random
+import itertools
+import tempfile
+import unittest
+from PySide.QtCore import Qt
+from hazama.config import nikki
+from hazama.ui.listmodel import NikkiModel, NikkiRows, TagModel, makePreview
+
+
+class NikkiTestCase(unittest.TestCase):
+    """Base class that connects to an empty diary book in a temporary directory."""
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        nikki.connect(os.path.join(self.tmp_dir, 'test.db'))
+
+    def tearDown(self):
+        nikki.disconnect()
+        shutil.rmtree(self.tmp_dir)
+
+
+class NikkiModelIdIndexTest(NikkiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = NikkiModel()
+
+    def add(self, text='text'):
+        return self.model.updateNikki(dict(id=-1, datetime='2016-01-01 12:00', title='',
+                                           tags=None, text=text, formats=None))
+
+    def assertIndexConsistent(self):
+        model = self.model
+        ids = [model.index(r, 0).data() for r in range(model.rowCount())]
+        for row, id_ in enumerate(ids):
+            if id_ is not None:
+                self.assertEqual(model.getRowById(id_), row)
+        self.assertEqual(len(model._idToRow), len([i for i in ids if i is not None]))
+
+    def test_mixed_inserts_and_deletes(self):
+        rand = random.Random(0)
+        fakeIds = itertools.count(10000)
+        for __ in range(30):
+            self.add()
+        for __ in range(50):
+            op = rand.randrange(3)
+            if op == 0:
+                self.add()
+            elif op == 1 and self.model.rowCount():
+                self.model.removeRow(rand.randrange(self.model.rowCount()))
+            else:
+                row = rand.randrange(self.model.rowCount() + 1)
+                self.model.insertRow(row)
+                self.model.setData(self.model.index(row, 0), next(fakeIds))
+            self.assertIndexConsistent()
+
+    def test_update_missing_row(self):
+        id_ = nikki.save(-1, '2016-01-01 12:00', '', 'a', 'text', None)  # not loaded
+        self.add()
+        stats = self.model.dayStats
+        self.assertEqual(stats.get(2016, 1, 1), (2, 8))  # counted though not loaded
+        row = self.model.updateNikki(dict(id=id_, datetime='2016-01-02 12:00', title='',
+                                          tags=None, text='changed', formats=None))
+        self.assertEqual(self.model.rowCount(), 2)
+        self.assertEqual(self.model.index(row, 0).data(), id_)
+        self.assertEqual(self.model.index(row, 4).data(), 'a')
+        self.assertIndexConsistent()
+        self.assertEqual(stats.get(2016, 1, 1), (1, 4))
+        self.assertEqual(stats.get(2016, 1, 2), (1, 7))
+        self.assertEqual(stats.get(2016), (2, 11))
+
+    def test_update_and_clear(self):
+        for __ in range(5):
+            self.add()
+        id_ = self.model.index(3, 0).data()
+        row = self.model.updateNikki(dict(id=id_, datetime='2016-01-01 12:00', title='',
+                                          tags=None, text='changed', formats=None))
+        self.assertEqual(row, 3)
+        self.assertEqual(self.model.getRowById(id_), 3)
+        self.model.clear()
+        self.assertEqual(self.model.getRowById(id_), -1)
+        self.assertIndexConsistent()
+
+
+class NikkiRowsTest(unittest.TestCase):
+    def test_same_as_lists(self):
+        rand = random.Random(0)
+        datetimes = [None, '2016-01-01 12:00', '0001-12-31 00:59', '2016-01-01',
+                     '2016-01-01 12:00:30', '2016-1-01 12:00', 'invalid']
+
+        def randRow():
+            return [rand.choice([None, rand.randrange(1, 1000)]), rand.choice(datetimes),
+                    rand.choice([None, 'text']), '', rand.choice([None, '', 'a', 'a b']),
+                    rand.choice([None, b'\0']), rand.choice([None, 0, 5])]
+
+        lists, rows = [], NikkiRows()
+        for __ in range(300):
+            op = rand.randrange(4)
+            if op == 0:
+                batch = [randRow() for __ in range(rand.randrange(1, 5))]
+                lists.extend(batch)
+                rows.extend(batch)
+            elif op == 1 and lists:
+                row, count = rand.randrange(len(lists)), rand.randrange(1, 4)
+                del lists[row:row+count]
+                rows.delete(row, count)
+            elif op == 2:
+                row, count = rand.randrange(len(lists) + 1), rand.randrange(1, 3)
+                lists[row:row] = [[None] * 7 for __ in range(count)]
+                rows.insertEmpty(row, count)
+            elif lists:
+                row, col, value = rand.randrange(len(lists)), rand.randrange(7), randRow()
+                lists[row][col] = value[col]
+                rows.set(row, col, value[col])
+            self.assertEqual([rows.row(r) for r in range(len(rows))], lists)
+
+
+class NikkiModelTagIndexTest(NikkiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = NikkiModel()
+        self.ids = [self.add(tags) for tags in ['a', 'ab', 'a ab', '']]
+
+    def add(self, tags):
+        row = self.model.updateNikki(dict(id=-1, datetime='2016-01-01 12:00', title='',
+                                          tags=tags, text='text', formats=None))
+        return self.model.index(row, 0).data()
+
+    def tagged(self, tags, matchAll=True):
+        ids = self.model.taggedIds(tags, matchAll)
+        return [i for i in self.ids if i in ids]
+
+    def test_exact_match(self):
+        a, ab, both, __ = self.ids
+        self.assertEqual(self.tagged(['a']), [a, both])  # no substring match
+        self.assertEqual(self.tagged(['ab']), [ab, both])
+        self.assertEqual(self.tagged(['a', 'ab']), [both])
+        self.assertEqual(self.tagged(['a', 'ab'], matchAll=False), [a, ab, both])
+        self.assertEqual(self.tagged(['nothing']), [])
+
+    def test_live_update(self):
+        a, ab, both, none = self.ids
+        ids = self.model.taggedIds(['a'])
+        self.model.updateNikki(dict(id=none, datetime='2016-01-01 12:00', title='',
+                                    tags='a', text='text', formats=None))
+        self.model.setData(self.model.index(self.model.getRowById(both), 4), 'ab')
+        self.model.removeRow(self.model.getRowById(a))
+        self.assertEqual([i for i in self.ids if i in ids], [none])
+        self.model.clear()
+        self.assertEqual(self.tagged(['a']), [])
+
+
+class DayStatsCacheTest(NikkiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = NikkiModel()
+
+    def save(self, id_, datetime, text):
+        row = self.model.updateNikki(dict(id=id_, datetime=datetime, title='',
+                                          tags=None, text=text, formats=None))
+        return self.model.index(row, 0).data()
+
+    def test_incremental_same_as_reload(self):
+        stats = self.model.dayStats
+        id1 = self.save(-1, '2016-03-01 08:00', 'abc')
+        self.assertEqual(stats.get(2016, 3, 1), (1, 3))  # loaded after saving
+        self.save(-1, '2016-03-01 09:00', 'de')
+        self.assertEqual(stats.get(2016, 3, 1), (2, 5))  # summed, not overwritten
+        self.save(id1, '2016-04-01 08:00', 'abcd')
+        self.model.removeRow(self.model.rowCount() - 1)
+        nikki.delete(2)
+        expected = stats.year(2016)
+        stats.clear()
+        self.assertEqual({k: v for k, v in expected.items() if v[0]}, stats.year(2016))
+        self.assertEqual(stats.get(2016, 4, 1), (1, 4))
+        self.save(-1, '2016-04-02 08:00', 'ab')
+        self.assertEqual(stats.get(2016, 4), (2, 6))
+        self.assertEqual(stats.get(2016), (2, 6))
+
+
+class TagModelTest(NikkiTestCase):
+    def setUp(self):
+        super().setUp()
+        nikki.save(-1, '2016-01-01 12:00', '', 'a b', 'text', None)
+        nikki.save(-1, '2016-01-01 12:00', '', 'b', 'text', None)
+        self.model = TagModel('All')
+        self.model.load()
+
+    def rows(self):
+        model = self.model
+        return [(model.index(r).data(), model.index(r).data(Qt.UserRole))
+                for r in range(model.rowCount())]
+
+    def test_load(self):
+        self.assertEqual(self.rows(), [('All', None), ('a', 1), ('b', 2)])
+
+    def test_delta_same_as_reload(self):
+        nikki.save(1, '2016-01-01 12:00', '', 'b c', 'text', None)
+        self.model.applyDelta({'a': -1, 'c': 1})
+        self.assertEqual(self.rows(), [('All', None), ('b', 2), ('c', 1)])
+        nikki.delete(2)
+        self.model.applyDelta({'b': -1})
+        self.assertEqual(self.model.rowOf('b'), 1)
+        expected = self.rows()
+        self.model.load()
+        self.assertEqual(self.rows(), expected)
+
+
+class MakePreviewTest(unittest.TestCase):
+    def test_not_cut(self):
+        fmt = [(0, 5, 1)]
+        self.assertEqual(makePreview('abc\ndef', fmt, 4, 10), ('abc\ndef', fmt))
+
+    def test_cut_lines(self):
+        text = 'abcdefghij\nxyz\n1\n2\n3'
+        self.assertEqual(makePreview(text, [(0, 20, 1), (9, 3, 2), (12, 1, 3)], 3, 5),
+                         ('abcdefghij\nxyz', [(0, 10, 1), (11, 3, 1), (9, 1, 2),
+                                                (11, 1, 2), (12, 1, 3)]))
+
+    def test_cut_long_paragraph(self):
+        text = 'a' * 30 + '\nb'
+        self.assertEqual(makePreview(text, [(3, 10, 1), (20, 5, 2), (31, 1, 3)], 2, 5),
+                         ('a' * 10, [(3, 7, 1)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
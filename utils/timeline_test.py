@@ -0,0 +1,39 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from hazama.timeline import Timeline
+
+
+class TimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_not_began(self):
+        t = Timeline()
+        t.mark('a')
+        t.finish('b')
+        self.assertEqual(t.phases, [])
+
+    def test_phases(self):
+        t = Timeline()
+        t.path = os.path.join(self.tmp_dir, 'startup.json')
+        t.begin()
+        t.mark('a')
+        t.mark('b')
+        t.finish('c')
+        t.mark('d')  # ignored after finished
+        t.finish('e')
+        self.assertEqual([n for n, __ in t.phases], ['a', 'b', 'c'])
+        self.assertAlmostEqual(sum(sec for __, sec in t.phases), t.total())
+        with open(t.path, encoding='utf-8') as f:
+            saved = json.load(f)
+        self.assertEqual([i['name'] for i in saved['phases']], ['a', 'b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()